@@ -0,0 +1,312 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import socket
+import statistics
+import sys
+import threading
+import time
+
+import Client
+import Server
+from Client import Colors
+
+# Benchmark defaults
+BENCH_HOST = "127.0.0.1"  # Server and client share the loopback interface, so the suite runs offline
+BENCH_SIZES = "1000000,10000000"
+BENCH_CHUNK_SIZES = "65536,262144"  # TCP send chunk sizes (the legacy engine keeps its own); UDP datagrams are always BUFFER_SIZE bytes
+BENCH_CONNECTIONS = "1,4"
+BENCH_PROTOCOLS = "tcp,udp"
+BENCH_ENGINES = Server.TCP_SEND_ENGINE
+BENCH_CORES = Server.SERVER_CORE
+BENCH_PAYLOADS = "filler"  # "random" downloads the seeded random pool and verifies every byte on the client
+BENCH_REPETITIONS = 3
+BENCH_WARMUP = 1
+BASELINE_PATH = "bench_baseline.json"
+REGRESSION_THRESHOLD = 0.10  # Fail when a tracked metric is more than 10% worse than the baseline
+SERVER_START_TIMEOUT = 5  # Seconds to wait for an in-process server to accept connections
+# Metrics compared against the baseline and whether higher values are better
+TRACKED_METRICS = {'throughput_bps': True, 'packets_per_s': True, 'cpu_s_per_gb': False}
+
+
+class LoopbackServer:
+    """
+    One in-process server (UDP and TCP) on ephemeral loopback ports.
+
+    The server runs on daemon threads for the rest of the process, exactly as `Server.py`
+    runs it, so the benchmark goes through `handle_tcp_client`/`handle_udp_request` (or
+    their event-loop counterparts) and the real socket stack.
+    """
+
+    def __init__(self, core, engine_name, chunk_size):
+        self.engine = Server.make_tcp_send_engine(engine_name, chunk_size)
+        tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp_sock.bind((BENCH_HOST, 0))
+        udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_sock.bind((BENCH_HOST, 0))
+        self.tcp_port = tcp_sock.getsockname()[1]
+        self.udp_port = udp_sock.getsockname()[1]
+        if core == "asyncio":
+            target = lambda: asyncio.run(Server.async_server(self.engine, broadcast=False, tcp_sock=tcp_sock,
+                                                             udp_sock=udp_sock))
+            threading.Thread(target=target, daemon=True).start()
+        else:
+            threading.Thread(target=Server.tcp_server, args=(self.engine,), kwargs={'tcp_sock': tcp_sock},
+                             daemon=True).start()
+            threading.Thread(target=Server.udp_server, kwargs={'udp_sock': udp_sock}, daemon=True).start()
+        self.wait_until_listening()
+
+    def wait_until_listening(self):
+        """
+        Blocks until the TCP server accepts connections (the UDP socket is bound already).
+        """
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while True:
+            try:
+                with socket.create_connection((BENCH_HOST, self.tcp_port), timeout=1):
+                    return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Loopback server on port {self.tcp_port} did not start")
+                time.sleep(0.05)
+
+
+def run_trial(server, protocol, file_size, connections, payload="filler"):
+    """
+    Runs one download trial against a loopback server and measures it.
+
+    Args:
+        server (LoopbackServer): The server to download from.
+        protocol (str): "tcp" or "udp".
+        file_size (int): Bytes per connection.
+        connections (int): Parallel connections.
+        payload (str): "filler" or "random" (verified by the client, see `Client.payload_pool`).
+
+    Returns:
+        dict: Throughput over the active window, packets per second (UDP datagrams, TCP receive
+        calls), process CPU seconds (client and server) per GB moved and UDP loss.
+    """
+    stats = []
+    if protocol == "tcp":
+        target, port = Client.tcp_download, server.tcp_port
+    else:
+        target, port = Client.udp_download, server.udp_port
+    threads = [threading.Thread(target=target, args=(BENCH_HOST, port, file_size, i + 1, stats),
+                                kwargs={'random_payload': payload == "random"})
+               for i in range(connections)]
+    cpu_start = time.process_time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    cpu = time.process_time() - cpu_start
+
+    metrics = Client.trial_metrics(stats)
+    if protocol == "tcp":
+        packets = sum(stat['report']['syscalls'] for stat in stats)
+    else:
+        packets = sum(stat['report']['unique'] + stat['report']['duplicates'] for stat in stats)
+    window = metrics.get('duration_s', 0)
+    metrics['packets_per_s'] = packets / window if window > 0 else 0
+    metrics['cpu_s_per_gb'] = cpu / (metrics['bytes'] / 1e9) if metrics['bytes'] else None
+    return metrics
+
+
+def config_key(core, protocol, engine_name, chunk_size, file_size, connections, payload="filler"):
+    """
+    Names a configuration, e.g. "threads-tcp-memoryview-chunk65536-size1000000-conn4". Random
+    payload configurations end in "-random".
+    """
+    suffix = "" if payload == "filler" else f"-{payload}"
+    if protocol == "udp":
+        return f"{core}-udp-size{file_size}-conn{connections}{suffix}"
+    return f"{core}-tcp-{engine_name}-chunk{chunk_size}-size{file_size}-conn{connections}{suffix}"
+
+
+def engine_chunk_sizes(engine_name, chunk_sizes=None):
+    """
+    The TCP send chunk sizes an engine is measured with: `chunk_sizes` when given, otherwise
+    BENCH_CHUNK_SIZES, except for the legacy engine, which is measured as the original server
+    sent (its `default_chunk_size`).
+    """
+    if chunk_sizes:
+        return chunk_sizes
+    if engine_name == Server.LegacySendEngine.name:
+        return [Server.LegacySendEngine.default_chunk_size]
+    return Client.parse_int_list(BENCH_CHUNK_SIZES)
+
+
+def run_benchmarks(cores, protocols, engines, chunk_sizes, sizes, connections, repetitions=BENCH_REPETITIONS,
+                   warmup=BENCH_WARMUP, log=print, payloads=("filler",)):
+    """
+    Sweeps every configuration `warmup + repetitions` times and keeps the median of each
+    metric over the measured trials (the median is less sensitive to a noisy trial than
+    the mean on a shared machine). A `chunk_sizes` of None measures every engine with its
+    own sizes (see `engine_chunk_sizes`).
+
+    Returns:
+        dict: JSON-serializable results keyed by `config_key`.
+    """
+    servers = {}
+    results = {}
+    for core in cores:
+        for protocol in protocols:
+            # UDP does not use the TCP engine or chunk size, so it is measured once per core
+            variants = [(engine, chunk) for engine in engines for chunk in engine_chunk_sizes(engine, chunk_sizes)] \
+                if protocol == "tcp" else [(engines[0], engine_chunk_sizes(engines[0], chunk_sizes)[0])]
+            for engine_name, chunk_size in variants:
+                if (core, engine_name, chunk_size) not in servers:
+                    servers[(core, engine_name, chunk_size)] = LoopbackServer(core, engine_name, chunk_size)
+                server = servers[(core, engine_name, chunk_size)]
+                for file_size in sizes:
+                    for count in connections:
+                        for payload in payloads:
+                            key = config_key(core, protocol, engine_name, chunk_size, file_size, count, payload)
+                            trials = [run_trial(server, protocol, file_size, count, payload)
+                                      for _ in range(warmup + repetitions)][warmup:]
+                            summary = {}
+                            for name in sorted({name for metrics in trials for name in metrics}):
+                                values = [metrics[name] for metrics in trials if metrics.get(name) is not None]
+                                if values:
+                                    summary[name] = statistics.median(values)
+                            results[key] = summary
+                            log(key, summary)
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """
+    Compares the tracked metrics of every configuration present in both runs.
+
+    Args:
+        results (dict): Current results keyed by configuration.
+        baseline (dict): Baseline results keyed by configuration.
+        threshold (float): Allowed relative change in the bad direction, e.g. 0.10 = 10%.
+
+    Returns:
+        list: One dict per compared metric with 'config', 'metric', 'baseline', 'current',
+        'change' (relative, positive = better) and 'regressed'.
+    """
+    comparisons = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        for metric, higher_is_better in TRACKED_METRICS.items():
+            old, new = baseline[key].get(metric), results[key].get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old if higher_is_better else (old - new) / old
+            comparisons.append({'config': key, 'metric': metric, 'baseline': old, 'current': new,
+                                'change': change, 'regressed': change < -threshold})
+    return comparisons
+
+
+def parse_list(text):
+    """
+    Parses a comma separated list of names, e.g. "tcp,udp".
+    """
+    return [value.strip() for value in text.split(",") if value.strip()]
+
+
+def parse_args(argv=None):
+    """
+    Parses the benchmark command line options.
+    """
+    parser = argparse.ArgumentParser(description="Loopback benchmarks for the speed test server and client.")
+    parser.add_argument("--sizes", type=Client.parse_int_list, default=Client.parse_int_list(BENCH_SIZES),
+                        help=f"comma separated file sizes in bytes (default: {BENCH_SIZES})")
+    parser.add_argument("--chunk-sizes", type=Client.parse_int_list,
+                        help=f"comma separated TCP send chunk sizes (default: {BENCH_CHUNK_SIZES}, "
+                             f"{Server.LegacySendEngine.default_chunk_size} for the legacy engine)")
+    parser.add_argument("--connections", type=Client.parse_int_list, default=Client.parse_int_list(BENCH_CONNECTIONS),
+                        help=f"comma separated numbers of parallel connections (default: {BENCH_CONNECTIONS})")
+    parser.add_argument("--protocols", type=parse_list, default=parse_list(BENCH_PROTOCOLS),
+                        help=f"comma separated protocols, tcp and/or udp (default: {BENCH_PROTOCOLS})")
+    parser.add_argument("--engines", type=parse_list, default=parse_list(BENCH_ENGINES),
+                        help=f"comma separated TCP send engines (default: {BENCH_ENGINES})")
+    parser.add_argument("--cores", type=parse_list, default=parse_list(BENCH_CORES),
+                        help=f"comma separated server cores, threads and/or asyncio (default: {BENCH_CORES})")
+    parser.add_argument("--payloads", type=parse_list, default=parse_list(BENCH_PAYLOADS),
+                        help=f"comma separated download payloads, filler and/or random (default: {BENCH_PAYLOADS})")
+    parser.add_argument("--repetitions", type=int, default=BENCH_REPETITIONS,
+                        help=f"measured trials per configuration (default: {BENCH_REPETITIONS})")
+    parser.add_argument("--warmup", type=int, default=BENCH_WARMUP,
+                        help=f"discarded warm-up trials per configuration (default: {BENCH_WARMUP})")
+    parser.add_argument("--baseline", default=BASELINE_PATH,
+                        help=f"baseline file to compare against or save to (default: {BASELINE_PATH})")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store this run as the new baseline instead of comparing")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help=f"allowed relative regression of a tracked metric (default: {REGRESSION_THRESHOLD})")
+    parser.add_argument("--output", help="also write this run's results as JSON to this file")
+    args = parser.parse_args(argv)
+    if any(protocol not in ("tcp", "udp") for protocol in args.protocols):
+        parser.error("--protocols accepts tcp and udp")
+    if any(engine not in Server.TCP_SEND_ENGINES for engine in args.engines):
+        parser.error(f"--engines accepts {', '.join(Server.TCP_SEND_ENGINES)}")
+    if any(core not in ("threads", "asyncio") for core in args.cores):
+        parser.error("--cores accepts threads and asyncio")
+    if any(payload not in ("filler", "random") for payload in args.payloads):
+        parser.error("--payloads accepts filler and random")
+    if args.repetitions < 1 or args.warmup < 0:
+        parser.error("--repetitions must be at least 1 and --warmup must not be negative")
+    if args.threshold < 0:
+        parser.error("--threshold must not be negative")
+    return args
+
+
+def main(argv=None):
+    """
+    Runs the benchmark sweep, then saves it as the baseline or gates it against the baseline.
+
+    Returns:
+        int: 0 when no tracked metric regressed beyond the threshold, 1 otherwise.
+    """
+    args = parse_args(argv)
+    print(Colors.HEADER + "Loopback benchmark" + Colors.ENDC)
+
+    def log(key, summary):
+        print(f"{Colors.OKCYAN}{key}: {summary.get('throughput_bps', 0) / 1e6:.1f} Mbps, "
+              f"{summary.get('packets_per_s', 0):.0f} packets/s, "
+              f"{summary.get('cpu_s_per_gb') or 0:.3f} CPU s/GB{Colors.ENDC}", file=sys.__stdout__, flush=True)
+
+    # Server and client report every transfer on stdout; keep only the benchmark lines
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = run_benchmarks(args.cores, args.protocols, args.engines, args.chunk_sizes, args.sizes,
+                                 args.connections, args.repetitions, args.warmup, log, args.payloads)
+    run = {'host': platform.node(), 'python': platform.python_version(),
+           'started': time.strftime("%Y-%m-%dT%H:%M:%S%z"), 'results': results}
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(run, output, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as output:
+            json.dump(run, output, indent=2)
+        print(Colors.OKGREEN + f"Baseline saved to {args.baseline}" + Colors.ENDC)
+        return 0
+    if not os.path.exists(args.baseline):
+        print(Colors.WARNING + f"No baseline at {args.baseline}, run with --save-baseline first" + Colors.ENDC)
+        return 0
+
+    with open(args.baseline) as source:
+        baseline = json.load(source)
+    comparisons = compare_to_baseline(results, baseline['results'], args.threshold)
+    regressions = [comparison for comparison in comparisons if comparison['regressed']]
+    for comparison in comparisons:
+        color = Colors.FAIL if comparison['regressed'] else Colors.OKGREEN
+        print(f"{color}{comparison['config']} {comparison['metric']}: {comparison['baseline']:.4g} -> "
+              f"{comparison['current']:.4g} ({comparison['change']:+.1%}){Colors.ENDC}")
+    if regressions:
+        print(Colors.FAIL + f"{len(regressions)} tracked metric(s) regressed by more than {args.threshold:.0%}"
+              + Colors.ENDC)
+        return 1
+    print(Colors.OKGREEN + f"No regressions beyond {args.threshold:.0%} in {len(comparisons)} comparisons" + Colors.ENDC)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,27 @@
+import argparse
+import bisect
+import collections
+import contextlib
+import csv
+import functools
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
 import socket
+import statistics
 import struct
+import sys
 import threading
 import time
+from array import array
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows, where SIOCOUTQ does not exist either
+    fcntl = None
 
 
 class Colors:
@@ -20,53 +40,719 @@ MAGIC_COOKIE = 0xabcddcba
 OFFER_TYPE = 0x2
 REQUEST_TYPE = 0x3
 PAYLOAD_TYPE = 0x4
+UPLOAD_TYPE = 0x5
+BIDIR_TYPE = 0x6
+RESULT_TYPE = 0x7
+FIN_TYPE = 0x8
+PROBE_TYPE = 0x9
+PAYLOAD_TS_TYPE = 0xA
+REQUEST_FLAG_TIMESTAMPS = 0x1  # UDP request flag: send PAYLOAD_TS_TYPE segments carrying the server's send time
+STOP_TYPE = 0xB
+REJECT_TYPE = 0xC
+NACK_TYPE = 0xD
+REQUEST_FLAG_RELIABLE = 0x2  # UDP request flag: resend the segments this client reports missing in NACK_TYPE messages
+REQUEST_FLAG_RANDOM = 0x4  # UDP request flag: fill the segments from the random payload pool instead of filler
+TCP_RANDOM_PAYLOAD = "random"  # Word appended to a TCP request for the random payload pool
+TCP_TUNING_OPTIONS = ("chunk", "sndbuf", "nodelay", "cc")  # Server socket options a TCP request may ask for as name=value
+PAYLOAD_SEED = 0x5EED5EED  # Seed the server generates its random payload pool from, the client regenerates it
+PAYLOAD_POOL_SIZE = 1024 * 1024  # Bytes in the random payload pool: byte i of a transfer is pool[i % size]
+RANDOM_PAYLOAD = False  # Interactive runs: download the random payload (incompressible) and verify every byte received
 BUFFER_SIZE = 1024
 UDP_TIMEOUT = 20
 BROADCAST_PORT = 12345
+DISCOVERY_WINDOW = 1.5  # Seconds to keep collecting offers after the first one, just over one broadcast interval
+SERVER_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".speedtest_servers.json")  # Known servers, None = no cache
+SERVER_CACHE_TTL = 600  # Seconds a cached server is trusted without hearing its offer or probe echo again
+RTT_PROBES = 5  # Echo probes sent to every candidate server, the median round-trip time ranks them
+PROBE_TIMEOUT = 0.5  # Seconds to wait for one probe echo
+PROBE = struct.Struct('!IBQ')  # Magic cookie, message type, probe sequence number
+PROBE_TS = struct.Struct('!IBQQQ')  # PROBE plus the client's send time and the server's receive time (ns)
+PROBE_STAMP = struct.Struct('!QQ')  # Sequence number and client send time, rewritten in place for every probe
+PAYLOAD_TS_HEADER = struct.Struct('!IBQQQ')  # PAYLOAD_HEADER plus the server's send time (ns)
+REJECT = struct.Struct('!IBI')  # Magic cookie, message type, milliseconds the server asks the client to wait
+NACK_HEADER = struct.Struct('!IBH')  # Magic cookie, message type, number of ranges that follow
+NACK_RANGE = struct.Struct('!QI')  # First missing segment, number of missing segments
+UDP_MAX_SEGMENT = 65507 - PAYLOAD_TS_HEADER.size  # Largest segment payload a download may ask for (one IPv4 datagram)
+NACK_MAX_RANGES = (BUFFER_SIZE - NACK_HEADER.size) // NACK_RANGE.size  # Ranges that fit in one NACK datagram
+NACK_INTERVAL = 0.1  # Seconds between the NACKs of a reliable UDP download, and its silence before asking again
+NACK_ROUND_RANGES = 1024  # Ranges asked for at most in one round after the server went quiet
+NACK_REPEAT_RTTS = 2  # Repair round trips of quiet before a hole that is still missing is asked for again
+NACK_GIVE_UP = 5  # Seconds without a new segment after which a reliable UDP download gives up
+RELIABLE_UDP = False  # Interactive runs: repair lost UDP download segments through NACKs, for a goodput comparable to TCP
+REJECT_RETRIES = 3  # Times a transfer the server rejected (at capacity) is tried again after the wait it asked for
+SERVER_SPREAD = 1  # Servers to spread the connections over round-robin, lowest RTT first
+UDP_TARGET_RATE = 0  # Bits/second the server should pace UDP transfers to, 0 = as fast as possible
+TCP_RECV_MODE = "recv_into"  # "recv_into" fills one preallocated buffer, "recv" allocates a bytes object per call
+TCP_READ_SIZE = 256 * 1024  # Bytes asked for per TCP receive call
+TCP_RCVBUF = 0  # SO_RCVBUF for TCP downloads in bytes, 0 = system default (keeps Linux receive buffer auto-tuning)
+TCP_QUICKACK = False  # Re-arm TCP_QUICKACK after every receive call (Linux only)
+UDP_IDLE_TIMEOUT = 1  # Seconds of silence after which a UDP download is considered finished
+PAYLOAD_HEADER = struct.Struct('!IBQQ')  # Magic cookie, message type, total segments, current segment
+MESSAGE_HEADER = struct.Struct('!IB')  # Magic cookie and message type, the start of every message
+RESULT_FRAME = struct.Struct('!IBQQQ')  # Magic cookie, message type, bytes received, segments received, receive time (ns)
+UDP_TIMESTAMPS = False  # Ask for timestamped UDP download segments (one-way delay variation); servers without request options drop such requests
+LATENCY_TEST = False  # Interactive runs: measure the RTT idle and under TCP load before the speed test
+LATENCY_PROBE_RATE = 1000  # Timestamped probes per second sent by the latency test
+LATENCY_DURATION = 2  # Seconds each latency measurement lasts at most
+LATENCY_LOAD_CONNECTIONS = 4  # TCP downloads that load the path while the latency under load is measured
+LATENCY_LOAD_SIZE = 50_000_000  # Bytes each of those downloads transfers
+LATENCY_LOAD_RAMP = 0.5  # Seconds the load runs before probing starts, so the queues have filled up
+TEST_MODE = "download"  # Direction of the interactive test: "download", "upload" or "bidir" (both at once)
+TEST_MODES = ("download", "upload", "bidir")
+TEST_DURATION = 0  # Seconds a download streams for instead of transferring a file size, 0 = use the file size
+STREAM_WARMUP = 1.0  # Seconds at the start of a stream left out of the reported throughput (TCP slow start)
+STABILITY_TOLERANCE = 0  # End a stream early once its last STABILITY_INTERVALS intervals lie within this fraction of their mean, 0 = off
+STABILITY_INTERVALS = 10  # Sampling intervals the stability check looks at (1 second)
+STREAM_DRAIN_TIMEOUT = 2  # Seconds a stopped TCP stream may take to deliver what was already in flight
+UDP_FIN_RETRIES = 3  # Times a UDP upload repeats its FIN when the server's result does not arrive
+UDP_PACING_SLACK = 0.001  # Seconds a paced UDP upload may run ahead of its target rate before sleeping
+SIOCOUTQ = 0x5411  # Linux ioctl: bytes of a TCP socket's send queue the peer has not acknowledged yet
+UPLOAD_ACK_TIMEOUT = 2  # Seconds a TCP upload waits for the server to acknowledge its last byte
+UPLOAD_ACK_POLL = 0.001  # Seconds between the checks of that wait
+SAMPLE_INTERVAL_NS = 100_000_000  # Length of one throughput sampling interval (100 ms)
+SPARKLINE_WIDTH = 60  # Maximum number of characters in a per-connection sparkline
+SPARKLINE_CHARS = "▁▂▃▄▅▆▇█"
+CLIENT_PROCESSES = 0  # Worker processes to shard connections across, 0 or 1 = all connections in this process
+CLIENT_PIN_CPUS = False  # Pin each worker process to its own CPU core (Linux only)
+SHARD_START_TIMEOUT = 30  # Seconds worker processes wait for each other before starting their transfers
+SERIES_EXPORT_PATH = None  # File (.json or .csv) to write per-interval throughput to after each test, None = off
+HISTORY_PATH = os.path.join(os.path.expanduser("~"), ".speedtest_history")  # Append-only results history, None = off
+HISTORY_MAGIC = b'STH\x01'  # First bytes of the history file and of its index (HISTORY_PATH + ".idx"), version 1
+# One history record per protocol and direction of a test: time (ns since the epoch), server IPv4 address, protocol,
+# direction, flags, servers, connections asked for and completed, file size, stream duration (ms), bytes, window (s),
+# throughput, throughput while all connections were active (NaN if never), median interval throughput and mean
+# connection speed (bits/second), loss percentage (NaN for TCP) and corrupted receives
+HISTORY_RECORD = struct.Struct('!Q4sBBBBHHQIQddddddQ')
+HISTORY_INDEX = struct.Struct('!Q4s')  # Time and server of every record, entry i belongs to record i
+HISTORY_FLAG_RELIABLE = 0x1  # History record flag: reliable UDP
+HISTORY_FLAG_RANDOM = 0x2  # History record flag: random payload
+TUNING_PATH = os.path.join(os.path.expanduser("~"), ".speedtest_tuning.json")  # Best socket options per host pair, None = off
+USE_TUNING = False  # Interactive runs: download with the socket options auto-tuning found for the server (--tuned)
+TUNE_TRIAL_DURATION = 3  # Seconds every auto-tuning trial streams for, the first STREAM_WARMUP of them left out
+TUNE_REPETITIONS = 1  # Trials per candidate configuration, the median throughput counts
+TUNE_MIN_GAIN = 0.03  # Fraction a candidate must beat the best configuration by to replace it, above trial noise
+TUNE_TCP_CHUNKS = (16384, 65536, 262144, 1048576, 4194304)  # Server send call sizes tried, besides the server's default
+TUNE_SNDBUFS = (262144, 1048576, 4194304)  # Server SO_SNDBUF values tried, besides the system default
+TUNE_RCVBUFS = (262144, 1048576, 4194304)  # Client SO_RCVBUF values tried, besides the system default
+TUNE_UDP_SEGMENTS = (512, 2048, 4096, 8192, 16384, 32768)  # Datagram payloads tried up to the path MTU, plus the largest
+CONGESTION_CONTROL_PATH = "/proc/sys/net/ipv4/tcp_available_congestion_control"  # Linux, the algorithms to try
+DEFAULT_PATH_MTU = 1500  # Assumed where the kernel does not report the path MTU (Ethernet)
+IP_UDP_OVERHEAD = 28  # IPv4 and UDP header bytes of a datagram
+HISTORY_PROTOCOLS = ("tcp", "udp")  # Protocol field values of a history record
+HISTORY_DIRECTIONS = ("download", "upload")  # Direction field values of a history record
+SERVER_TCP_PORT = 16000  # Ports assumed when the server is given on the command line instead of discovered
+SERVER_UDP_PORT = 15000
+# Two-sided 95% Student t critical values by degrees of freedom; larger samples use the normal value 1.96
+T_CRITICAL_95 = (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.201, 2.179, 2.160, 2.145,
+                 2.131, 2.120, 2.110, 2.101, 2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048,
+                 2.045, 2.042)
 
 
-def listen_for_offers():
+def collect_offers(window=DISCOVERY_WINDOW, timeout=UDP_TIMEOUT):
     """
-    Listens for server offers via UDP broadcasts.
-    Returns the server's IP, UDP port, and TCP port if a valid offer is received.
+    Listens for server offers via UDP broadcasts. Waits up to `timeout` seconds for the first
+    offer, then keeps listening for `window` more seconds so every server in the LAN is heard.
+
+    Args:
+        window (float): Seconds to keep collecting after the first offer.
+        timeout (float): Seconds to wait for the first offer.
+
+    Returns:
+        list: (server IP, UDP port, TCP port) of every server that sent an offer, in arrival order.
     """
+    offers = []
     with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_sock:  # Creating a UDP socket using IPv4 (AF_INET)
         udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)  # Enabling the option to send broadcast messages
         udp_sock.bind(("",
                        BROADCAST_PORT))  # Binding the socket to listen on all available interfaces on the specified broadcast port
-        udp_sock.settimeout(UDP_TIMEOUT)  # Setting a timeout for UDP socket operations to prevent indefinite blocking
 
         print(f"{Colors.OKBLUE}Client started, listening for offer requests...{Colors.ENDC}")
-        try:
-            while True:
-                try:
-                    data, server_address = udp_sock.recvfrom(BUFFER_SIZE)
-                    if len(data) >= 9:
-                        # Attempt to unpack the data
-                        magic_cookie, msg_type, udp_port, tcp_port = struct.unpack('!IBHH', data)
-                        # msg_type (ip,port)
-                        if magic_cookie == MAGIC_COOKIE and msg_type == OFFER_TYPE:
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            udp_sock.settimeout(remaining)  # Never block past the deadline
+            try:
+                data, server_address = udp_sock.recvfrom(BUFFER_SIZE)
+                if len(data) >= 9:
+                    # Attempt to unpack the data
+                    magic_cookie, msg_type, udp_port, tcp_port = struct.unpack('!IBHH', data)
+                    # msg_type (ip,port)
+                    if magic_cookie == MAGIC_COOKIE and msg_type == OFFER_TYPE:
+                        offer = (server_address[0], udp_port, tcp_port)
+                        if offer not in offers:  # Every server repeats its offer each broadcast interval
                             print(
                                 f"{Colors.OKGREEN}️✔ Received offer from {server_address[0]}: UDP port {udp_port}, TCP port {tcp_port}{Colors.ENDC}")
-                            return server_address[0], udp_port, tcp_port
-                        else:
-                            print(
-                                f"{Colors.WARNING}⚠️ Received packet from {server_address[0]} but it is not a valid offer.{Colors.ENDC}")
+                            if not offers:
+                                deadline = min(deadline, time.monotonic() + window)
+                            offers.append(offer)
+                    else:
+                        print(
+                            f"{Colors.WARNING}⚠️ Received packet from {server_address[0]} but it is not a valid offer.{Colors.ENDC}")
 
-                # struct.error: occurs if the data size or format doesn't match to unpack format.
-                # Exception: handles any general errors (e.g., network errors or socket issues).
-                except struct.error:
-                    print(f"{Colors.FAIL}❌ Invalid packet structure received, ignoring...{Colors.ENDC}")
-                except Exception as e:
-                    print(f"{Colors.FAIL}❌ Unexpected error while listening for offers: {e}{Colors.ENDC}")
+            # struct.error: occurs if the data size or format doesn't match to unpack format.
+            # Exception: handles any general errors (e.g., network errors or socket issues).
+            except socket.timeout:
+                break
+            except struct.error:
+                print(f"{Colors.FAIL}❌ Invalid packet structure received, ignoring...{Colors.ENDC}")
+            except Exception as e:
+                print(f"{Colors.FAIL}❌ Unexpected error while listening for offers: {e}{Colors.ENDC}")
 
-        except socket.timeout:
-            print(f"{Colors.FAIL}⏰ No server offer received within timeout period.{Colors.ENDC}")
-            return None, None
+    if not offers:
+        print(f"{Colors.FAIL}⏰ No server offer received within timeout period.{Colors.ENDC}")
+    return offers
+
+
+def read_server_cache(path=SERVER_CACHE_PATH):
+    """
+    Reads the on-disk server cache.
+
+    Args:
+        path (str): The cache file, None to disable the cache.
+
+    Returns:
+        dict: Maps (server IP, UDP port, TCP port) to the time.time() it was last seen,
+        empty if there is no usable cache.
+    """
+    if not path:
+        return {}
+    try:
+        with open(path) as f:
+            entries = json.load(f)['servers']
+        return {(entry['ip'], entry['udp_port'], entry['tcp_port']): entry['seen'] for entry in entries}
+    except (OSError, ValueError, KeyError, TypeError):  # Missing, unreadable or corrupt cache: discover again
+        return {}
+
+
+def load_server_cache(path=SERVER_CACHE_PATH, ttl=SERVER_CACHE_TTL):
+    """
+    Returns the cached servers seen within the last `ttl` seconds, most recently seen first.
+    """
+    now = time.time()
+    entries = read_server_cache(path)
+    return sorted((server for server, seen in entries.items() if now - seen <= ttl),
+                  key=entries.get, reverse=True)
+
+
+def save_server_cache(servers, path=SERVER_CACHE_PATH, ttl=SERVER_CACHE_TTL):
+    """
+    Records `servers` as seen now in the on-disk cache and drops the entries older than `ttl`.
+
+    Args:
+        servers (list): (server IP, UDP port, TCP port) tuples that just answered.
+        path (str): The cache file, None to disable the cache.
+        ttl (float): Seconds a cache entry stays valid.
+    """
+    if not path:
+        return
+    now = time.time()
+    entries = {server: seen for server, seen in read_server_cache(path).items() if now - seen <= ttl}
+    entries.update((tuple(server), now) for server in servers)
+    try:
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as f:
+            json.dump({'servers': [{'ip': ip, 'udp_port': udp_port, 'tcp_port': tcp_port, 'seen': seen}
+                                   for (ip, udp_port, tcp_port), seen in entries.items()]}, f, indent=2)
+        os.replace(temporary, path)  # Atomic, so concurrent clients never read a half written cache
+    except OSError as e:
+        print(f"{Colors.WARNING}⚠️ Could not write the server cache {path}: {e}{Colors.ENDC}")
+
+
+def probe_rtt(server, count=RTT_PROBES, timeout=PROBE_TIMEOUT):
+    """
+    Measures the round-trip time to a server with PROBE_TYPE messages, which it echoes from its UDP port.
+
+    Args:
+        server (tuple): (server IP, UDP port, TCP port).
+        count (int): Number of probes to send.
+        timeout (float): Seconds to wait for each echo.
+
+    Returns:
+        float: The median RTT of the answered probes in seconds, None if no probe was answered.
+    """
+    server_ip, udp_port, _ = server
+    rtts = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_sock:
+        udp_sock.settimeout(timeout)
+        for sequence in range(count):
+            probe = PROBE.pack(MAGIC_COOKIE, PROBE_TYPE, sequence)
+            sent_ns = time.perf_counter_ns()
+            try:
+                udp_sock.sendto(probe, (server_ip, udp_port))
+                while udp_sock.recv(BUFFER_SIZE) != probe:  # Skips late echoes of earlier probes
+                    pass
+                rtts.append((time.perf_counter_ns() - sent_ns) / 1e9)
+            except socket.timeout:
+                continue
+            except OSError:  # E.g. ICMP port unreachable: nothing listens there anymore
+                return None
+    return statistics.median(rtts) if rtts else None
+
+
+def rank_servers(servers):
+    """
+    Probes all `servers` in parallel and orders them by round-trip time.
+
+    Args:
+        servers (list): (server IP, UDP port, TCP port) tuples.
+
+    Returns:
+        list: (server, RTT in seconds) pairs, lowest RTT first. Servers that did not answer
+        (e.g. older servers without probe support) come last with an RTT of None.
+    """
+    rtts = {}
+
+    def probe(server):
+        rtts[server] = probe_rtt(server)
+
+    threads = [threading.Thread(target=probe, args=(server,)) for server in servers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(((server, rtts.get(server)) for server in servers),
+                  key=lambda pair: (pair[1] is None, pair[1] or 0))
+
+
+def find_servers(count=SERVER_SPREAD, use_cache=True, cache_path=SERVER_CACHE_PATH):
+    """
+    Finds up to `count` servers to test against, lowest round-trip time first.
+
+    Fresh cached servers that still answer a probe are used right away, skipping the wait for
+    broadcasts. Otherwise every offer heard during the discovery window is probed and cached.
+
+    Args:
+        count (int): Maximum number of servers to return.
+        use_cache (bool): Try the on-disk cache before listening for offers.
+        cache_path (str): The cache file, None to disable the cache.
+
+    Returns:
+        list: (server IP, UDP port, TCP port) tuples, empty if no server was found.
+    """
+    if use_cache:
+        cached = load_server_cache(cache_path)
+        ranked = [(server, rtt) for server, rtt in rank_servers(cached) if rtt is not None]
+        if ranked:
+            print(f"{Colors.OKGREEN}️✔ {len(ranked)} cached server(s) answered, skipping offer discovery{Colors.ENDC}")
+            save_server_cache([server for server, _ in ranked], cache_path)
+            for (server_ip, udp_port, tcp_port), rtt in ranked[:count]:
+                print(f"{Colors.OKCYAN}Using {server_ip} (UDP port {udp_port}, TCP port {tcp_port}), "
+                      f"RTT {rtt * 1000:.3f} ms{Colors.ENDC}")
+            return [server for server, _ in ranked[:count]]
+
+    offers = collect_offers()
+    if not offers:
+        return []
+    save_server_cache(offers, cache_path)
+    ranked = rank_servers(offers)
+    for (server_ip, udp_port, tcp_port), rtt in ranked[:count]:
+        rtt_text = "no probe answer" if rtt is None else f"RTT {rtt * 1000:.3f} ms"
+        print(f"{Colors.OKCYAN}Using {server_ip} (UDP port {udp_port}, TCP port {tcp_port}), {rtt_text}{Colors.ENDC}")
+    return [server for server, _ in ranked[:count]]
+
+
+def listen_for_offers():
+    """
+    Finds the lowest-latency server, from the cache or from offer broadcasts (see `find_servers`).
+    Returns the server's IP, UDP port, and TCP port, or (None, None, None) if no server was found.
+    """
+    servers = find_servers(1)
+    return servers[0] if servers else (None, None, None)
+
+
+# Interval throughput sampling
+class IntervalSeries:
+    """
+    Throughput time series of one transfer, sampled on fixed SAMPLE_INTERVAL_NS boundaries.
+
+    The receive loop keeps its own running byte and packet totals and only compares the
+    current `time.perf_counter_ns()` with `next_sample_ns`; when a boundary has passed it calls
+    `sample`, which appends the totals to compact arrays. Per-interval throughput is derived
+    from the differences between consecutive samples.
+    """
+
+    def __init__(self, start_ns, interval_ns=SAMPLE_INTERVAL_NS):
+        self.start_ns = start_ns
+        self.interval_ns = interval_ns
+        self.next_sample_ns = start_ns + interval_ns
+        self.ends_ns = array('q')  # End of each interval, relative to start_ns
+        self.bytes = array('Q')  # Cumulative bytes at the end of each interval
+        self.packets = array('Q')  # Cumulative packets (receive calls for TCP) at the end of each interval
+
+    def sample(self, now_ns, total_bytes, total_packets):
+        """
+        Closes every interval that ended before `now_ns`. Call it before adding the data that
+        arrived at `now_ns`, so that data is counted in the interval it belongs to.
+        """
+        while self.next_sample_ns <= now_ns:
+            self.ends_ns.append(self.next_sample_ns - self.start_ns)
+            self.bytes.append(total_bytes)
+            self.packets.append(total_packets)
+            self.next_sample_ns += self.interval_ns
+
+    def finish(self, end_ns, total_bytes, total_packets):
+        """
+        Closes the intervals up to `end_ns`, plus the final partial interval if there is one.
+        """
+        self.sample(end_ns, total_bytes, total_packets)
+        if end_ns > self.next_sample_ns - self.interval_ns:
+            self.ends_ns.append(end_ns - self.start_ns)
+            self.bytes.append(total_bytes)
+            self.packets.append(total_packets)
+
+    def intervals(self):
+        """
+        Yields (end offset in seconds, bytes, packets, bits/second) for every interval.
+        """
+        previous_end = previous_bytes = previous_packets = 0
+        for end, total_bytes, total_packets in zip(self.ends_ns, self.bytes, self.packets):
+            duration = end - previous_end
+            interval_bytes = total_bytes - previous_bytes
+            yield (end / 1e9, interval_bytes, total_packets - previous_packets,
+                   interval_bytes * 8e9 / duration if duration > 0 else 0)
+            previous_end, previous_bytes, previous_packets = end, total_bytes, total_packets
+
+    def rates(self):
+        """
+        Returns:
+            list: Bits/second of every interval. A final partial interval shorter than half an
+            interval is left out (it is too short to be meaningful) unless it is the only one.
+        """
+        rates = []
+        previous_end = 0
+        for end, (_, _, _, rate) in zip(self.ends_ns, self.intervals()):
+            if end - previous_end >= self.interval_ns // 2 or len(self.ends_ns) == 1:
+                rates.append(rate)
+            previous_end = end
+        return rates
+
+    def steady_state(self, warmup_ns):
+        """
+        Measures the part of the transfer after its warm-up: from the first sample at or after
+        `warmup_ns` to the last sample.
+
+        Returns:
+            tuple: (start of the steady window relative to start_ns, bytes, duration) with times
+            in nanoseconds, None if no whole interval follows the warm-up.
+        """
+        if warmup_ns <= 0 and self.ends_ns:
+            return 0, self.bytes[-1], self.ends_ns[-1]
+        first = bisect.bisect_left(self.ends_ns, warmup_ns)
+        if first >= len(self.ends_ns) - 1:
+            return None
+        return self.ends_ns[first], self.bytes[-1] - self.bytes[first], self.ends_ns[-1] - self.ends_ns[first]
+
+    def totals_at(self, offset_ns):
+        """
+        Estimates the cumulative byte and packet counts `offset_ns` after start_ns, interpolating
+        linearly between the samples around it (zero before the start, the totals after the end).
+
+        Returns:
+            tuple: (bytes, packets) as floats.
+        """
+        if offset_ns <= 0 or not self.ends_ns:
+            return 0.0, 0.0
+        index = bisect.bisect_left(self.ends_ns, offset_ns)
+        if index >= len(self.ends_ns):
+            return float(self.bytes[-1]), float(self.packets[-1])
+        previous_end, previous_bytes, previous_packets = ((self.ends_ns[index - 1], self.bytes[index - 1],
+                                                           self.packets[index - 1]) if index else (0, 0, 0))
+        fraction = (offset_ns - previous_end) / (self.ends_ns[index] - previous_end)
+        return (previous_bytes + fraction * (self.bytes[index] - previous_bytes),
+                previous_packets + fraction * (self.packets[index] - previous_packets))
+
+    def scaled(self, total_bytes):
+        """
+        Returns:
+            IntervalSeries: A copy whose cumulative byte counts are scaled to end at `total_bytes`,
+            the same timing with a different byte total (e.g. what arrived out of what was sent).
+        """
+        series = IntervalSeries(self.start_ns, self.interval_ns)
+        series.next_sample_ns = self.next_sample_ns
+        series.ends_ns = array('q', self.ends_ns)
+        series.packets = array('Q', self.packets)
+        last = self.bytes[-1] if self.bytes else 0
+        if last == total_bytes or not last:
+            series.bytes = array('Q', self.bytes)
+        else:
+            series.bytes = array('Q', (round(value * total_bytes / last) for value in self.bytes))
+        return series
+
+    def is_stable(self, count, tolerance, after_ns=0):
+        """
+        Checks whether the throughput has settled: the last `count` intervals all ended after
+        `after_ns` and each carried within `tolerance` (a fraction) of their mean byte count.
+        Meant to be called right after `sample`, so every interval checked is a whole one.
+        """
+        samples = len(self.bytes)
+        if tolerance <= 0 or count <= 0 or samples <= count or self.ends_ns[samples - count - 1] < after_ns:
+            return False
+        counts = [self.bytes[index] - self.bytes[index - 1] for index in range(samples - count, samples)]
+        mean = sum(counts) / count
+        return mean > 0 and all(abs(value - mean) <= tolerance * mean for value in counts)
+
+    def summary(self):
+        """
+        Returns:
+            dict: Interval count and min, median, p95 and p99 interval throughput in bits/second.
+        """
+        rates = sorted(self.rates())
+        if not rates:
+            return {'intervals': 0, 'min': 0, 'median': 0, 'p95': 0, 'p99': 0}
+        return {
+            'intervals': len(rates),
+            'min': rates[0],
+            'median': percentile(rates, 50),
+            'p95': percentile(rates, 95),
+            'p99': percentile(rates, 99),
+        }
+
+    def sparkline(self, width=SPARKLINE_WIDTH):
+        """
+        Renders the interval throughput as a line of block characters, averaging neighbouring
+        intervals when there are more than `width` of them.
+        """
+        rates = self.rates()
+        if not rates:
+            return ""
+        if len(rates) > width:
+            step = len(rates) / width
+            rates = [sum(rates[int(i * step):int((i + 1) * step)]) / (int((i + 1) * step) - int(i * step))
+                     for i in range(width)]
+        peak = max(rates) or 1
+        return "".join(SPARKLINE_CHARS[min(len(SPARKLINE_CHARS) - 1, int(rate / peak * len(SPARKLINE_CHARS)))]
+                       for rate in rates)
+
+
+def percentile(sorted_values, percent):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    rank = max(1, -(-len(sorted_values) * percent // 100))  # ceil(n * p / 100)
+    return sorted_values[int(rank) - 1]
+
+
+def print_interval_summary(protocol, stat):
+    """
+    Prints the interval throughput percentiles and sparkline of one transfer.
+
+    Args:
+        protocol (str): "TCP" or "UDP".
+        stat (dict): A statistics entry produced by `tcp_download` or `udp_download`.
+    """
+    summary = stat['series'].summary()
+    print(
+        f"{Colors.OKCYAN}  {protocol} transfer #{stat['id']} intervals ({summary['intervals']} x {SAMPLE_INTERVAL_NS // 1_000_000} ms): "
+        f"min {summary['min'] / 1e6:.2f}, median {summary['median'] / 1e6:.2f}, p95 {summary['p95'] / 1e6:.2f}, "
+        f"p99 {summary['p99'] / 1e6:.2f} Mbit/s {stat['series'].sparkline()}{Colors.ENDC}")
+
+
+def export_series(path, tcp_stats, udp_stats):
+    """
+    Writes the interval series of every transfer to `path`, as JSON if the name ends
+    with .json and as CSV otherwise.
+
+    Args:
+        path (str): Output file name.
+        tcp_stats (list): Statistics entries produced by `tcp_download`.
+        udp_stats (list): Statistics entries produced by `udp_download`.
+    """
+    rows = [(protocol, stat['id'], stat.get('direction', "download"), index, end, interval_bytes, packets, rate)
+            for protocol, stats in (("tcp", tcp_stats), ("udp", udp_stats))
+            for stat in stats
+            for index, (end, interval_bytes, packets, rate) in enumerate(stat['series'].intervals())]
+    columns = ("protocol", "connection", "direction", "interval", "end_s", "bytes", "packets", "bits_per_second")
+    with open(path, "w", newline="") as f:
+        if path.endswith(".json"):
+            json.dump({'interval_ns': SAMPLE_INTERVAL_NS, 'samples': [dict(zip(columns, row)) for row in rows]}, f, indent=2)
+        else:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(rows)
+
+
+# Aggregate throughput
+# Concurrent transfers share one link, so their combined speed is all the bytes they moved over the window in
+# which any of them was active, not the mean of their own speeds. The per-transfer series are merged on a common
+# grid to see how the combined throughput evolved, and over the part of the window where every transfer ran.
+def aggregate_series(stats, interval_ns=SAMPLE_INTERVAL_NS):
+    """
+    Merges the interval series of concurrent transfers into one series of their combined
+    throughput, sampled on a common grid from the earliest 'start_ns' to the latest 'end_ns'.
+    Transfers sample on their own boundaries, so each one's cumulative counts are interpolated
+    at the common ones; bytes a transfer moved before its 'start_ns' (a stream's warm-up) are
+    left out. The timestamps come from `time.perf_counter_ns`, a system-wide clock on Linux,
+    so transfers of sharded worker processes merge too.
+
+    Args:
+        stats (list): Statistics entries of the transfers, none of them empty.
+        interval_ns (int): Length of one interval of the merged series.
+
+    Returns:
+        IntervalSeries: The combined series, starting at the earliest 'start_ns'.
+    """
+    start_ns = min(stat['start_ns'] for stat in stats)
+    end_ns = max(stat['end_ns'] for stat in stats)
+    bases = [(stat['series'], stat['series'].totals_at(stat['start_ns'] - stat['series'].start_ns)) for stat in stats]
+    merged = IntervalSeries(start_ns, interval_ns)
+    boundaries = list(range(start_ns + interval_ns, end_ns, interval_ns))
+    if end_ns > start_ns:
+        boundaries.append(end_ns)
+    for boundary in boundaries:
+        total_bytes = total_packets = 0.0
+        for series, (base_bytes, base_packets) in bases:
+            series_bytes, series_packets = series.totals_at(boundary - series.start_ns)
+            total_bytes += max(0.0, series_bytes - base_bytes)
+            total_packets += max(0.0, series_packets - base_packets)
+        merged.ends_ns.append(boundary - start_ns)
+        merged.bytes.append(round(total_bytes))
+        merged.packets.append(round(total_packets))
+    merged.next_sample_ns = end_ns + interval_ns
+    return merged
+
+
+def aggregate_throughput(stats):
+    """
+    Combines concurrent transfers (one protocol and direction) into the throughput of the link
+    they shared.
+
+    Args:
+        stats (list): Statistics entries produced by the transfer functions.
+
+    Returns:
+        dict: 'connections', 'bytes', 'window_s' (first start to last end) and 'throughput_bps'
+        (all bytes over that window); 'overlap_s' and 'overlap_bps' over the part of the window
+        in which every transfer was active (None if there was none); the min, median and p95
+        interval throughput of the combined series and the series itself under 'series'.
+        Empty (apart from 'connections') without any transfer.
+    """
+    aggregate = {'connections': len(stats)}
+    if not stats:
+        return aggregate
+    start_ns = min(stat['start_ns'] for stat in stats)
+    window_ns = max(stat['end_ns'] for stat in stats) - start_ns
+    overlap_start_ns = max(stat['start_ns'] for stat in stats)
+    overlap_ns = min(stat['end_ns'] for stat in stats) - overlap_start_ns
+    series = aggregate_series(stats)
+    total_bytes = sum(stat['bytes'] for stat in stats)
+    aggregate.update(bytes=total_bytes, window_s=window_ns / 1e9,
+                     throughput_bps=total_bytes * 8e9 / window_ns if window_ns > 0 else 0,
+                     overlap_s=None, overlap_bps=None, series=series)
+    if overlap_ns > 0:
+        overlap_bytes = (series.totals_at(overlap_start_ns + overlap_ns - start_ns)[0]
+                         - series.totals_at(overlap_start_ns - start_ns)[0])
+        aggregate.update(overlap_s=overlap_ns / 1e9, overlap_bps=overlap_bytes * 8e9 / overlap_ns)
+    summary = series.summary()
+    aggregate.update(interval_min_bps=summary['min'], interval_median_bps=summary['median'],
+                     interval_p95_bps=summary['p95'])
+    return aggregate
+
+
+def print_aggregate(protocol, direction, aggregate):
+    """
+    Prints the combined throughput of the concurrent transfers of one protocol and direction.
+    """
+    overlap = (f", {aggregate['overlap_bps'] / 1e6:.2f} Mbit/s while all were active "
+               f"({aggregate['overlap_s']:.2f} seconds)" if aggregate['overlap_bps'] is not None else "")
+    print(f"{Colors.OKGREEN}✔ {protocol} {direction} aggregate of {aggregate['connections']} transfers: "
+          f"{aggregate['throughput_bps'] / 1e6:.2f} Mbit/s over {aggregate['window_s']:.2f} seconds{overlap}.{Colors.ENDC}")
+    print(f"{Colors.OKCYAN}  {protocol} {direction} aggregate intervals: min {aggregate['interval_min_bps'] / 1e6:.2f}, "
+          f"median {aggregate['interval_median_bps'] / 1e6:.2f}, p95 {aggregate['interval_p95_bps'] / 1e6:.2f} "
+          f"Mbit/s {aggregate['series'].sparkline()}{Colors.ENDC}")
+
+
+# Rejected transfers
+# A server at capacity answers a transfer with REJECT instead of serving it. The transfer is tried again after the
+# wait the server asked for, plus jitter so the rejected connections of a test do not all return at once.
+class ServerBusy(Exception):
+    """
+    Raised when the server rejected a transfer with a REJECT message.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"the server is at capacity, retry after {retry_after:.1f} seconds")
+        self.retry_after = retry_after
+
+
+def check_reject(data, length=None):
+    """
+    Raises ServerBusy if `data[:length]` (length defaults to len(data)) is a REJECT message.
+    """
+    length = len(data) if length is None else length
+    if length == REJECT.size:
+        magic_cookie, msg_type, retry_after_ms = REJECT.unpack_from(data)
+        if magic_cookie == MAGIC_COOKIE and msg_type == REJECT_TYPE:
+            raise ServerBusy(retry_after_ms / 1000)
+
+
+def retry_when_busy(transfer):
+    """
+    Decorates a transfer function taking (server_ip, port, file_size, id_connection, ...): while
+    the server rejects the transfer, it runs again after the wait the server asked for plus up to
+    50% jitter, at most REJECT_RETRIES times.
+    """
+    @functools.wraps(transfer)
+    def run(server_ip, port, file_size, id_connection, *args, **kwargs):
+        for attempt in range(REJECT_RETRIES + 1):
+            try:
+                return transfer(server_ip, port, file_size, id_connection, *args, **kwargs)
+            except ServerBusy as busy:
+                if attempt == REJECT_RETRIES:
+                    print(f"{Colors.FAIL}❌ Transfer #{id_connection} rejected {attempt + 1} times, the server is at "
+                          f"capacity.{Colors.ENDC}")
+                    return None
+                wait = busy.retry_after * (1 + random.random() / 2)
+                print(f"{Colors.WARNING}⚠️ Transfer #{id_connection} rejected, the server is at capacity; retrying "
+                      f"in {wait:.1f} seconds...{Colors.ENDC}")
+                time.sleep(wait)
+    return run
+
+
+# Random payload
+payload_cache = b""
+payload_lock = threading.Lock()
+
+
+def payload_pool(span=BUFFER_SIZE):
+    """
+    Regenerates the server's random payload pool from PAYLOAD_SEED (once per process), repeated
+    so that the `span` bytes starting at any offset within the first period are one slice:
+    data received at transfer offset o is intact if `pool.startswith(data, o % PAYLOAD_POOL_SIZE)`.
+    The comparison runs at memory speed on the receive buffer, without copying it.
+
+    Args:
+        span (int): Longest piece of data that will be checked at once.
+
+    Returns:
+        bytes: The pool, at least PAYLOAD_POOL_SIZE + `span` bytes long.
+    """
+    global payload_cache
+    with payload_lock:
+        if len(payload_cache) < PAYLOAD_POOL_SIZE + span:
+            content = payload_cache[:PAYLOAD_POOL_SIZE] or random.Random(PAYLOAD_SEED).randbytes(PAYLOAD_POOL_SIZE)
+            payload_cache = content * (span // PAYLOAD_POOL_SIZE + 2)
+        return payload_cache
+
+
+def print_payload_check(protocol, id_connection, report, unit):
+    """
+    Prints the result of verifying a random payload download (`report['corrupt']` damaged `unit`s).
+    """
+    if report['corrupt']:
+        print(f"{Colors.FAIL}❌ {protocol} transfer #{id_connection}: {report['corrupt']} {unit} arrived corrupted "
+              f"(first at byte {report['first_corrupt_byte']}).{Colors.ENDC}")
+    else:
+        print(f"{Colors.OKCYAN}  {protocol} transfer #{id_connection}: random payload verified, no corruption."
+              f"{Colors.ENDC}")
 
 
 # Perform TCP download
-def tcp_download(server_ip, tcp_port, file_size, id_connection, stats):
+@retry_when_busy
+def tcp_download(server_ip, tcp_port, file_size, id_connection, stats, recv_mode=TCP_RECV_MODE,
+                 read_size=TCP_READ_SIZE, rcvbuf=TCP_RCVBUF, quickack=TCP_QUICKACK, duration=0, random_payload=False,
+                 tuning=None):
     """
     Performs a file download over TCP and records the transfer statistics.
     Args:
@@ -74,183 +760,2254 @@ def tcp_download(server_ip, tcp_port, file_size, id_connection, stats):
         tcp_port (int): The TCP port on which the server is listening.
         file_size (int): The size of the file to download.
         id_connection (int): Identifier for the current connection.
-        stats (list): A list to store statistics about the transfer.
+        stats (list): A list to store statistics about the transfer. Each entry is a dict with
+            'id', 'direction', 'total_time', 'speed', 'bytes', 'start_ns', 'end_ns', 'series'
+            (IntervalSeries) and 'report' (receive syscall counters).
+        recv_mode (str): "recv_into" reuses one preallocated buffer, "recv" allocates per call.
+        read_size (int): Bytes asked for per receive call.
+        rcvbuf (int): SO_RCVBUF to request before connecting, 0 keeps the system default.
+        quickack (bool): Re-arm TCP_QUICKACK after every receive call where supported.
+        duration (float): Stream for this many seconds instead of downloading `file_size` bytes
+            and report the steady state after STREAM_WARMUP (see `apply_steady_state`).
+        random_payload (bool): Ask for the random payload pool instead of filler and verify
+            every byte received against it.
+        tuning (dict): Socket options of this download (see `auto_tune`): 'chunk' (server send
+            call size), 'sndbuf', 'nodelay' and 'cc' (congestion control) are asked of the server,
+            'rcvbuf' overrides `rcvbuf`. Missing or 0 = defaults.
     """
+    tuning = tuning or {}
+    rcvbuf = tuning.get('rcvbuf', rcvbuf)
+    words = "".join(f" {name}={tuning[name]}" for name in TCP_TUNING_OPTIONS if tuning.get(name))
+    if random_payload:
+        payload_pool(read_size)  # Generated before the request, so the server's first bytes do not wait
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_sock:
+            if rcvbuf:  # Set before connecting so the advertised window scale matches the buffer
+                tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
             tcp_sock.connect((server_ip, tcp_port))  # Waiting until the connection is confirmed (Blocking Call)
             # sendall() - accepts data in binary format only.
             # encode()- converts the string to Bytes data
-            tcp_sock.sendall(f"{file_size}\n".encode())  # Send file size as a string
+            suffix = (f" {TCP_RANDOM_PAYLOAD}" if random_payload else "") + words  # Tuning words end the request
+            if duration:
+                tcp_sock.sendall(f"{int(duration * 1000)} stream{suffix}\n".encode())  # Stream length in milliseconds
+            elif suffix:
+                tcp_sock.sendall(f"{file_size} download{suffix}\n".encode())
+            else:
+                tcp_sock.sendall(f"{file_size}\n".encode())  # Send file size as a string
+            stats.append(receive_tcp_download(tcp_sock, file_size, id_connection, recv_mode, read_size, quickack,
+                                              duration, random_payload))
 
-            start_time = time.time()
+    except ServerBusy:
+        raise
+    except socket.error as e:
+        print(f"{Colors.FAIL}❌ TCP connection error: {e}{Colors.ENDC}")
+    except Exception as e:
+        print(f"{Colors.FAIL}❌ Error during TCP download: {e}{Colors.ENDC}")
 
-            bytes_received = 0
-            while bytes_received < file_size:
-                data = tcp_sock.recv(BUFFER_SIZE)
-                if not data:
-                    break
-                bytes_received += len(data)
 
-            total_time = time.time() - start_time  # Calculate total download time
-            speed = (bytes_received * 8) / total_time if total_time > 0 else 0  # speed =  bits/second
+def receive_tcp_download(tcp_sock, file_size, id_connection, recv_mode=TCP_RECV_MODE, read_size=TCP_READ_SIZE,
+                         quickack=TCP_QUICKACK, duration=0, random_payload=False):
+    """
+    Receives the `file_size` bytes of a TCP download on a connection whose request was sent,
+    reports the transfer and returns its statistics entry (see `tcp_download`). With a
+    `duration` the connection carries a stream instead, received until the deadline (or until
+    the throughput is stable) and then ended with a STOP message. With `random_payload` every
+    receive call is compared with the payload pool (see `payload_pool`).
+    """
+    quickack = quickack and hasattr(socket, "TCP_QUICKACK")
+    pool = payload_pool(read_size) if random_payload else None  # Ready before the transfer is timed
+    start_ns = time.perf_counter_ns()  # Monotonic, unaffected by wall-clock changes
+    series = IntervalSeries(start_ns)
+    deadline_ns = start_ns + int(duration * 1e9) if duration else None
+    limit = math.inf if duration else file_size
+    stream_end = "server"  # Why a stream ended: "deadline", "stable" or "server" (it closed the connection)
 
-            stats.append((id_connection, total_time, speed))
+    bytes_received = 0
+    syscalls = 0
+    buffer = bytearray(read_size) if recv_mode == "recv_into" else None  # Reused for every receive call
+    view = memoryview(buffer) if buffer is not None else None
+    corrupt = 0  # Receive calls whose data differs from the payload pool
+    first_corrupt = None
+    while bytes_received < limit:
+        if buffer is not None:
+            received = tcp_sock.recv_into(buffer, min(read_size, limit - bytes_received))
+            data = buffer
+        else:
+            data = tcp_sock.recv(min(read_size, limit - bytes_received))
+            received = len(data)
+        now_ns = time.perf_counter_ns()
+        sampled = now_ns >= series.next_sample_ns
+        if sampled:
+            series.sample(now_ns, bytes_received, syscalls)
+        syscalls += 1
+        if not received:
+            break
+        if not bytes_received:
+            check_reject(data, received)  # A server at capacity answers with REJECT and closes the connection
+        if pool is not None and not pool.startswith(view[:received] if view is not None else data,
+                                                    bytes_received % PAYLOAD_POOL_SIZE):
+            corrupt += 1
+            if first_corrupt is None:
+                first_corrupt = bytes_received
+        bytes_received += received
+        if quickack:
+            tcp_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+            syscalls += 1
+        if deadline_ns is not None:
+            if now_ns >= deadline_ns:
+                stream_end = "deadline"
+                break
+            if sampled and series.is_stable(STABILITY_INTERVALS, STABILITY_TOLERANCE, int(STREAM_WARMUP * 1e9)):
+                stream_end = "stable"
+                break
 
-            # Print formatted output with colors
-            print(
-                f"{Colors.OKGREEN}✔ TCP transfer #{id_connection} finished, total time: {total_time:.2f} seconds, total speed: {speed:.2f} bits/second.{Colors.ENDC}")
+    end_ns = time.perf_counter_ns()
+    if duration and stream_end != "server":
+        stop_tcp_stream(tcp_sock, buffer or bytearray(read_size))
+    series.finish(end_ns, bytes_received, syscalls)
+    total_time = (end_ns - start_ns) / 1e9  # Calculate total download time
+    speed = (bytes_received * 8) / total_time if total_time > 0 else 0  # speed =  bits/second
+    report = {
+        'syscalls': syscalls,
+        'syscalls_per_mb': syscalls / (bytes_received / 1e6) if bytes_received else 0,
+        'rcvbuf': tcp_sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),  # As granted by the kernel
+    }
+    if random_payload:
+        report.update(payload="random", corrupt=corrupt, first_corrupt_byte=first_corrupt)
 
+    stat = {'id': id_connection, 'direction': "download", 'total_time': total_time, 'speed': speed,
+            'bytes': bytes_received, 'start_ns': start_ns, 'end_ns': end_ns, 'series': series, 'report': report}
 
-    except socket.error as e:
-        print(f"{Colors.FAIL}❌ TCP connection error: {e}{Colors.ENDC}")
-    except Exception as e:
-        print(f"{Colors.FAIL}❌ Error during TCP download: {e}{Colors.ENDC}")
+    # Print formatted output with colors
+    print(
+        f"{Colors.OKGREEN}✔ TCP transfer #{id_connection} finished, total time: {total_time:.2f} seconds, total speed: {speed:.2f} bits/second.{Colors.ENDC}")
+    print(
+        f"{Colors.OKCYAN}  TCP transfer #{id_connection}: {syscalls} receive syscalls ({report['syscalls_per_mb']:.1f} per MB, "
+        f"{recv_mode}, read size {read_size}, SO_RCVBUF {report['rcvbuf']}).{Colors.ENDC}")
+    if random_payload:
+        print_payload_check("TCP", id_connection, report, "receive calls")
+    print_interval_summary("TCP", stat)
+    if duration:
+        apply_steady_state("TCP", stat, stream_end)
+    return stat
 
 
-# Function to request and receive UDP data
-def udp_download(server_ip, udp_port, file_size, id_connection, stats):
+def stop_tcp_stream(tcp_sock, buffer):
     """
-    Performs a UDP speed test by sending a request and receiving data packets from the server.
-    Records transfer statistics for later analysis.
+    Sends STOP on a TCP stream and drains (without counting) what the server had already sent,
+    until it closes the connection or STREAM_DRAIN_TIMEOUT passes.
+    """
+    try:
+        tcp_sock.sendall(MESSAGE_HEADER.pack(MAGIC_COOKIE, STOP_TYPE))
+        tcp_sock.settimeout(STREAM_DRAIN_TIMEOUT)
+        while tcp_sock.recv_into(buffer):
+            pass
+    except OSError:  # Timed out or reset, the measurement is over either way
+        pass
 
-    Args:
-        server_ip (str): The IP address of the server.
-        udp_port (int): The UDP port on which the server is listening.
-        file_size (int): The size of the file to download.
-        id_connection (int): Identifier for the current connection.
-        stats (list): A list to store statistics about the transfer.
+
+def apply_steady_state(protocol, stat, stream_end, warmup=STREAM_WARMUP):
+    """
+    Turns the statistics entry of a duration-bounded transfer into its steady-state figures:
+    the intervals of the first `warmup` seconds are left out of 'bytes', 'total_time', 'speed'
+    and 'start_ns'. The whole transfer stays available as 'total_bytes'; 'stream_end' tells
+    why it ended ("deadline", "stable" or "server").
+    """
+    stat.update(total_bytes=stat['bytes'], stream_end=stream_end, warmup=warmup)
+    steady = stat['series'].steady_state(int(warmup * 1e9))
+    if steady is None:
+        print(f"{Colors.WARNING}⚠️ {protocol} transfer #{stat['id']} ended within its {warmup:.1f} s warm-up, "
+              f"reporting the whole transfer.{Colors.ENDC}")
+        return stat
+    offset_ns, steady_bytes, steady_ns = steady
+    stat.update(start_ns=stat['series'].start_ns + offset_ns, bytes=steady_bytes, total_time=steady_ns / 1e9,
+                speed=steady_bytes * 8e9 / steady_ns if steady_ns > 0 else 0)
+    print(f"{Colors.OKCYAN}  {protocol} transfer #{stat['id']}: steady state after a {warmup:.1f} s warm-up: "
+          f"{stat['speed']:.2f} bits/second over {stat['total_time']:.2f} seconds (ended by {stream_end}).{Colors.ENDC}")
+    return stat
+
+
+# Perform TCP upload
+def unacknowledged_bytes(tcp_sock):
+    """
+    Returns:
+        int: Bytes sent on `tcp_sock` that the peer has not acknowledged yet (SIOCOUTQ), 0 where
+        the kernel cannot tell.
     """
+    if fcntl is None:
+        return 0
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_sock:
-            # Create and send the request packet to the server
-            request_packet = struct.pack('!IBQ', MAGIC_COOKIE, REQUEST_TYPE, file_size)
-            udp_sock.sendto(request_packet, (server_ip, udp_port))
+        return struct.unpack('i', fcntl.ioctl(tcp_sock.fileno(), SIOCOUTQ, b'\0\0\0\0'))[0]
+    except OSError:
+        return 0
 
-            start_time = time.time()
-            received_packets = 0
-            total_packets = (file_size + BUFFER_SIZE - 1) // BUFFER_SIZE
-            udp_sock.settimeout(1)
 
-            while True:
-                flag = False
-                try:
-                    # Receive data from the server (up to BUFFER_SIZE * 2 bytes at a time)
-                    data, _ = udp_sock.recvfrom(BUFFER_SIZE * 2)
+def send_tcp_upload(tcp_sock, file_size, chunk_size=TCP_READ_SIZE):
+    """
+    Sends `file_size` bytes of filler from one preallocated buffer, then closes the sending
+    side so the server sees the end of the upload and waits (up to UPLOAD_ACK_TIMEOUT) until
+    the server acknowledged every byte. Bytes still in the send queue have not reached the
+    server, so the series counts the acknowledged bytes and the upload ends with the last one.
 
-                    payload_struct_format = '!IBQQ'
-                    payload_protocol_length = struct.calcsize(payload_struct_format)
-                    # Process the packet
-                    if len(data) >= payload_protocol_length:
-                        magic_cookie, msg_type, total_segments, current_segment = struct.unpack(payload_struct_format,
-                                                                                                data[
-                                                                                                :payload_protocol_length])
-                        if magic_cookie == MAGIC_COOKIE and msg_type == PAYLOAD_TYPE:
-                            received_packets += 1  # Increment received packet count
-
-                            # If all packets have been received, break out of the loop
-                            if received_packets == total_segments:
-                                break
-                    else:
-                        # Log a warning for short packets
-                        print(
-                            f"{Colors.WARNING}⚠️ Received a short packet (length: {len(data)} bytes), skipping...{Colors.ENDC}")
+    Returns:
+        tuple: Bytes sent, start and end time in perf_counter nanoseconds and the IntervalSeries
+        of the acknowledged bytes.
+    """
+    chunk = memoryview(b'B' * chunk_size)
+    start_ns = time.perf_counter_ns()
+    series = IntervalSeries(start_ns)
+    bytes_sent = 0
+    calls = 0
+    while bytes_sent < file_size:
+        now_ns = time.perf_counter_ns()
+        if now_ns >= series.next_sample_ns:
+            series.sample(now_ns, max(0, bytes_sent - unacknowledged_bytes(tcp_sock)), calls)
+        bytes_sent += tcp_sock.send(chunk[:min(chunk_size, file_size - bytes_sent)])
+        calls += 1
+    tcp_sock.shutdown(socket.SHUT_WR)
+    deadline = time.perf_counter() + UPLOAD_ACK_TIMEOUT
+    while time.perf_counter() < deadline:
+        now_ns = time.perf_counter_ns()
+        unacknowledged = unacknowledged_bytes(tcp_sock)
+        if unacknowledged <= 0:
+            break
+        if now_ns >= series.next_sample_ns:
+            series.sample(now_ns, max(0, bytes_sent - unacknowledged), calls)
+        time.sleep(UPLOAD_ACK_POLL)
+    end_ns = time.perf_counter_ns()
+    series.finish(end_ns, bytes_sent, calls)
+    return bytes_sent, start_ns, end_ns, series
 
-                except socket.timeout:
-                    # Stop the download if no packet is received within 1 second
-                    flag = True
-                    print(f"{Colors.WARNING}⚠️ No packet received for 1 second, stopping UDP download...{Colors.ENDC}\n")
-                    break
 
-            # Calculate total download time and success rate
-            total_time = time.time() - start_time
-            speed = (received_packets * 8) / total_time if total_time > 0 else 0  # speed =  bits/second
-            success_rate = (received_packets / total_packets) * 100 if total_packets > 0 else 0
+def receive_exactly(tcp_sock, nbytes):
+    """
+    Receives exactly `nbytes` bytes.
 
-            # Save the statistics for this connection
-            stats.append((id_connection, total_time, speed, success_rate))
-            if flag:
-                total_time -= 1
-            # Print a summary of the UDP transfer
-            print(
-                f"{Colors.OKGREEN}✔ UDP transfer #{id_connection} finished, total time: {total_time:.2f} seconds, total speed: {speed:.2f} bits/second, percentage of packets received successfully: {success_rate:.2f}%.{Colors.ENDC}")
+    Raises:
+        ServerBusy: If the server rejected the connection with REJECT instead.
+        ConnectionError: If the server closes the connection first.
+    """
+    data = bytearray()
+    while len(data) < nbytes:
+        try:
+            chunk = tcp_sock.recv(nbytes - len(data))
+        except ConnectionResetError:  # A rejecting server resets the connection after its REJECT
+            chunk = b""
+        if not chunk:
+            check_reject(data)
+            raise ConnectionError("connection closed before the result arrived")
+        data += chunk
+    return data
 
-            # print(
-            #     f"{Colors.OKGREEN}✔ UDP transfer #{id_connection} complete: {received_packets}/{total_packets} packets received ({success_rate:.2f}% success rate) in {total_time:.2f} seconds.{Colors.ENDC}")
 
-    except Exception as e:
-        print(f"{Colors.FAIL}❌ Error during UDP download: {e}{Colors.ENDC}")
+def receive_reject(tcp_sock):
+    """
+    Called when sending on a TCP connection failed: raises ServerBusy if the server had
+    answered the connection with REJECT.
+    """
+    try:
+        data = tcp_sock.recv(REJECT.size)
+    except OSError:
+        return
+    check_reject(data)
 
 
-# Function to initiate the speed test
-def initiate_speed_test(server_ip, tcp_port, udp_port, file_size, tcp_threads, udp_threads):
+def upload_stat(id_connection, result, start_ns, end_ns, series, bytes_sent, total_segments=None):
+    """
+    Builds the statistics entry of an upload from the server's RESULT_FRAME. Speed and time are
+    the server's view (first to last byte received), so they measure the uplink itself. The
+    window runs from the first byte sent to the last one sent (UDP) or acknowledged (TCP), not to
+    the arrival of the result, and the series is scaled to the bytes the server received, so
+    both count the same bytes as 'bytes' (a UDP upload's losses are taken as evenly spread).
+
+    Args:
+        id_connection (int): Identifier for the connection.
+        result (tuple): The unpacked RESULT_FRAME.
+        start_ns (int): When the client started sending.
+        end_ns (int): When the last byte was sent (UDP) or acknowledged (TCP).
+        series (IntervalSeries): Sending (UDP) or acknowledged (TCP) progress of the client.
+        bytes_sent (int): Payload bytes the client sent.
+        total_segments (int): Segments of a UDP upload, adds 'success_rate'.
+
+    Returns:
+        dict: Statistics entry with 'direction' "upload".
+    """
+    _, _, bytes_received, segments, elapsed_ns = result
+    total_time = elapsed_ns / 1e9
+    stat = {'id': id_connection, 'direction': "upload", 'total_time': total_time,
+            'speed': bytes_received * 8 / total_time if total_time > 0 else 0, 'bytes': bytes_received,
+            'start_ns': start_ns, 'end_ns': end_ns, 'series': series.scaled(bytes_received),
+            'report': {'bytes_sent': bytes_sent, 'server_segments': segments}}
+    if total_segments is not None:
+        stat['success_rate'] = segments / total_segments * 100 if total_segments else 0
+    return stat
+
+
+@retry_when_busy
+def tcp_upload(server_ip, tcp_port, file_size, id_connection, stats, bidir=False, recv_mode=TCP_RECV_MODE,
+               read_size=TCP_READ_SIZE, rcvbuf=TCP_RCVBUF, quickack=TCP_QUICKACK):
     """
-    Initiates both TCP and UDP download tests.
-    Creates separate threads for each test and records their statistics.
+    Uploads `file_size` bytes over TCP (and for `bidir` downloads as many at the same time), then
+    reads the server's RESULT_FRAME, which follows the download payload.
 
     Args:
         server_ip (str): The IP address of the server.
-        tcp_port (int): The TCP port for the download.
-        udp_port (int): The UDP port for the download.
-        file_size (int): The size of the file to be downloaded.
-        tcp_threads (int): Number of threads for TCP download.
-        udp_threads (int): Number of threads for UDP download.
+        tcp_port (int): The TCP port on which the server is listening.
+        file_size (int): Bytes in each direction.
+        id_connection (int): Identifier for the current connection.
+        stats (list): Receives the upload entry (see `upload_stat`) and, for `bidir`, the download
+            entry (see `tcp_download`).
+        bidir (bool): Download while uploading.
+        recv_mode, read_size, rcvbuf, quickack: Download receive settings, see `tcp_download`.
     """
-    tcp_stats = []  # List to store statistics for TCP transfers
-    udp_stats = []  # List to store statistics for UDP transfers
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_sock:
+            if rcvbuf:
+                tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+            tcp_sock.connect((server_ip, tcp_port))
+            tcp_sock.sendall(f"{file_size} {'bidir' if bidir else 'upload'}\n".encode())
 
-    # Create and start TCP threads
-    tcp_threads_list = [
-        threading.Thread(target=tcp_download, args=(server_ip, tcp_port, file_size, i + 1, tcp_stats))
-        for i in range(tcp_threads)
-    ]
+            if bidir:
+                upload = []
 
-    # Create and start UDP threads
-    udp_threads_list = [
-        threading.Thread(target=udp_download, args=(server_ip, udp_port, file_size, i + 1, udp_stats))
-        for i in range(udp_threads)
-    ]
+                def send():
+                    try:
+                        upload.append(send_tcp_upload(tcp_sock, file_size, read_size))
+                    except OSError:  # Rejected or dropped by the server, the download side reports it
+                        pass
 
-    # Start all TCP and UDP threads
-    for thread in tcp_threads_list + udp_threads_list:
-        thread.start()
+                sender = threading.Thread(target=send, daemon=True)
+                sender.start()
+                download = receive_tcp_download(tcp_sock, file_size, id_connection, recv_mode, read_size, quickack)
+                sender.join()
+                if not upload:
+                    raise ConnectionError("upload failed")
+                bytes_sent, start_ns, end_ns, series = upload[0]
+            else:
+                download = None
+                try:
+                    bytes_sent, start_ns, end_ns, series = send_tcp_upload(tcp_sock, file_size, read_size)
+                except OSError:
+                    receive_reject(tcp_sock)
+                    raise
 
-    # Wait for all threads to complete
-    for thread in tcp_threads_list + udp_threads_list:
-        thread.join()
+            result = RESULT_FRAME.unpack(receive_exactly(tcp_sock, RESULT_FRAME.size))
+            if result[0] != MAGIC_COOKIE or result[1] != RESULT_TYPE:
+                raise ValueError("invalid result frame")
+            stat = upload_stat(id_connection, result, start_ns, end_ns, series, bytes_sent)
+            if download is not None:
+                stats.append(download)
+            stats.append(stat)
+            print(
+                f"{Colors.OKGREEN}✔ TCP upload #{id_connection} finished, total time: {stat['total_time']:.2f} seconds, "
+                f"total speed: {stat['speed']:.2f} bits/second (measured by the server, {stat['bytes']}/{bytes_sent} bytes "
+                f"received).{Colors.ENDC}")
+            print_interval_summary("TCP upload", stat)
 
-    # Print final summary
-    print(f"{Colors.OKBLUE}All transfers completed, listening to offer requests{Colors.ENDC}")
-    # print(f"{Colors.OKCYAN}Summary:{Colors.ENDC}")
-    #
-    # for conn_id, duration, speed in tcp_stats:
-    #     print(f"{Colors.BOLD}TCP transfer #{conn_id} finished, total time: {duration:.2f} seconds, total speed: {speed:.2f} bits/second.{Colors.ENDC}")
-    # print("")
-    # for conn_id, duration, speed, success_rate in udp_stats:
-    #     print(f"{Colors.BOLD}UDP transfer #{conn_id} finished, total time: {duration:.2f} seconds, total speed: {speed:.2f} bits/second, percentage of packets received successfully: {success_rate:.2f}%.{Colors.ENDC}")
+    except ServerBusy:
+        raise
+    except socket.error as e:
+        print(f"{Colors.FAIL}❌ TCP connection error: {e}{Colors.ENDC}")
+    except Exception as e:
+        print(f"{Colors.FAIL}❌ Error during TCP upload: {e}{Colors.ENDC}")
 
 
-def main():
+def tcp_transfer(server_ip, tcp_port, file_size, id_connection, stats, mode=TEST_MODE, duration=0,
+                 random_payload=False, tuning=None):
     """
-    Main function that starts the client, receives server offers,
-    and initiates the speed test based on user input.
+    Runs one TCP connection of a test in `mode` ("download", "upload" or "bidir"). Downloads
+    stream for `duration` seconds instead of transferring `file_size` bytes when it is set,
+    carry the verified random payload when `random_payload` is and use the socket options in
+    the `tuning` map (see `connection_tuning`).
     """
-    print(f"{Colors.HEADER}Welcome to the Speed Test Client!{Colors.ENDC}")
+    if mode == "download":
+        tcp_download(server_ip, tcp_port, file_size, id_connection, stats, duration=duration,
+                     random_payload=random_payload, tuning=connection_tuning(tuning, server_ip, "tcp"))
+    else:
+        tcp_upload(server_ip, tcp_port, file_size, id_connection, stats, bidir=mode == "bidir")
 
-    # Get valid inputs for file size, number of UDP threads, and TCP threads
-    file_size = get_valid_input("Enter file size for download (in bytes): ")
-    tcp_threads = get_valid_input("Enter the number of TCP connections: ")
-    udp_threads = get_valid_input("Enter the number of UDP connections: ")
 
-    # Receive the server offer
-    server_ip, udp_port, tcp_port = listen_for_offers()
+# Per-segment accounting for UDP downloads
+MISSING_BYTES = re.compile(rb'\x00+|[^\xff]')  # A run of bitmap bytes with no segment received, or one byte with some
+# Runs of clear bits of every byte value, as half-open (first bit, last bit + 1) ranges
+BYTE_GAPS = [tuple((match.start(), match.end()) for match in re.finditer('0+', format(byte, '08b')[::-1]))
+             for byte in range(256)]
 
-    if server_ip is None or tcp_port is None:
-        print(f"{Colors.WARNING}⚠️ No server found. Exiting...{Colors.ENDC}")
-        return
 
-    print(f"{Colors.OKBLUE}Starting speed test with file size: {file_size} bytes.{Colors.ENDC}")
-    initiate_speed_test(server_ip, tcp_port, udp_port, file_size, tcp_threads, udp_threads)
+class ReceiveTracker:
+    """
+    Tracks which segments of a UDP transfer arrived, using one bit per segment.
+
+    Every packet costs O(1): a bit test-and-set plus a few counter updates. It classifies packets
+    as unique, duplicate or out of order (older than the highest segment seen so far), counts
+    goodput in payload bytes and keeps an RFC 3550 style interarrival jitter estimate. Losses and
+    loss bursts are derived from the bitmap once the transfer is over. For a `stream` the total is
+    unknown: the bitmap grows (doubling) with the segment numbers, and the report treats every
+    segment up to the highest one received as sent.
+    """
+
+    def __init__(self, total_segments, stream=False):
+        self.stream = stream
+        self.total_segments = total_segments
+        self.seen = bytearray((total_segments + 7) // 8)
+        if total_segments % 8:
+            self.seen[-1] = 0xFF << (total_segments % 8) & 0xFF  # Padding bits past the last segment count as seen
+        self.unique = 0
+        self.duplicates = 0
+        self.out_of_order = 0
+        self.goodput_bytes = 0
+        self.highest = -1
+        self.jitter_ns = 0.0
+        self.last_arrival_ns = None
+        self.last_transit_ns = None
+        self.timestamped = 0  # Segments that carried a send timestamp
+        self.min_transit_ns = None
+        self.max_transit_ns = None
+        self.transit_sum_ns = 0
+
+    def record(self, segment, payload_bytes, arrival_ns, send_ns=None):
+        """
+        Accounts for one received segment.
+
+        Args:
+            segment (int): The segment number from the payload header.
+            payload_bytes (int): Payload bytes carried by the datagram (header excluded).
+            arrival_ns (int): Arrival time from `time.perf_counter_ns`.
+            send_ns (int): Sender timestamp if the packet carries one. Without it the jitter is
+                based on the change between consecutive interarrival gaps.
+
+        Returns:
+            bool: True if the segment had not been received before.
+        """
+        if segment >= self.total_segments:
+            if not self.stream:
+                return False
+            self.total_segments = max(segment + 1, 2 * self.total_segments, 1024) + 7 & ~7  # Whole bytes, no padding
+            self.seen.extend(bytes(self.total_segments // 8 - len(self.seen)))
+        index = segment >> 3
+        mask = 1 << (segment & 7)
+        if self.seen[index] & mask:
+            self.duplicates += 1
+            return False
+        self.seen[index] |= mask
+        self.unique += 1
+        self.goodput_bytes += payload_bytes
+        if segment < self.highest:
+            self.out_of_order += 1
+        else:
+            self.highest = segment
+
+        # RFC 3550: D is the change in transit time between consecutive packets, J += (|D| - J) / 16
+        if send_ns is not None:
+            transit = arrival_ns - send_ns  # One-way delay plus the (constant) offset between the two clocks
+            self.timestamped += 1
+            self.transit_sum_ns += transit
+            if self.min_transit_ns is None or transit < self.min_transit_ns:
+                self.min_transit_ns = transit
+            if self.max_transit_ns is None or transit > self.max_transit_ns:
+                self.max_transit_ns = transit
+        elif self.last_arrival_ns is not None:
+            transit = arrival_ns - self.last_arrival_ns  # Interarrival gap
+        else:
+            transit = None
+        if transit is not None and self.last_transit_ns is not None:
+            self.jitter_ns += (abs(transit - self.last_transit_ns) - self.jitter_ns) / 16
+        self.last_transit_ns = transit
+        self.last_arrival_ns = arrival_ns
+        return True
+
+    @property
+    def complete(self):
+        return not self.stream and self.unique == self.total_segments
+
+    def accepts_total(self, total_segments, limit):
+        """
+        Checks the total segments a download datagram announces against this transfer. Until the
+        first segment is recorded the server may split the file differently than the client
+        assumed (into at most `limit` segments), which resizes the bitmap; after that, or beyond
+        `limit`, a different total marks a stray datagram.
+
+        Returns:
+            bool: True if the datagram belongs to this transfer.
+        """
+        if self.stream or total_segments == self.total_segments:
+            return True
+        if self.unique or total_segments > limit:
+            return False
+        self.total_segments = total_segments
+        self.seen = bytearray((total_segments + 7) // 8)
+        if total_segments % 8:
+            self.seen[-1] = 0xFF << (total_segments % 8) & 0xFF
+        return True
+
+    def end_stream(self):
+        """
+        Fixes the total of a stream at the highest segment received, so losses after the last
+        received segment (indistinguishable from segments never sent) are not counted.
+        """
+        if not self.stream:
+            return
+        self.stream = False
+        self.total_segments = self.highest + 1
+        del self.seen[(self.total_segments + 7) // 8:]
+        if self.total_segments % 8:
+            self.seen[-1] |= 0xFF << (self.total_segments % 8) & 0xFF
+
+    def missing_ranges(self, start=0, end=None, limit=None):
+        """
+        Lists the segments that never arrived as half-open (start, end) ranges.
+        Whole bytes of received segments are skipped by the regex engine and runs of bytes with
+        nothing received are taken at once, so the scan stays fast for millions of segments.
+
+        Args:
+            start (int): First segment to look at.
+            end (int): Segment to stop before, defaults to the total.
+            limit (int): Return at most this many ranges, None = all of them.
+
+        Returns:
+            list: (first_missing, last_missing + 1) tuples in ascending order.
+        """
+        end = self.total_segments if end is None else min(end, self.total_segments)
+        limit = len(self.seen) * 8 if limit is None else limit
+        ranges = []
+        run_first = run_last = -1  # The range being extended, not yet in `ranges`
+        seen = self.seen
+        for match in MISSING_BYTES.finditer(seen, start >> 3, end + 7 >> 3):
+            base = match.start() * 8
+            byte = seen[match.start()]
+            for first, last in BYTE_GAPS[byte] if byte else ((0, match.end() * 8 - base),):
+                first += base
+                last += base
+                if first < start:
+                    first = start
+                if last > end:
+                    last = end
+                if first >= last:
+                    continue
+                if first == run_last:
+                    run_last = last
+                    continue
+                if run_last >= 0:
+                    if len(ranges) == limit:
+                        return ranges
+                    ranges.append((run_first, run_last))
+                run_first, run_last = first, last
+        if run_last >= 0 and len(ranges) < limit:
+            ranges.append((run_first, run_last))
+        return ranges
+
+    def report(self):
+        """
+        Summarizes the transfer.
+
+        Returns:
+            dict: Segment counters, loss bursts, goodput in bytes and jitter in milliseconds. Timestamped
+            transfers also report the mean and maximum one-way delay above the lowest one seen.
+        """
+        self.end_stream()
+        bursts = self.missing_ranges()
+        report = {
+            'total_segments': self.total_segments,
+            'unique': self.unique,
+            'duplicates': self.duplicates,
+            'out_of_order': self.out_of_order,
+            'lost': self.total_segments - self.unique,
+            'loss_bursts': len(bursts),
+            'max_loss_burst': max((end - start for start, end in bursts), default=0),
+            'goodput_bytes': self.goodput_bytes,
+            'jitter_ms': self.jitter_ns / 1e6,
+        }
+        if self.timestamped:
+            report['delay_variation_mean_ms'] = (self.transit_sum_ns / self.timestamped - self.min_transit_ns) / 1e6
+            report['delay_variation_max_ms'] = (self.max_transit_ns - self.min_transit_ns) / 1e6
+        return report
+
+
+def send_nacks(udp_sock, address, ranges):
+    """
+    Asks the server to resend the segments in `ranges`, NACK_MAX_RANGES (first, count)
+    ranges per NACK datagram.
+
+    Args:
+        udp_sock (socket.socket): The download's socket.
+        address (tuple): Where the download comes from.
+        ranges (list): Half-open (start, end) segment ranges, see `ReceiveTracker.missing_ranges`.
+
+    Returns:
+        int: NACK datagrams sent.
+    """
+    messages = 0
+    for offset in range(0, len(ranges), NACK_MAX_RANGES):
+        batch = ranges[offset:offset + NACK_MAX_RANGES]
+        message = bytearray(NACK_HEADER.pack(MAGIC_COOKIE, NACK_TYPE, len(batch)))
+        for start, end in batch:
+            message += NACK_RANGE.pack(start, end - start)
+        udp_sock.sendto(message, address)
+        messages += 1
+    return messages
+
+
+class NackScheduler:
+    """
+    Decides which holes a reliable UDP download asks the server to resend, and when (selective
+    repeat). A hole is asked for once it is NACK_INTERVAL old, i.e. below the highest segment
+    received one interval earlier, or once the server went quiet. It is asked for again only
+    after the repairs have been quiet for NACK_REPEAT_RTTS repair round trips since, as until
+    then its repair may still be queued at the server or on its way. The repair round trip is
+    the time from a NACK to the first repaired segment after it, smoothed like TCP's SRTT.
+    """
+
+    def __init__(self, start_ns):
+        self.asked_until = 0  # Holes below it were asked for at least once
+        self.mark = 0  # Where `asked_until` moves on the next NACK: holes below it are one interval old
+        self.next_ns = start_ns + int(NACK_INTERVAL * 1e9)
+        self.rounds = collections.deque()  # (time, `asked_until` after it) of the first NACKs not yet settled
+        self.settled = 0  # Holes below it were last asked for at least one repair wait ago
+        self.repeat_ns = 0  # When the holes below `settled` were last asked for again
+        self.repair_ns = 0  # Arrival of the last repaired segment
+        self.rtt_ns = None  # Smoothed repair round trip, None until the first repair arrived
+        self.probe_ns = None  # The NACK whose first repair is the next round trip sample
+        self.messages = 0  # NACK datagrams sent
+        self.segments = 0  # Segments asked for, counted every time they are asked for
+
+    @property
+    def wait_ns(self):
+        """Nanoseconds a hole that was asked for is given before it is asked for again."""
+        if self.rtt_ns is None:
+            return int(NACK_REPEAT_RTTS * NACK_INTERVAL * 1e9)
+        return max(int(NACK_INTERVAL * 1e9), NACK_REPEAT_RTTS * self.rtt_ns)
+
+    def arrived(self, segment, arrival_ns):
+        """
+        Notes a segment received for the first time; one that was asked for is a repair.
+        """
+        if segment >= self.asked_until:
+            return
+        self.repair_ns = arrival_ns
+        if self.probe_ns is not None:
+            sample = arrival_ns - self.probe_ns
+            self.rtt_ns = sample if self.rtt_ns is None else self.rtt_ns + (sample - self.rtt_ns) // 8
+            self.probe_ns = None
+
+    def due(self, tracker, now_ns, quiet=False):
+        """
+        Lists the holes of `tracker` to ask for now.
+
+        Args:
+            tracker (ReceiveTracker): The download's segments.
+            now_ns (int): The current `time.perf_counter_ns` value.
+            quiet (bool): The server sent nothing for NACK_INTERVAL, so the holes after the
+                highest segment received are lost too.
+
+        Returns:
+            list: Half-open (start, end) segment ranges, the older holes first.
+        """
+        ranges = []
+        if quiet or now_ns >= self.next_ns:
+            if quiet:
+                self.mark = tracker.total_segments
+            if self.mark > self.asked_until:
+                ranges = tracker.missing_ranges(self.asked_until, self.mark)
+                self.asked_until = self.mark
+                self.rounds.append((now_ns, self.asked_until))
+            self.mark = max(self.mark, tracker.highest + 1)
+            self.next_ns = now_ns + int(NACK_INTERVAL * 1e9)
+        wait_ns = self.wait_ns
+        while self.rounds and now_ns - self.rounds[0][0] >= wait_ns:
+            self.settled = self.rounds.popleft()[1]
+        if self.settled and now_ns - max(self.repeat_ns, self.repair_ns) >= wait_ns:
+            ranges = tracker.missing_ranges(0, self.settled, NACK_ROUND_RANGES) + ranges
+            self.repeat_ns = now_ns
+        return ranges
+
+    def send(self, udp_sock, address, ranges, now_ns):
+        """
+        Sends the NACKs for `ranges` (see `send_nacks`) and starts a round trip sample.
+        """
+        if not ranges:
+            return
+        self.messages += send_nacks(udp_sock, address, ranges)
+        self.segments += sum(end - start for start, end in ranges)
+        if self.probe_ns is None:
+            self.probe_ns = now_ns
+
+
+# Function to request and receive UDP data
+@retry_when_busy
+def udp_download(server_ip, udp_port, file_size, id_connection, stats, rate_bps=UDP_TARGET_RATE,
+                 timestamps=UDP_TIMESTAMPS, duration=0, reliable=False, random_payload=False, tuning=None):
+    """
+    Performs a UDP speed test by sending a request and receiving data packets from the server.
+    Records transfer statistics for later analysis.
+
+    Packets are received into one preallocated buffer and accounted for by a `ReceiveTracker`,
+    so the reported speed is the goodput in real payload bits per second.
+
+    A `reliable` download repairs its losses through NACKs scheduled by a `NackScheduler`. Once it
+    has every segment it sends FIN and reports the time to completion, comparable with a TCP
+    download of the same size. One that gives up after NACK_GIVE_UP seconds without a new
+    segment (the server ran out of repair budget or went away) fails: it reports no statistics.
+
+    Args:
+        server_ip (str): The IP address of the server.
+        udp_port (int): The UDP port on which the server is listening.
+        file_size (int): The size of the file to download.
+        id_connection (int): Identifier for the current connection.
+        stats (list): A list to store statistics about the transfer. Each entry is a dict with
+            'id', 'total_time', 'speed', 'success_rate', 'bytes', 'start_ns', 'end_ns',
+            'series' (IntervalSeries of unique segments) and 'report' (ReceiveTracker report).
+        rate_bps (int): Bits/second the server should pace the transfer to, 0 = as fast as possible.
+        timestamps (bool): Ask the server to stamp every segment with its send time, for the
+            one-way delay variation in the report.
+        duration (float): Stream for this many seconds instead of downloading `file_size` bytes
+            and report the steady state after STREAM_WARMUP (see `apply_steady_state`).
+        reliable (bool): Have the server resend lost segments until every one arrived. Does not
+            apply to streams.
+        random_payload (bool): Ask for segments filled from the random payload pool and compare
+            each one with the pool; a corrupted segment is counted and treated as lost.
+        tuning (dict): Socket options of this download (see `auto_tune`): 'segment_size' (payload
+            bytes per datagram) and 'sndbuf' are asked of the server, 'rcvbuf' is the SO_RCVBUF
+            of the receiving socket. Missing or 0 = defaults.
+    """
+    reliable = reliable and not duration
+    tuning = tuning or {}
+    segment_size = min(tuning.get('segment_size') or BUFFER_SIZE, UDP_MAX_SEGMENT)
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_sock:
+            if tuning.get('rcvbuf'):
+                udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, tuning['rcvbuf'])
+            # Create and send the request packet to the server
+            request_packet = struct.pack('!IBQ', MAGIC_COOKIE, REQUEST_TYPE, 0 if duration else file_size)
+            flags = ((REQUEST_FLAG_TIMESTAMPS if timestamps else 0) | (REQUEST_FLAG_RELIABLE if reliable else 0)
+                     | (REQUEST_FLAG_RANDOM if random_payload else 0))
+            tuned = segment_size != BUFFER_SIZE or tuning.get('sndbuf')
+            if rate_bps or flags or duration or tuned:
+                request_packet += struct.pack('!Q', rate_bps)  # Optional target rate field
+            if flags or duration or tuned:
+                request_packet += struct.pack('!B', flags)  # Optional flags field
+            if duration or tuned:
+                request_packet += struct.pack('!I', int(duration * 1000))  # Optional stream length in milliseconds
+            if tuned:
+                request_packet += struct.pack('!HI', segment_size, tuning.get('sndbuf', 0))  # Optional socket tuning
+            pool = payload_pool(segment_size) if random_payload else None  # Ready before the transfer is timed
+            udp_sock.sendto(request_packet, (server_ip, udp_port))
+
+            start_ns = time.perf_counter_ns()
+            last_arrival_ns = start_ns
+            series = IntervalSeries(start_ns)
+            if duration:
+                tracker = ReceiveTracker(0, stream=True)
+            else:
+                tracker = ReceiveTracker((file_size + segment_size - 1) // segment_size)
+            smallest_segment = min(segment_size, BUFFER_SIZE)  # Servers without the segment size option use BUFFER_SIZE
+            max_segments = (file_size + smallest_segment - 1) // smallest_segment
+            deadline_ns = start_ns + int(duration * 1e9) if duration else None
+            stream_end = "server"  # Why a stream ended, see `receive_tcp_download`
+            source_address = None  # Where the stream comes from, STOP and NACKs go there
+            buffer = bytearray(segment_size + BUFFER_SIZE)  # Reused for every datagram
+            view = memoryview(buffer)
+            corrupt = 0  # Segments whose payload differs from the payload pool
+            first_corrupt = None
+            header_size = PAYLOAD_HEADER.size
+            udp_sock.settimeout(NACK_INTERVAL if reliable else UDP_IDLE_TIMEOUT)
+            nacks = NackScheduler(start_ns) if reliable else None
+            progress_ns = start_ns  # Last time a new segment arrived
+
+            while not tracker.complete:
+                try:
+                    if duration or reliable:
+                        length, source_address = udp_sock.recvfrom_into(buffer)
+                    else:
+                        length = udp_sock.recv_into(buffer)
+                    arrival_ns = time.perf_counter_ns()
+                    sampled = arrival_ns >= series.next_sample_ns
+                    if sampled:
+                        series.sample(arrival_ns, tracker.goodput_bytes, tracker.unique)
+
+                    # Process the packet
+                    if length >= header_size:
+                        magic_cookie, msg_type, total_segments, current_segment = PAYLOAD_HEADER.unpack_from(buffer)
+                        payload_start = PAYLOAD_TS_HEADER.size if msg_type == PAYLOAD_TS_TYPE else header_size
+                        if (pool is not None and magic_cookie == MAGIC_COOKIE
+                                and msg_type in (PAYLOAD_TYPE, PAYLOAD_TS_TYPE)
+                                and not pool.startswith(view[payload_start:length],
+                                                        current_segment * segment_size % PAYLOAD_POOL_SIZE)):
+                            # A damaged segment is not recorded, so it counts as lost (and gets repaired)
+                            corrupt += 1
+                            if first_corrupt is None:
+                                first_corrupt = current_segment * segment_size
+                        elif (magic_cookie == MAGIC_COOKIE and msg_type == PAYLOAD_TYPE
+                              and tracker.accepts_total(total_segments, max_segments)):
+                            if tracker.record(current_segment, length - header_size, arrival_ns):
+                                progress_ns = arrival_ns
+                                if nacks is not None:
+                                    nacks.arrived(current_segment, arrival_ns)
+                            last_arrival_ns = arrival_ns
+                        elif (magic_cookie == MAGIC_COOKIE and msg_type == PAYLOAD_TS_TYPE
+                              and length >= PAYLOAD_TS_HEADER.size
+                              and tracker.accepts_total(total_segments, max_segments)):
+                            _, _, _, _, send_ns = PAYLOAD_TS_HEADER.unpack_from(buffer)
+                            if tracker.record(current_segment, length - PAYLOAD_TS_HEADER.size, arrival_ns, send_ns):
+                                progress_ns = arrival_ns
+                                if nacks is not None:
+                                    nacks.arrived(current_segment, arrival_ns)
+                            last_arrival_ns = arrival_ns
+                    else:
+                        check_reject(buffer, length)  # A server at capacity answers the request with REJECT
+                        # Log a warning for short packets
+                        print(
+                            f"{Colors.WARNING}⚠️ Received a short packet (length: {length} bytes), skipping...{Colors.ENDC}")
+                    if deadline_ns is not None:
+                        if arrival_ns >= deadline_ns:
+                            stream_end = "deadline"
+                            break
+                        if sampled and series.is_stable(STABILITY_INTERVALS, STABILITY_TOLERANCE,
+                                                        int(STREAM_WARMUP * 1e9)):
+                            stream_end = "stable"
+                            break
+                    if nacks is not None and source_address is not None:
+                        nacks.send(udp_sock, source_address, nacks.due(tracker, arrival_ns), arrival_ns)
+
+                except socket.timeout:
+                    now_ns = time.perf_counter_ns()
+                    if reliable and now_ns - progress_ns < NACK_GIVE_UP * 1e9:
+                        if source_address is not None:
+                            # The server is done sending: the tail is missing too
+                            nacks.send(udp_sock, source_address, nacks.due(tracker, now_ns, quiet=True), now_ns)
+                        continue
+                    # Stop the download if no packet is received within UDP_IDLE_TIMEOUT seconds
+                    silence = NACK_GIVE_UP if reliable else UDP_IDLE_TIMEOUT
+                    print(f"{Colors.WARNING}⚠️ No new packet received for {silence} second, stopping UDP download...{Colors.ENDC}\n")
+                    break
+
+            if duration and stream_end != "server" and source_address is not None:
+                stop_message = MESSAGE_HEADER.pack(MAGIC_COOKIE, STOP_TYPE)
+                for _ in range(UDP_FIN_RETRIES):  # Repeated, losing one STOP only makes the server run to its deadline
+                    udp_sock.sendto(stop_message, source_address)
+            if reliable and tracker.complete:
+                fin_message = MESSAGE_HEADER.pack(MAGIC_COOKIE, FIN_TYPE)
+                for _ in range(UDP_FIN_RETRIES):  # Repeated, without it the server lingers for NACKs a while
+                    udp_sock.sendto(fin_message, source_address)
+            if not tracker.unique:
+                # Nothing arrived (no server, or it dropped the request): no statistics to pass for a transfer
+                print(f"{Colors.FAIL}❌ UDP transfer #{id_connection} failed: no segment arrived.{Colors.ENDC}")
+                return
+            stat = udp_download_stat(id_connection, tracker, series, start_ns, last_arrival_ns)
+            if duration:
+                apply_steady_state("UDP", stat, stream_end)
+            if random_payload:
+                stat['report'].update(payload="random", corrupt=corrupt, first_corrupt_byte=first_corrupt)
+                print_payload_check("UDP", id_connection, stat['report'], "segments")
+            if reliable:
+                stat['report'].update(reliable=True, nack_messages=nacks.messages, nacked_segments=nacks.segments)
+                if not tracker.complete:
+                    # Partial statistics would pass for a repaired download, so the connection counts as failed
+                    print(f"{Colors.FAIL}❌ Reliable UDP transfer #{id_connection} failed: {stat['report']['lost']} of "
+                          f"{tracker.total_segments} segments still missing after {nacks.segments} asked for again "
+                          f"in {nacks.messages} NACKs.{Colors.ENDC}")
+                    return
+                print(f"{Colors.OKCYAN}  UDP transfer #{id_connection}: reliable, {nacks.segments} segments asked for "
+                      f"again in {nacks.messages} NACKs, complete.{Colors.ENDC}")
+            stats.append(stat)
+
+    except ServerBusy:
+        raise
+    except Exception as e:
+        print(f"{Colors.FAIL}❌ Error during UDP download: {e}{Colors.ENDC}")
+
+
+def udp_download_stat(id_connection, tracker, series, start_ns, last_arrival_ns):
+    """
+    Builds and reports the statistics entry of a finished UDP download (see `udp_download`).
+    """
+    # Calculate total download time (up to the last packet) and success rate
+    report = tracker.report()
+    series.finish(last_arrival_ns, tracker.goodput_bytes, tracker.unique)
+    total_time = (last_arrival_ns - start_ns) / 1e9
+    speed = (report['goodput_bytes'] * 8) / total_time if total_time > 0 else 0  # speed =  bits/second
+    success_rate = (report['unique'] / report['total_segments']) * 100 if report['total_segments'] > 0 else 0
+
+    # Save the statistics for this connection
+    stat = {'id': id_connection, 'direction': "download", 'total_time': total_time, 'speed': speed,
+            'success_rate': success_rate, 'bytes': report['goodput_bytes'], 'start_ns': start_ns,
+            'end_ns': last_arrival_ns, 'series': series, 'report': report}
+    # Print a summary of the UDP transfer
+    print(
+        f"{Colors.OKGREEN}✔ UDP transfer #{id_connection} finished, total time: {total_time:.2f} seconds, total speed: {speed:.2f} bits/second, percentage of packets received successfully: {success_rate:.2f}%.{Colors.ENDC}")
+    print(
+        f"{Colors.OKCYAN}  UDP transfer #{id_connection}: {report['unique']}/{report['total_segments']} unique segments, "
+        f"{report['lost']} lost in {report['loss_bursts']} bursts (longest {report['max_loss_burst']}), "
+        f"{report['duplicates']} duplicates, {report['out_of_order']} out of order, jitter {report['jitter_ms']:.3f} ms.{Colors.ENDC}")
+    if 'delay_variation_mean_ms' in report:
+        print(f"{Colors.OKCYAN}  UDP transfer #{id_connection}: one-way delay above the minimum: mean "
+              f"{report['delay_variation_mean_ms']:.3f} ms, max {report['delay_variation_max_ms']:.3f} ms.{Colors.ENDC}")
+    print_interval_summary("UDP", stat)
+    return stat
+
+
+# Perform UDP upload
+def send_udp_upload(udp_sock, session_address, file_size, rate_bps, progress):
+    """
+    Sends the segments of a `file_size` bytes file to the server's session address from one
+    reusable datagram buffer, followed by a FIN message. Paced to `rate_bps` when set.
+
+    Args:
+        udp_sock (socket.socket): The client socket of the transfer.
+        session_address (tuple): Where the server receives the upload.
+        file_size (int): Bytes to upload.
+        rate_bps (int): Target rate in bits/second, 0 = as fast as possible.
+        progress (list): Receives (bytes sent, start ns, end ns, IntervalSeries) when done.
+    """
+    try:
+        total_segments = (file_size + BUFFER_SIZE - 1) // BUFFER_SIZE
+        buffer = bytearray(b'B' * (PAYLOAD_HEADER.size + BUFFER_SIZE))
+        view = memoryview(buffer)
+        start_ns = time.perf_counter_ns()
+        series = IntervalSeries(start_ns)
+        bytes_sent = 0
+        for segment in range(total_segments):
+            PAYLOAD_HEADER.pack_into(buffer, 0, MAGIC_COOKIE, PAYLOAD_TYPE, total_segments, segment)
+            payload = min(BUFFER_SIZE, file_size - bytes_sent)
+            udp_sock.sendto(view[:PAYLOAD_HEADER.size + payload], session_address)
+            bytes_sent += payload
+            now_ns = time.perf_counter_ns()
+            if now_ns >= series.next_sample_ns:
+                series.sample(now_ns, bytes_sent, segment + 1)
+            if rate_bps:
+                ahead = (start_ns + bytes_sent * 8e9 / rate_bps - now_ns) / 1e9
+                if ahead > UDP_PACING_SLACK:
+                    time.sleep(ahead)
+        udp_sock.sendto(struct.pack('!IBQ', MAGIC_COOKIE, FIN_TYPE, total_segments), session_address)
+        end_ns = time.perf_counter_ns()
+        series.finish(end_ns, bytes_sent, total_segments)
+        progress.append((bytes_sent, start_ns, end_ns, series))
+    except Exception as e:
+        print(f"{Colors.FAIL}❌ Error during UDP upload: {e}{Colors.ENDC}")
+
+
+@retry_when_busy
+def udp_upload(server_ip, udp_port, file_size, id_connection, stats, bidir=False, rate_bps=UDP_TARGET_RATE):
+    """
+    Uploads `file_size` bytes over UDP (and for `bidir` downloads as many at the same time).
+
+    The server answers the request from a session socket of its own; the client sends the
+    upload there and waits for the server's RESULT_FRAME, repeating its FIN if the result
+    does not arrive within UDP_IDLE_TIMEOUT.
+
+    Args:
+        server_ip (str): The IP address of the server.
+        udp_port (int): The UDP port on which the server is listening.
+        file_size (int): Bytes in each direction.
+        id_connection (int): Identifier for the current connection.
+        stats (list): Receives the upload entry (see `upload_stat`) and, for `bidir`, the download
+            entry (see `udp_download`).
+        bidir (bool): Download while uploading.
+        rate_bps (int): Bits/second both directions are paced to, 0 = as fast as possible.
+    """
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_sock:
+            request_packet = struct.pack('!IBQ', MAGIC_COOKIE, BIDIR_TYPE if bidir else UPLOAD_TYPE, file_size)
+            if rate_bps:
+                request_packet += struct.pack('!Q', rate_bps)
+            udp_sock.sendto(request_packet, (server_ip, udp_port))
+            udp_sock.settimeout(UDP_IDLE_TIMEOUT)
+            buffer = bytearray(BUFFER_SIZE * 2)  # Reused for every datagram
+            try:
+                length, session_address = udp_sock.recvfrom_into(buffer)  # The echo of the request, from the session
+            except socket.timeout:
+                print(f"{Colors.WARNING}⚠️ The server did not answer the UDP upload request.{Colors.ENDC}")
+                return
+            check_reject(buffer, length)  # Sent from the server port instead of a session
+
+            total_segments = (file_size + BUFFER_SIZE - 1) // BUFFER_SIZE
+            start_ns = time.perf_counter_ns()
+            last_arrival_ns = start_ns
+            series = IntervalSeries(start_ns)
+            tracker = ReceiveTracker(total_segments) if bidir else None
+            upload = []
+            sender = threading.Thread(target=send_udp_upload,
+                                      args=(udp_sock, session_address, file_size, rate_bps, upload), daemon=True)
+            sender.start()
+
+            result = None
+            fin_retries = 0
+            address = session_address
+            while True:
+                if address == session_address and length >= MESSAGE_HEADER.size:
+                    magic_cookie, msg_type = MESSAGE_HEADER.unpack_from(buffer)
+                    if magic_cookie == MAGIC_COOKIE and msg_type == RESULT_TYPE and length >= RESULT_FRAME.size:
+                        result = RESULT_FRAME.unpack_from(buffer)
+                    elif (magic_cookie == MAGIC_COOKIE and msg_type == PAYLOAD_TYPE and tracker is not None
+                          and length >= PAYLOAD_HEADER.size):
+                        arrival_ns = time.perf_counter_ns()
+                        if arrival_ns >= series.next_sample_ns:
+                            series.sample(arrival_ns, tracker.goodput_bytes, tracker.unique)
+                        tracker.record(PAYLOAD_HEADER.unpack_from(buffer)[3], length - PAYLOAD_HEADER.size,
+                                       arrival_ns)
+                        last_arrival_ns = arrival_ns
+                if result is not None and (tracker is None or tracker.complete):
+                    break
+                try:
+                    length, address = udp_sock.recvfrom_into(buffer)
+                except socket.timeout:
+                    if sender.is_alive():  # A paced upload is still being sent
+                        continue
+                    if result is None and fin_retries < UDP_FIN_RETRIES:
+                        udp_sock.sendto(struct.pack('!IBQ', MAGIC_COOKIE, FIN_TYPE, total_segments), session_address)
+                        fin_retries += 1
+                        continue
+                    break
+            sender.join()
+
+            if tracker is not None:
+                stats.append(udp_download_stat(id_connection, tracker, series, start_ns, last_arrival_ns))
+            if result is None or not upload:
+                print(f"{Colors.WARNING}⚠️ No result from the server for UDP upload #{id_connection}.{Colors.ENDC}")
+                return
+            bytes_sent, upload_start_ns, upload_end_ns, upload_series = upload[0]
+            stat = upload_stat(id_connection, result, upload_start_ns, upload_end_ns, upload_series, bytes_sent,
+                               total_segments)
+            stats.append(stat)
+            print(
+                f"{Colors.OKGREEN}✔ UDP upload #{id_connection} finished, total time: {stat['total_time']:.2f} seconds, "
+                f"total speed: {stat['speed']:.2f} bits/second (measured by the server), percentage of packets received "
+                f"successfully: {stat['success_rate']:.2f}%.{Colors.ENDC}")
+            print_interval_summary("UDP upload", stat)
+
+    except ServerBusy:
+        raise
+    except Exception as e:
+        print(f"{Colors.FAIL}❌ Error during UDP upload: {e}{Colors.ENDC}")
+
+
+def udp_transfer(server_ip, udp_port, file_size, id_connection, stats, rate_bps=UDP_TARGET_RATE, mode=TEST_MODE,
+                 duration=0, reliable=False, random_payload=False, tuning=None):
+    """
+    Runs one UDP connection of a test in `mode` ("download", "upload" or "bidir"). Downloads
+    stream for `duration` seconds instead of transferring `file_size` bytes when it is set,
+    repair their losses through NACKs when `reliable` is, carry the verified random payload
+    when `random_payload` is and use the socket options in the `tuning` map.
+    """
+    if mode == "download":
+        udp_download(server_ip, udp_port, file_size, id_connection, stats, rate_bps, duration=duration,
+                     reliable=reliable, random_payload=random_payload,
+                     tuning=connection_tuning(tuning, server_ip, "udp"))
+    else:
+        udp_upload(server_ip, udp_port, file_size, id_connection, stats, bidir=mode == "bidir", rate_bps=rate_bps)
+
+
+# Multi-process client mode
+def run_connection_shard(jobs, file_size, start_barrier, results, cpu=None, udp_rate=UDP_TARGET_RATE,
+                         mode=TEST_MODE, duration=0, reliable=False, random_payload=False, tuning=None):
+    """
+    Worker process entry point: runs a shard of the connections as threads in this process
+    and sends their statistics back through a pipe.
+
+    Args:
+        jobs (list): ("tcp" or "udp", connection id, (server IP, UDP port, TCP port)) triples
+            handled by this process.
+        file_size (int): The size of the file to be downloaded.
+        start_barrier (multiprocessing.Barrier): Shared by all workers so their transfers overlap.
+        results (multiprocessing.connection.Connection): Write end of the result pipe.
+        cpu (int): CPU core to pin this process to, None to leave scheduling to the OS.
+        udp_rate (int): Bits/second the server should pace UDP transfers to, 0 = as fast as possible.
+        mode (str): "download", "upload" or "bidir".
+        duration (float): Seconds downloads stream for, 0 = transfer `file_size` bytes.
+        reliable (bool): Repair lost UDP download segments through NACKs.
+        random_payload (bool): Download the random payload pool and verify it.
+        tuning (dict): Socket options per server for the downloads, see `connection_tuning`.
+    """
+    tcp_stats = []
+    udp_stats = []
+    try:
+        if cpu is not None:
+            os.sched_setaffinity(0, {cpu})
+        threads = [
+            threading.Thread(target=tcp_transfer,
+                             args=(server_ip, tcp_port, file_size, id_connection, tcp_stats, mode, duration,
+                                   random_payload, tuning))
+            if protocol == "tcp" else
+            threading.Thread(target=udp_transfer,
+                             args=(server_ip, udp_port, file_size, id_connection, udp_stats, udp_rate, mode,
+                                   duration, reliable, random_payload, tuning))
+            for protocol, id_connection, (server_ip, udp_port, tcp_port) in jobs
+        ]
+        try:
+            start_barrier.wait(SHARD_START_TIMEOUT)
+        except threading.BrokenBarrierError:
+            print(f"{Colors.WARNING}⚠️ Not every worker process is ready, starting transfers anyway...{Colors.ENDC}")
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    except Exception as e:
+        print(f"{Colors.FAIL}❌ Error in worker process: {e}{Colors.ENDC}")
+    finally:
+        results.send((tcp_stats, udp_stats))
+        results.close()
+
+
+def run_sharded_transfers(server_ip, tcp_port, udp_port, file_size, tcp_threads, udp_threads, processes,
+                          pin_cpus=CLIENT_PIN_CPUS, udp_rate=UDP_TARGET_RATE, mode=TEST_MODE, servers=None,
+                          duration=0, reliable=False, random_payload=False, tuning=None):
+    """
+    Spreads the TCP and UDP connections round-robin over `processes` worker processes, so the
+    receive loops do not share one GIL, and merges the statistics they send back.
+
+    Args:
+        server_ip (str): The IP address of the server.
+        tcp_port (int): The TCP port for the download.
+        udp_port (int): The UDP port for the download.
+        file_size (int): The size of the file to be downloaded.
+        tcp_threads (int): Number of TCP connections.
+        udp_threads (int): Number of UDP connections.
+        processes (int): Number of worker processes (capped at the number of connections).
+        pin_cpus (bool): Pin every worker to its own CPU core where the OS supports it.
+        udp_rate (int): Bits/second the server should pace UDP transfers to, 0 = as fast as possible.
+        mode (str): "download", "upload" or "bidir".
+        servers (list): (server IP, UDP port, TCP port) tuples to spread the connections over,
+            see `connection_server`. Defaults to the one server given.
+        duration (float): Seconds downloads stream for, 0 = transfer `file_size` bytes.
+        reliable (bool): Repair lost UDP download segments through NACKs.
+        random_payload (bool): Download the random payload pool and verify it.
+        tuning (dict): Socket options per server for the downloads, see `connection_tuning`.
+
+    Returns:
+        tuple: The merged TCP and UDP statistics lists, ordered by connection id.
+    """
+    servers = servers or [(server_ip, udp_port, tcp_port)]
+    jobs = ([("tcp", i + 1, connection_server(servers, i + 1)) for i in range(tcp_threads)]
+            + [("udp", i + 1, connection_server(servers, i + 1)) for i in range(udp_threads)])
+    processes = max(1, min(processes, len(jobs)))
+    cpus = sorted(os.sched_getaffinity(0)) if pin_cpus and hasattr(os, "sched_setaffinity") else None
+    start_barrier = multiprocessing.Barrier(processes)
+
+    workers = []
+    for index in range(processes):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        worker = multiprocessing.Process(
+            target=run_connection_shard,
+            args=(jobs[index::processes], file_size, start_barrier, sender,
+                  cpus[index % len(cpus)] if cpus else None, udp_rate, mode, duration, reliable, random_payload,
+                  tuning),
+            daemon=True)
+        worker.start()
+        sender.close()  # The parent only reads, so EOF shows up if a worker dies
+        workers.append((worker, receiver))
+
+    tcp_stats = []
+    udp_stats = []
+    for worker, receiver in workers:
+        try:
+            worker_tcp_stats, worker_udp_stats = receiver.recv()
+            tcp_stats.extend(worker_tcp_stats)
+            udp_stats.extend(worker_udp_stats)
+        except EOFError:
+            print(f"{Colors.FAIL}❌ Worker process {worker.pid} exited without results.{Colors.ENDC}")
+        receiver.close()
+        worker.join()
+
+    tcp_stats.sort(key=lambda stat: stat['id'])
+    udp_stats.sort(key=lambda stat: stat['id'])
+    print(f"{Colors.OKCYAN}Merged results of {len(tcp_stats) + len(udp_stats)} transfers from {processes} processes."
+          f"{Colors.ENDC}")
+    return tcp_stats, udp_stats
+
+
+def connection_server(servers, id_connection):
+    """
+    Picks the server of one connection: connections are spread round-robin over `servers`,
+    so connection 1 of every protocol goes to the first (lowest RTT) server.
+
+    Args:
+        servers (list): (server IP, UDP port, TCP port) tuples.
+        id_connection (int): The connection id, starting at 1.
+
+    Returns:
+        tuple: (server IP, UDP port, TCP port) of the connection.
+    """
+    return servers[(id_connection - 1) % len(servers)]
+
+
+# Function to initiate the speed test
+def initiate_speed_test(server_ip, tcp_port, udp_port, file_size, tcp_threads, udp_threads, export_path=None,
+                        processes=CLIENT_PROCESSES, pin_cpus=CLIENT_PIN_CPUS, udp_rate=UDP_TARGET_RATE,
+                        mode=TEST_MODE, servers=None, duration=0, reliable=False, random_payload=False,
+                        history_path=HISTORY_PATH, tuning=None):
+    """
+    Initiates both TCP and UDP tests, downloads by default.
+    Creates separate threads for each test and records their statistics. With more than one
+    process, the connections are sharded across worker processes instead. The combined
+    throughput of concurrent transfers is reported (see `aggregate_throughput`) and appended
+    to the results history.
+
+    Args:
+        server_ip (str): The IP address of the server.
+        tcp_port (int): The TCP port for the download.
+        udp_port (int): The UDP port for the download.
+        file_size (int): The size of the file to be downloaded.
+        tcp_threads (int): Number of threads for TCP download.
+        udp_threads (int): Number of threads for UDP download.
+        export_path (str): If set, the interval series of every transfer are written to this
+            file (JSON for a .json name, CSV otherwise).
+        processes (int): Worker processes to shard the connections across, 0 or 1 = this process.
+        pin_cpus (bool): Pin every worker process to its own CPU core.
+        udp_rate (int): Bits/second the server should pace UDP transfers to, 0 = as fast as possible.
+        mode (str): "download", "upload" (client to server) or "bidir" (both at once on every connection).
+        servers (list): (server IP, UDP port, TCP port) tuples to spread the connections over
+            round-robin (e.g. from `find_servers`). Defaults to the one server given.
+        duration (float): Stream every download for this many seconds instead of transferring
+            `file_size` bytes, reporting only the steady state after STREAM_WARMUP seconds.
+            Uploads ignore it.
+        reliable (bool): Repair lost UDP download segments through NACKs (see `udp_download`),
+            so UDP reports the goodput and completion time of a complete transfer like TCP.
+        random_payload (bool): Download the server's seeded random payload instead of filler, which
+            compressing middleboxes cannot shrink, and verify every byte received against it.
+        history_path (str): Results history to append this test to (see `HistoryStore`), None = off.
+        tuning (dict): Socket options of the downloads per server IP, e.g. from `load_tuning`
+            (see `connection_tuning`). None = defaults.
+
+    Returns:
+        tuple: The TCP and UDP statistics lists. Every entry has a 'direction', "download" or "upload".
+    """
+    if duration and mode != "download":
+        print(f"{Colors.WARNING}⚠️ Duration-bounded tests only stream downloads, the {mode} test transfers "
+              f"{file_size} bytes.{Colors.ENDC}")
+    started_ns = time.time_ns()
+    servers = servers or [(server_ip, udp_port, tcp_port)]
+    if len(servers) > 1:
+        print(f"{Colors.OKCYAN}Spreading the connections over {len(servers)} servers: "
+              f"{', '.join(server[0] for server in servers)}{Colors.ENDC}")
+    if processes > 1:
+        tcp_stats, udp_stats = run_sharded_transfers(server_ip, tcp_port, udp_port, file_size, tcp_threads,
+                                                     udp_threads, processes, pin_cpus, udp_rate, mode, servers,
+                                                     duration, reliable, random_payload, tuning)
+    else:
+        tcp_stats = []  # List to store statistics for TCP transfers
+        udp_stats = []  # List to store statistics for UDP transfers
+
+        # Create and start TCP threads
+        tcp_threads_list = []
+        for i in range(tcp_threads):
+            server_ip, _, tcp_port = connection_server(servers, i + 1)
+            tcp_threads_list.append(threading.Thread(target=tcp_transfer,
+                                                     args=(server_ip, tcp_port, file_size, i + 1, tcp_stats, mode,
+                                                           duration, random_payload, tuning)))
+
+        # Create and start UDP threads
+        udp_threads_list = []
+        for i in range(udp_threads):
+            server_ip, udp_port, _ = connection_server(servers, i + 1)
+            udp_threads_list.append(threading.Thread(target=udp_transfer,
+                                                     args=(server_ip, udp_port, file_size, i + 1, udp_stats,
+                                                           udp_rate, mode, duration, reliable, random_payload,
+                                                           tuning)))
+
+        # Start all TCP and UDP threads
+        for thread in tcp_threads_list + udp_threads_list:
+            thread.start()
+
+        # Wait for all threads to complete
+        for thread in tcp_threads_list + udp_threads_list:
+            thread.join()
+
+    if export_path:
+        export_series(export_path, tcp_stats, udp_stats)
+        print(f"{Colors.OKCYAN}Interval series written to {export_path}{Colors.ENDC}")
+
+    for protocol, stats in (("TCP", tcp_stats), ("UDP", udp_stats)):
+        for direction in HISTORY_DIRECTIONS:
+            concurrent = [stat for stat in stats if stat['direction'] == direction]
+            if len(concurrent) > 1:
+                print_aggregate(protocol, direction, aggregate_throughput(concurrent))
+    if history_path:
+        record_history(history_path, started_ns, servers[0][0], len(servers), tcp_stats, udp_stats, file_size,
+                       (tcp_threads, udp_threads), mode, duration, reliable, random_payload)
+
+    # Print final summary
+    print(f"{Colors.OKBLUE}All transfers completed, listening to offer requests{Colors.ENDC}")
+    # print(f"{Colors.OKCYAN}Summary:{Colors.ENDC}")
+    #
+    # for conn_id, duration, speed in tcp_stats:
+    #     print(f"{Colors.BOLD}TCP transfer #{conn_id} finished, total time: {duration:.2f} seconds, total speed: {speed:.2f} bits/second.{Colors.ENDC}")
+    # print("")
+    # for conn_id, duration, speed, success_rate in udp_stats:
+    #     print(f"{Colors.BOLD}UDP transfer #{conn_id} finished, total time: {duration:.2f} seconds, total speed: {speed:.2f} bits/second, percentage of packets received successfully: {success_rate:.2f}%.{Colors.ENDC}")
+
+    return tcp_stats, udp_stats
+
+
+# Results history
+# Every test appends one fixed-width binary record per protocol and direction to HISTORY_PATH, plus a small
+# index entry (time and server) to HISTORY_PATH + ".idx". Records are never rewritten, so appending is cheap and
+# a query for a time range and server binary-searches the index and reads only the records it needs.
+class HistoryStore:
+    """
+    Append-only store of test results in HISTORY_RECORD records, with a HISTORY_INDEX index.
+
+    Record i of the data file belongs to entry i of the index. Both files start with
+    HISTORY_MAGIC; an append cut short (a crash or a full disk) leaves a partial tail, which
+    is ignored and overwritten by the next append. Timestamps never decrease from one record
+    to the next (a record is stamped no earlier than the one before it, should the clock step
+    back), which is what lets `query` find a time range by binary search.
+    """
+
+    def __init__(self, path=HISTORY_PATH):
+        self.path = path
+        self.index_path = path + ".idx"
+
+    def count(self):
+        """
+        Returns:
+            int: Records present in both files.
+        """
+        try:
+            records = (os.path.getsize(self.path) - len(HISTORY_MAGIC)) // HISTORY_RECORD.size
+            entries = (os.path.getsize(self.index_path) - len(HISTORY_MAGIC)) // HISTORY_INDEX.size
+        except OSError:
+            return 0
+        return max(0, min(records, entries))
+
+    def open_for_append(self, path, count, entry_size):
+        """
+        Opens one of the two files positioned after its first `count` entries, creating it
+        (with HISTORY_MAGIC) if needed and cutting off a partial tail.
+
+        Raises:
+            ValueError: If the file exists but is not a results history.
+        """
+        f = open(path, "r+b" if os.path.exists(path) else "w+b")
+        try:
+            if f.read(len(HISTORY_MAGIC)) not in (HISTORY_MAGIC, b""):
+                raise ValueError(f"{path} is not a results history")
+            f.seek(0)
+            f.write(HISTORY_MAGIC)
+            f.truncate(len(HISTORY_MAGIC) + count * entry_size)
+            f.seek(0, os.SEEK_END)
+        except BaseException:
+            f.close()
+            raise
+        return f
+
+    def append(self, records):
+        """
+        Appends records, the data first and then their index entries, so an index entry never
+        refers to a record that was not written.
+
+        Args:
+            records (list): Tuples in HISTORY_RECORD field order.
+        """
+        if not records:
+            return
+        count = self.count()
+        with self.open_for_append(self.path, count, HISTORY_RECORD.size) as data, \
+                self.open_for_append(self.index_path, count, HISTORY_INDEX.size) as index:
+            last_ns = 0
+            if count:
+                index.seek(len(HISTORY_MAGIC) + (count - 1) * HISTORY_INDEX.size)
+                last_ns = HISTORY_INDEX.unpack(index.read(HISTORY_INDEX.size))[0]
+                index.seek(0, os.SEEK_END)
+            records = [(max(record[0], last_ns),) + tuple(record[1:]) for record in records]
+            data.write(b"".join(HISTORY_RECORD.pack(*record) for record in records))
+            data.flush()
+            index.write(b"".join(HISTORY_INDEX.pack(record[0], record[1]) for record in records))
+
+    def query(self, server=None, since=None, until=None):
+        """
+        Reads the records of one server (or all) stamped within [since, until).
+
+        Args:
+            server (str): Server IPv4 address, None = every server.
+            since (float): Unix time of the oldest record wanted, None = the first one.
+            until (float): Unix time the records must be older than, None = no limit.
+
+        Returns:
+            list: Records as dicts (see `history_record_dict`), oldest first.
+        """
+        count = self.count()
+        if not count:
+            return []
+        with open(self.index_path, "rb") as f:
+            f.seek(len(HISTORY_MAGIC))
+            index = list(HISTORY_INDEX.iter_unpack(f.read(count * HISTORY_INDEX.size)))
+        times = [entry[0] for entry in index]
+
+        first = bisect.bisect_left(times, int(since * 1e9)) if since is not None else 0
+        last = bisect.bisect_left(times, int(until * 1e9)) if until is not None else count
+        if first >= last:
+            return []
+        wanted = range(first, last)
+        if server is not None:
+            key = history_server_key(server)
+            wanted = [entry for entry in wanted if index[entry][1] == key]
+            if not wanted:
+                return []
+        with open(self.path, "rb") as f:  # One read covering the wanted records
+            f.seek(len(HISTORY_MAGIC) + wanted[0] * HISTORY_RECORD.size)
+            data = f.read((wanted[-1] - wanted[0] + 1) * HISTORY_RECORD.size)
+        return [history_record_dict(HISTORY_RECORD.unpack_from(data, (entry - wanted[0]) * HISTORY_RECORD.size))
+                for entry in wanted]
+
+
+def history_server_key(server_ip):
+    """
+    Packs a server address into the 4 bytes records are indexed by (0.0.0.0 if it cannot be resolved).
+    """
+    try:
+        return socket.inet_aton(socket.gethostbyname(server_ip))
+    except OSError:
+        return bytes(4)
+
+
+def history_records(timestamp_ns, server_ip, servers, tcp_stats, udp_stats, file_size, connections, mode, duration,
+                    reliable, random_payload):
+    """
+    Builds the history records of one test, one per protocol and direction it ran, also when
+    none of its transfers completed.
+
+    Args:
+        timestamp_ns (int): When the test started, in ns since the epoch.
+        server_ip (str): The (first) server tested against.
+        servers (int): Servers the connections were spread over.
+        tcp_stats (list): TCP statistics entries of the test.
+        udp_stats (list): UDP statistics entries of the test.
+        file_size (int): Bytes per transfer, 0 for a stream.
+        connections (tuple): TCP and UDP connections asked for.
+        mode (str): "download", "upload" or "bidir".
+        duration (float): Seconds downloads streamed for, 0 = file size transfer.
+        reliable (bool): Reliable UDP downloads.
+        random_payload (bool): Random payload downloads.
+
+    Returns:
+        list: Tuples in HISTORY_RECORD field order.
+    """
+    key = history_server_key(server_ip)
+    directions = HISTORY_DIRECTIONS if mode == "bidir" else (mode,)
+    records = []
+    for protocol, stats, count in zip(HISTORY_PROTOCOLS, (tcp_stats, udp_stats), connections):
+        if not count:
+            continue
+        for direction in directions:
+            metrics = trial_metrics([stat for stat in stats if stat['direction'] == direction])
+            download = direction == "download"
+            flags = ((HISTORY_FLAG_RELIABLE if reliable and download and protocol == "udp" else 0)
+                     | (HISTORY_FLAG_RANDOM if random_payload and download else 0))
+            records.append((timestamp_ns, key, HISTORY_PROTOCOLS.index(protocol), HISTORY_DIRECTIONS.index(direction),
+                            flags, min(servers, 255), min(count, 65535), min(metrics['completed'], 65535), file_size,
+                            int(duration * 1000) if download else 0, metrics['bytes'], metrics.get('duration_s', 0.0),
+                            metrics.get('throughput_bps', 0.0),
+                            math.nan if metrics.get('overlap_bps') is None else metrics['overlap_bps'],
+                            metrics.get('interval_median_bps', 0.0), metrics.get('mean_connection_bps', 0.0),
+                            metrics.get('loss_percent', math.nan), metrics.get('corrupt', 0)))
+    return records
+
+
+def history_record_dict(record):
+    """
+    Turns an unpacked HISTORY_RECORD into a JSON-serializable dict (NaN fields become None).
+    """
+    (timestamp_ns, key, protocol, direction, flags, servers, connections, completed, file_size, duration_ms,
+     total_bytes, window_s, throughput, overlap, interval_median, mean_connection, loss, corrupt) = record
+    return {
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(timestamp_ns / 1e9)),
+        'timestamp': timestamp_ns / 1e9, 'server': socket.inet_ntoa(key), 'protocol': HISTORY_PROTOCOLS[protocol],
+        'direction': HISTORY_DIRECTIONS[direction], 'reliable': bool(flags & HISTORY_FLAG_RELIABLE),
+        'random_payload': bool(flags & HISTORY_FLAG_RANDOM), 'servers': servers, 'connections': connections,
+        'completed': completed, 'file_size': file_size, 'duration': duration_ms / 1000, 'bytes': total_bytes,
+        'duration_s': window_s, 'throughput_bps': throughput,
+        'overlap_bps': None if math.isnan(overlap) else overlap, 'interval_median_bps': interval_median,
+        'mean_connection_bps': mean_connection, 'loss_percent': None if math.isnan(loss) else loss,
+        'corrupt': corrupt,
+    }
+
+
+def record_history(path, timestamp_ns, *args):
+    """
+    Appends the records of one test (see `history_records` for the arguments) to the history
+    at `path`, warning instead of failing when it cannot be written.
+    """
+    try:
+        HistoryStore(path).append(history_records(timestamp_ns, *args))
+    except (OSError, ValueError) as e:
+        print(f"{Colors.WARNING}⚠️ Could not record the results in {path}: {e}{Colors.ENDC}")
+
+
+def history_trends(records):
+    """
+    Groups history records by server and configuration and summarizes each group's throughput:
+    over all its runs (see `summarize`) and as the median of every day.
+
+    Args:
+        records (list): Record dicts from `HistoryStore.query`.
+
+    Returns:
+        list: One dict per configuration, in order of its first run.
+    """
+    groups = {}
+    for record in records:
+        key = (record['server'], record['protocol'], record['direction'], record['file_size'], record['duration'],
+               record['connections'], record['reliable'], record['random_payload'])
+        groups.setdefault(key, []).append(record)
+    trends = []
+    for (server, protocol, direction, file_size, duration, connections, reliable, random_payload), runs in groups.items():
+        days = {}
+        for record in runs:
+            days.setdefault(record['time'][:10], []).append(record['throughput_bps'])
+        trends.append({
+            'server': server, 'protocol': protocol, 'direction': direction, 'file_size': file_size,
+            'duration': duration, 'connections': connections, 'reliable': reliable, 'random_payload': random_payload,
+            'runs': len(runs), 'first': runs[0]['time'], 'last': runs[-1]['time'],
+            'throughput_bps': summarize([record['throughput_bps'] for record in runs]),
+            'daily_median_bps': {day: statistics.median(values) for day, values in days.items()},
+        })
+    return trends
+
+
+# Latency probing
+# Timestamped probes echoed by the server measure the RTT, and with the server's receive time
+# the uplink and downlink delay variation, both on an idle path and while TCP downloads load it.
+def receive_probe_echoes(udp_sock, buffer, rtts, uplinks, deadline_ns):
+    """
+    Receives probe echoes into `buffer` until `deadline_ns` (a `time.perf_counter_ns` value)
+    and records the first echo of every probe.
+
+    Args:
+        udp_sock (socket.socket): The connected probe socket.
+        buffer (bytearray): Reused receive buffer.
+        rtts (array): RTT of every probe in ns, -1 while no echo arrived.
+        uplinks (array): Server receive time minus client send time of every probe in ns.
+        deadline_ns (int): When to return.
+    """
+    while True:
+        remaining = deadline_ns - time.perf_counter_ns()
+        if remaining <= 0:
+            return
+        udp_sock.settimeout(remaining / 1e9)
+        try:
+            length = udp_sock.recv_into(buffer)
+        except socket.timeout:
+            return
+        arrival_ns = time.perf_counter_ns()
+        if length == PROBE_TS.size:
+            magic_cookie, msg_type, sequence, send_ns, server_ns = PROBE_TS.unpack_from(buffer)
+            if magic_cookie == MAGIC_COOKIE and msg_type == PROBE_TYPE and sequence < len(rtts) \
+                    and rtts[sequence] < 0:
+                rtts[sequence] = arrival_ns - send_ns
+                uplinks[sequence] = server_ns - send_ns
+
+
+def measure_latency(server_ip, udp_port, duration=LATENCY_DURATION, rate=LATENCY_PROBE_RATE, stop=None):
+    """
+    Sends timestamped probes to the server's UDP port at `rate` per second for `duration`
+    seconds and times their echoes. The probe, the receive buffer and the result arrays are
+    allocated up front and probes are stamped in place, so nothing is allocated per probe.
+
+    Args:
+        server_ip (str): The IP address of the server.
+        udp_port (int): The UDP port of the server.
+        duration (float): Seconds to probe for.
+        rate (int): Probes per second.
+        stop (threading.Event): Ends the measurement early once set.
+
+    Returns:
+        dict: The `latency_report` of the probes, None if the server could not be reached.
+    """
+    count = max(1, int(duration * rate))
+    interval_ns = int(1e9 / rate)
+    rtts = array('q', [-1]) * count
+    uplinks = array('q', [0]) * count  # Includes the offset between the two clocks, only differences are used
+    probe = bytearray(PROBE_TS.size)
+    PROBE_TS.pack_into(probe, 0, MAGIC_COOKIE, PROBE_TYPE, 0, 0, 0)
+    buffer = bytearray(BUFFER_SIZE)
+    sent = 0
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_sock:
+            udp_sock.connect((server_ip, udp_port))
+            start_ns = time.perf_counter_ns()
+            for sequence in range(count):
+                receive_probe_echoes(udp_sock, buffer, rtts, uplinks, start_ns + sequence * interval_ns)
+                if stop is not None and stop.is_set():
+                    break
+                PROBE_STAMP.pack_into(probe, MESSAGE_HEADER.size, sequence, time.perf_counter_ns())
+                udp_sock.send(probe)
+                sent += 1
+            receive_probe_echoes(udp_sock, buffer, rtts, uplinks,
+                                 time.perf_counter_ns() + int(PROBE_TIMEOUT * 1e9))  # Late echoes
+    except OSError as e:
+        print(f"{Colors.FAIL}❌ Error during latency probing: {e}{Colors.ENDC}")
+        return None
+    return latency_report(rtts[:sent], uplinks[:sent])
+
+
+def latency_report(rtts, uplinks):
+    """
+    Summarizes the probes of one latency measurement.
+
+    Args:
+        rtts (array): RTT of every probe sent in ns, -1 for probes without an echo.
+        uplinks (array): Server receive time minus client send time of every probe in ns.
+
+    Returns:
+        dict: Probes sent and answered, loss, RTT percentiles and jitter (mean change between
+        consecutive RTTs) in milliseconds, and the p50/p99 delay above the lowest one seen
+        separately for the uplink (client to server) and the downlink.
+    """
+    answered = [index for index in range(len(rtts)) if rtts[index] >= 0]
+    report = {'sent': len(rtts), 'received': len(answered),
+              'loss_percent': 100 * (1 - len(answered) / len(rtts)) if len(rtts) else 0.0}
+    if not answered:
+        return report
+    ordered = sorted(rtts[index] for index in answered)
+    for name, value in (('min', ordered[0]), ('p50', percentile(ordered, 50)), ('p90', percentile(ordered, 90)),
+                        ('p99', percentile(ordered, 99)), ('max', ordered[-1])):
+        report[f"rtt_{name}_ms"] = value / 1e6
+    report['jitter_ms'] = statistics.fmean(
+        abs(rtts[answered[i]] - rtts[answered[i - 1]]) for i in range(1, len(answered))) / 1e6 \
+        if len(answered) > 1 else 0.0
+    up = [uplinks[index] for index in answered]
+    down = [rtts[index] - uplinks[index] for index in answered]
+    for direction, delays in (('uplink', up), ('downlink', down)):
+        lowest = min(delays)
+        variation = sorted(delay - lowest for delay in delays)
+        report[f"{direction}_delay_variation_p50_ms"] = percentile(variation, 50) / 1e6
+        report[f"{direction}_delay_variation_p99_ms"] = percentile(variation, 99) / 1e6
+    return report
+
+
+def print_latency_summary(label, report):
+    """
+    Prints one line with the RTT percentiles of a `latency_report`.
+    """
+    if not report or not report['received']:
+        print(f"{Colors.WARNING}⚠️ {label} latency: no probe was answered.{Colors.ENDC}")
+        return
+    print(f"{Colors.OKCYAN}{label} latency: RTT min {report['rtt_min_ms']:.3f}, p50 {report['rtt_p50_ms']:.3f}, "
+          f"p90 {report['rtt_p90_ms']:.3f}, p99 {report['rtt_p99_ms']:.3f} ms, jitter {report['jitter_ms']:.3f} ms, "
+          f"{report['loss_percent']:.2f}% of {report['sent']} probes lost.{Colors.ENDC}")
+
+
+def latency_under_load(server_ip, tcp_port, udp_port, connections=LATENCY_LOAD_CONNECTIONS,
+                       file_size=LATENCY_LOAD_SIZE, duration=LATENCY_DURATION, rate=LATENCY_PROBE_RATE):
+    """
+    Measures the latency on the idle path, then again while `connections` TCP downloads load it.
+    The growth of the median RTT under load shows how much the path buffers (bufferbloat).
+
+    Args:
+        server_ip (str): The IP address of the server.
+        tcp_port (int): The TCP port for the load downloads.
+        udp_port (int): The UDP port for the probes.
+        connections (int): Number of TCP downloads loading the path.
+        file_size (int): Bytes each download transfers.
+        duration (float): Seconds each measurement lasts at most, the loaded one ends with the load.
+        rate (int): Probes per second.
+
+    Returns:
+        dict: 'idle' and 'loaded' latency reports, 'bufferbloat_ms' (loaded minus idle median RTT)
+        and 'load' (metrics of the load downloads), None if the server did not answer any probe.
+    """
+    idle = measure_latency(server_ip, udp_port, duration, rate)
+    print_latency_summary("Idle", idle)
+    if not idle or not idle['received']:
+        return None
+
+    load_stats = []
+    loaders = [threading.Thread(target=tcp_download, args=(server_ip, tcp_port, file_size, i + 1, load_stats))
+               for i in range(connections)]
+    load_done = threading.Event()
+
+    def wait_for_load():
+        for loader in loaders:
+            loader.join()
+        load_done.set()
+
+    for loader in loaders:
+        loader.start()
+    watcher = threading.Thread(target=wait_for_load)
+    watcher.start()
+    load_done.wait(LATENCY_LOAD_RAMP)
+    loaded = measure_latency(server_ip, udp_port, duration, rate, stop=load_done)
+    watcher.join()
+    print_latency_summary("Loaded", loaded)
+
+    result = {'idle': idle, 'loaded': loaded, 'load': dict(trial_metrics(load_stats), connections=connections)}
+    if loaded and loaded['received']:
+        result['bufferbloat_ms'] = loaded['rtt_p50_ms'] - idle['rtt_p50_ms']
+        print(f"{Colors.OKBLUE}Median RTT grows by {result['bufferbloat_ms']:.3f} ms under load.{Colors.ENDC}")
+    return result
+
+
+## Headless mode
+# Socket option auto-tuning
+# Short stream trials search the socket options of downloads from one server: the TCP send chunk size, socket
+# buffers, TCP_NODELAY and congestion control, and the UDP datagram size up to the path MTU. One option is varied at
+# a time while the others keep their best value so far (coordinate descent), which takes a few dozen trials instead
+# of the whole product of the candidates. The best configuration of every host pair is saved to TUNING_PATH.
+def path_mtu(server_ip):
+    """
+    The path MTU towards `server_ip` as the kernel knows it: on Linux the IP_MTU of a connected
+    UDP socket with path MTU discovery on (the outgoing interface's MTU unless an ICMP
+    "fragmentation needed" lowered it), DEFAULT_PATH_MTU elsewhere.
+    """
+    if not sys.platform.startswith("linux"):
+        return DEFAULT_PATH_MTU
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_sock:
+            udp_sock.setsockopt(socket.IPPROTO_IP, getattr(socket, "IP_MTU_DISCOVER", 10),
+                                getattr(socket, "IP_PMTUDISC_DO", 2))
+            udp_sock.connect((server_ip, SERVER_UDP_PORT))  # Nothing is sent, this only picks the route
+            return udp_sock.getsockopt(socket.IPPROTO_IP, getattr(socket, "IP_MTU", 14))
+    except OSError:
+        return DEFAULT_PATH_MTU
+
+
+def local_address(server_ip):
+    """
+    The local IP address this host reaches `server_ip` from, the client side of the host pair.
+    """
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_sock:
+            udp_sock.connect((server_ip, SERVER_UDP_PORT))
+            return udp_sock.getsockname()[0]
+    except OSError:
+        return "0.0.0.0"
+
+
+def available_congestion_control(path=CONGESTION_CONTROL_PATH):
+    """
+    The TCP congestion control algorithms this host's kernel offers, tried on the server (which
+    turns away the ones it does not have, so they measure nothing). Empty if the list cannot be read.
+    """
+    try:
+        with open(path) as f:
+            return f.read().split()
+    except OSError:
+        return []
+
+
+def tuning_space(protocol, mtu):
+    """
+    The socket options auto-tuning searches for `protocol`, in search order.
+
+    Args:
+        protocol (str): "tcp" or "udp".
+        mtu (int): Path MTU to the server, which bounds the UDP datagram size.
+
+    Returns:
+        list: (option name, candidate values) pairs; the first value of every option (0 or "")
+        keeps the default.
+    """
+    if protocol == "tcp":
+        return [('chunk', (0,) + TUNE_TCP_CHUNKS), ('sndbuf', (0,) + TUNE_SNDBUFS), ('rcvbuf', (0,) + TUNE_RCVBUFS),
+                ('nodelay', (0, 1)), ('cc', ("",) + tuple(available_congestion_control()))]
+    largest = max(1, min(mtu - IP_UDP_OVERHEAD - PAYLOAD_TS_HEADER.size, UDP_MAX_SEGMENT))
+    segments = sorted({size for size in TUNE_UDP_SEGMENTS if size < largest} | {largest} - {BUFFER_SIZE})
+    return [('segment_size', (0,) + tuple(segments)), ('sndbuf', (0,) + TUNE_SNDBUFS),
+            ('rcvbuf', (0,) + TUNE_RCVBUFS)]
+
+
+def connection_tuning(tuning, server_ip, protocol):
+    """
+    Picks the socket options of one connection from a tuning map.
+
+    Args:
+        tuning (dict): Maps server IP to {'tcp': options, 'udp': options}, None = no tuning.
+        server_ip (str): The server of the connection.
+        protocol (str): "tcp" or "udp".
+
+    Returns:
+        dict: The options for `tcp_download` or `udp_download`, None for the defaults.
+    """
+    return (tuning or {}).get(server_ip, {}).get(protocol)
+
+
+def auto_tune(server, protocols=("tcp", "udp"), connections=1, duration=TUNE_TRIAL_DURATION,
+              repetitions=TUNE_REPETITIONS, udp_rate=UDP_TARGET_RATE, processes=CLIENT_PROCESSES):
+    """
+    Searches the download socket options for `server` in short stream trials and reports the
+    best configuration of each protocol. Each option in `tuning_space` is varied in turn with
+    the others at their best value so far; a candidate replaces the best one only if it is
+    TUNE_MIN_GAIN faster, so trial noise does not pick the configuration.
+
+    Args:
+        server (tuple): (server IP, UDP port, TCP port).
+        protocols (list): "tcp" and/or "udp".
+        connections (int): Parallel connections per trial.
+        duration (float): Seconds every trial streams for (steady state after STREAM_WARMUP).
+        repetitions (int): Trials per configuration, their median throughput counts.
+        udp_rate (int): Bits/second the server should pace UDP trials to, 0 = as fast as possible.
+        processes (int): Worker processes per trial, see `initiate_speed_test`.
+
+    Returns:
+        dict: The host pair ('client', 'server'), 'path_mtu', 'measured' and per protocol the
+        'best' options (defaults left out), their 'throughput_bps', the 'default_bps' of the
+        defaults, the relative 'gain' and every configuration tried under 'trials'.
+    """
+    server_ip, udp_port, tcp_port = server
+    mtu = path_mtu(server_ip)
+    result = {'client': local_address(server_ip), 'server': server_ip, 'path_mtu': mtu,
+              'measured': time.strftime("%Y-%m-%dT%H:%M:%S%z"), 'trial_duration': duration,
+              'connections': connections}
+    for protocol in protocols:
+        trials = []
+        measured = {}
+
+        def measure(options):
+            key = tuple(sorted(options.items()))
+            if key not in measured:
+                rates = []
+                for _ in range(repetitions):
+                    tcp_stats, udp_stats = initiate_speed_test(
+                        server_ip, tcp_port, udp_port, 0, connections if protocol == "tcp" else 0,
+                        connections if protocol == "udp" else 0, processes=processes, udp_rate=udp_rate,
+                        duration=duration, history_path=None, tuning={server_ip: {protocol: options}})
+                    stats = tcp_stats if protocol == "tcp" else udp_stats
+                    rates.append(trial_metrics(stats).get('throughput_bps', 0) if len(stats) == connections else 0)
+                measured[key] = statistics.median(rates)
+                trials.append({'options': {name: value for name, value in options.items() if value},
+                               'throughput_bps': measured[key]})
+                print(f"{Colors.OKCYAN}Auto-tune {protocol.upper()} {format_options(options)}: "
+                      f"{measured[key] / 1e6:.2f} Mbit/s{Colors.ENDC}")
+            return measured[key]
+
+        space = tuning_space(protocol, mtu)
+        best = {name: values[0] for name, values in space}
+        best_rate = default_rate = measure(best)
+        for name, values in space:
+            for value in values[1:]:
+                candidate = dict(best, **{name: value})
+                rate = measure(candidate)
+                if rate > best_rate * (1 + TUNE_MIN_GAIN):
+                    best, best_rate = candidate, rate
+        result[protocol] = {'best': {name: value for name, value in best.items() if value},
+                            'throughput_bps': best_rate, 'default_bps': default_rate,
+                            'gain': best_rate / default_rate - 1 if default_rate else None, 'trials': trials}
+        print(f"{Colors.OKGREEN}✔ Best {protocol.upper()} configuration for {result['client']} -> {server_ip}: "
+              f"{format_options(best)}, {best_rate / 1e6:.2f} Mbit/s "
+              f"(defaults {default_rate / 1e6:.2f} Mbit/s).{Colors.ENDC}")
+    return result
+
+
+def format_options(options):
+    """
+    Formats socket options as name=value words, "defaults" if they all keep their default.
+    """
+    return " ".join(f"{name}={value}" for name, value in options.items() if value) or "defaults"
+
+
+def save_tuning(result, path=TUNING_PATH):
+    """
+    Stores the best configurations `auto_tune` found for one host pair in the tuning file,
+    replacing what was stored for that pair before.
+    """
+    if not path:
+        return
+    entries = read_tuning(path)
+    entries[f"{result['client']}>{result['server']}"] = {
+        'measured': result['measured'], 'path_mtu': result['path_mtu'],
+        **{protocol: {key: result[protocol][key] for key in ('best', 'throughput_bps', 'default_bps')}
+           for protocol in HISTORY_PROTOCOLS if protocol in result},
+    }
+    try:
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as f:
+            json.dump({'pairs': entries}, f, indent=2)
+        os.replace(temporary, path)  # Atomic, like the server cache
+    except OSError as e:
+        print(f"{Colors.WARNING}⚠️ Could not write the tuning file {path}: {e}{Colors.ENDC}")
+
+
+def read_tuning(path=TUNING_PATH):
+    """
+    Returns:
+        dict: The stored configurations by "client IP>server IP", empty if there are none.
+    """
+    if not path:
+        return {}
+    try:
+        with open(path) as f:
+            entries = json.load(f)['pairs']
+        return entries if isinstance(entries, dict) else {}
+    except (OSError, ValueError, KeyError, TypeError):
+        return {}
+
+
+def load_tuning(servers, path=TUNING_PATH):
+    """
+    Builds the tuning map of a test (see `connection_tuning`) from the configurations stored for
+    this host and `servers`. Servers without one keep the defaults.
+
+    Args:
+        servers (list): (server IP, UDP port, TCP port) tuples.
+        path (str): The tuning file.
+
+    Returns:
+        dict: Maps server IP to {'tcp': options, 'udp': options}.
+    """
+    entries = read_tuning(path)
+    tuning = {}
+    for server_ip, _, _ in servers:
+        entry = entries.get(f"{local_address(server_ip)}>{server_ip}")
+        if entry:
+            tuning[server_ip] = {protocol: entry[protocol]['best'] for protocol in HISTORY_PROTOCOLS
+                                 if isinstance(entry.get(protocol), dict) and entry[protocol].get('best')}
+            print(f"{Colors.OKCYAN}Using the socket options tuned for {server_ip} on {entry.get('measured')}: "
+                  + ", ".join(f"{protocol.upper()} {format_options(options)}"
+                              for protocol, options in tuning[server_ip].items()) + f"{Colors.ENDC}")
+    return tuning
+
+
+# A scriptable front end for monitoring: run a matrix of configurations K times against one discovered
+# (or given) server and summarize every metric with mean, standard deviation and a 95% confidence interval.
+def summarize(values):
+    """
+    Summarizes repeated measurements of one metric.
+
+    Args:
+        values (list): One value per measured trial; None (a metric the trial could not measure)
+            is left out.
+
+    Returns:
+        dict: n, mean, stdev (sample) and the bounds of the 95% confidence interval of the mean.
+    """
+    values = [value for value in values if value is not None]
+    n = len(values)
+    if n == 0:
+        return {'n': 0, 'mean': None, 'stdev': None, 'ci95_low': None, 'ci95_high': None}
+    mean = statistics.fmean(values)
+    stdev = statistics.stdev(values) if n > 1 else 0.0
+    t = T_CRITICAL_95[n - 2] if 1 < n <= len(T_CRITICAL_95) + 1 else 1.96
+    margin = t * stdev / math.sqrt(n) if n > 1 else 0.0
+    return {'n': n, 'mean': mean, 'stdev': stdev, 'ci95_low': mean - margin, 'ci95_high': mean + margin}
+
+
+def trial_metrics(stats):
+    """
+    Reduces the statistics of one trial (all connections of one protocol) to its metrics.
+
+    Args:
+        stats (list): Statistics entries produced by `tcp_download` or `udp_download`.
+
+    Returns:
+        dict: Combined throughput over the active window (see `aggregate_throughput`), and while
+        every connection was active, the median interval throughput of the combined series, mean
+        per-connection speed, bytes, duration, completed connections (those that moved any data)
+        and, for UDP, the percentage of lost segments and the mean one-way delay variation of
+        timestamped transfers. Reliable UDP downloads add the segments they asked for again,
+        random payload downloads the corrupted receives.
+    """
+    metrics = {'completed': sum(1 for stat in stats if stat['bytes']), 'bytes': sum(stat['bytes'] for stat in stats)}
+    if stats:
+        aggregate = aggregate_throughput(stats)
+        metrics['duration_s'] = aggregate['window_s']
+        metrics['throughput_bps'] = aggregate['throughput_bps']
+        metrics['overlap_bps'] = aggregate['overlap_bps']  # None when the connections never all ran at once
+        metrics['interval_median_bps'] = aggregate['interval_median_bps']
+        metrics['mean_connection_bps'] = statistics.fmean(stat['speed'] for stat in stats)
+        if 'success_rate' in stats[0]:
+            metrics['loss_percent'] = 100 - statistics.fmean(stat['success_rate'] for stat in stats)
+        variations = [stat['report']['delay_variation_mean_ms'] for stat in stats
+                      if 'delay_variation_mean_ms' in stat.get('report', {})]
+        if variations:
+            metrics['delay_variation_ms'] = statistics.fmean(variations)
+        if any('corrupt' in stat.get('report', {}) for stat in stats):
+            metrics['corrupt'] = sum(stat['report'].get('corrupt', 0) for stat in stats)
+        if any('nacked_segments' in stat.get('report', {}) for stat in stats):
+            metrics['nacked_segments'] = sum(stat['report'].get('nacked_segments', 0) for stat in stats)
+    return metrics
+
+
+def run_test_matrix(server, sizes, connections, protocols, repetitions=5, warmup=1, processes=CLIENT_PROCESSES,
+                    pin_cpus=CLIENT_PIN_CPUS, udp_rate=UDP_TARGET_RATE, mode=TEST_MODE, servers=None, duration=0,
+                    reliable=False, random_payload=False, history_path=HISTORY_PATH, tuning=None):
+    """
+    Runs every (protocol, file size, connection count) configuration `warmup + repetitions`
+    times against one server and summarizes the measured trials. Warm-up trials are run but
+    not reported, nor recorded in the results history.
+
+    Args:
+        server (tuple): (server IP, UDP port, TCP port), e.g. from `listen_for_offers`.
+        sizes (list): File sizes in bytes.
+        connections (list): Numbers of parallel connections.
+        protocols (list): "tcp" and/or "udp".
+        repetitions (int): Measured trials per configuration.
+        warmup (int): Discarded trials run before the measured ones.
+        processes (int): Worker processes per trial, see `initiate_speed_test`.
+        pin_cpus (bool): Pin worker processes to CPU cores.
+        udp_rate (int): Bits/second the server should pace UDP transfers to, 0 = as fast as possible.
+        mode (str): "download", "upload" or "bidir". Bidirectional trials report the upload
+            metrics with an "upload_" prefix next to the download metrics.
+        servers (list): (server IP, UDP port, TCP port) tuples to spread every trial's connections
+            over, `server` first. Defaults to `server` alone.
+        duration (float): Stream downloads for this many seconds instead of iterating over
+            `sizes`; the reported metrics are then the steady state after STREAM_WARMUP.
+        reliable (bool): Repair lost UDP download segments through NACKs.
+        random_payload (bool): Download the random payload pool and verify it.
+        history_path (str): Results history every measured trial is appended to, None = off.
+        tuning (dict): Socket options of the downloads per server IP (see `connection_tuning`).
+
+    Returns:
+        dict: JSON-serializable results with the trials and summary of every configuration.
+    """
+    server_ip, udp_port, tcp_port = server
+    results = {'server': {'ip': server_ip, 'udp_port': udp_port, 'tcp_port': tcp_port},
+               'started': time.strftime("%Y-%m-%dT%H:%M:%S%z"), 'mode': mode, 'repetitions': repetitions,
+               'warmup': warmup, 'configurations': []}
+    if duration:
+        results.update(duration=duration, stream_warmup=STREAM_WARMUP)
+        sizes = [0]  # Streams have no file size
+    if reliable:
+        results['reliable'] = True
+    if random_payload:
+        results['payload'] = "random"
+    if tuning:
+        results['tuning'] = tuning
+    if servers and len(servers) > 1:
+        results['servers'] = [{'ip': ip, 'udp_port': udp, 'tcp_port': tcp} for ip, udp, tcp in servers]
+    for protocol in protocols:
+        for file_size in sizes:
+            for count in connections:
+                tcp_threads, udp_threads = (count, 0) if protocol == "tcp" else (0, count)
+                trials = []
+                for trial in range(warmup + repetitions):
+                    tcp_stats, udp_stats = initiate_speed_test(server_ip, tcp_port, udp_port, file_size, tcp_threads,
+                                                               udp_threads, processes=processes, pin_cpus=pin_cpus,
+                                                               udp_rate=udp_rate, mode=mode, servers=servers,
+                                                               duration=duration, reliable=reliable,
+                                                               random_payload=random_payload,
+                                                               history_path=history_path if trial >= warmup else None,
+                                                               tuning=tuning)
+                    if trial < warmup:
+                        continue
+                    stats = tcp_stats if protocol == "tcp" else udp_stats
+                    if mode == "bidir":
+                        metrics = trial_metrics([stat for stat in stats if stat['direction'] == "download"])
+                        metrics.update((f"upload_{name}", value) for name, value in
+                                       trial_metrics([stat for stat in stats if stat['direction'] == "upload"]).items())
+                        trials.append(metrics)
+                    else:
+                        trials.append(trial_metrics(stats))
+                names = sorted({name for metrics in trials for name in metrics})
+                results['configurations'].append({
+                    'protocol': protocol, 'file_size': file_size, 'connections': count, 'trials': trials,
+                    'summary': {name: summarize([metrics[name] for metrics in trials if metrics.get(name) is not None])
+                                for name in names},
+                })
+    return results
+
+
+def parse_int_list(text):
+    """
+    Parses a comma separated list of positive integers, e.g. "1000000,10000000".
+    """
+    values = [int(value) for value in text.split(",") if value.strip()]
+    if not values or any(value <= 0 for value in values):
+        raise argparse.ArgumentTypeError(f"expected a comma separated list of positive integers, got '{text}'")
+    return values
+
+
+def parse_args(argv=None):
+    """
+    Parses the headless client command line options.
+
+    Args:
+        argv (list): Arguments to parse, defaults to sys.argv[1:].
+
+    Returns:
+        argparse.Namespace: The parsed options.
+    """
+    parser = argparse.ArgumentParser(description="Network speed test client. Without options it runs interactively.")
+    parser.add_argument("--server", help="server IP address (default: wait for an offer broadcast)")
+    parser.add_argument("--tcp-port", type=int, default=SERVER_TCP_PORT, help="server TCP port when --server is given")
+    parser.add_argument("--udp-port", type=int, default=SERVER_UDP_PORT, help="server UDP port when --server is given")
+    parser.add_argument("--spread", type=int, default=SERVER_SPREAD,
+                        help="spread the connections over this many discovered servers, lowest RTT first")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="ignore the cached servers and wait for offer broadcasts")
+    parser.add_argument("--sizes", type=parse_int_list, default=[1_000_000], help="comma separated file sizes in bytes")
+    parser.add_argument("--connections", type=parse_int_list, default=[1], help="comma separated connection counts")
+    parser.add_argument("--protocols", default="tcp,udp", help="comma separated protocols: tcp, udp")
+    parser.add_argument("--repetitions", type=int, default=5, help="measured trials per configuration")
+    parser.add_argument("--warmup", type=int, default=1, help="discarded warm-up trials per configuration")
+    parser.add_argument("--processes", type=int, default=CLIENT_PROCESSES, help="worker processes per trial")
+    parser.add_argument("--pin-cpus", action="store_true", help="pin worker processes to CPU cores")
+    parser.add_argument("--udp-rate", type=int, default=UDP_TARGET_RATE, help="UDP target rate in bits/second")
+    parser.add_argument("--mode", choices=TEST_MODES, default=TEST_MODE,
+                        help="direction: server to client, client to server or both at once")
+    parser.add_argument("--duration", type=float, default=TEST_DURATION,
+                        help="stream downloads for this many seconds instead of transferring --sizes, "
+                             "reporting the steady state after the warm-up (STREAM_WARMUP)")
+    parser.add_argument("--reliable", action="store_true",
+                        help="repair lost UDP download segments through NACKs, for a goodput comparable to TCP")
+    parser.add_argument("--random-payload", action="store_true",
+                        help="download incompressible random payload and verify every byte received")
+    parser.add_argument("--latency", action="store_true",
+                        help="also measure the RTT idle and under TCP load (reported under 'latency')")
+    parser.add_argument("--no-history", action="store_true",
+                        help=f"do not append the measured trials to the results history ({HISTORY_PATH})")
+    parser.add_argument("--history", action="store_true",
+                        help="print the recorded results of --server (or every server) and their trends instead of testing")
+    parser.add_argument("--since", type=float, default=0,
+                        help="with --history, only the results of the last this many days")
+    parser.add_argument("--tune", action="store_true",
+                        help="search the download socket options for the server in short trials (--protocols, the "
+                             "first of --connections) and save the best per host pair instead of testing")
+    parser.add_argument("--tuned", action="store_true",
+                        help=f"download with the socket options --tune saved for the server ({TUNING_PATH})")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--quiet", action="store_true", help="do not print progress to stderr")
+    args = parser.parse_args(argv)
+    args.protocols = [protocol.strip().lower() for protocol in args.protocols.split(",") if protocol.strip()]
+    if not args.protocols or set(args.protocols) - {"tcp", "udp"}:
+        parser.error("--protocols accepts tcp and udp")
+    if args.repetitions <= 0 or args.warmup < 0:
+        parser.error("--repetitions must be positive and --warmup not negative")
+    if args.spread <= 0:
+        parser.error("--spread must be positive")
+    if args.duration < 0:
+        parser.error("--duration must not be negative")
+    if args.duration and args.mode != "download":
+        parser.error("--duration only applies to downloads")
+    if args.reliable and (args.mode != "download" or args.duration):
+        parser.error("--reliable only applies to downloads of a file size")
+    if args.random_payload and args.mode != "download":
+        parser.error("--random-payload only applies to downloads")
+    if args.since < 0:
+        parser.error("--since must not be negative")
+    if args.history and not HISTORY_PATH:
+        parser.error("--history needs HISTORY_PATH set in Client.py")
+    if args.tune and args.history:
+        parser.error("--tune and --history are separate runs")
+    if args.tuned and args.mode != "download":
+        parser.error("--tuned only applies to downloads")
+    return args
+
+
+def run_headless(args):
+    """
+    Runs the test matrix described by the parsed command line and writes the JSON results, or
+    with --history the recorded results and with --tune the auto-tuning results instead.
+    Progress output goes to stderr (or nowhere with --quiet) so stdout only carries JSON.
+
+    Args:
+        args (argparse.Namespace): Options from `parse_args`.
+
+    Returns:
+        int: Process exit code, 1 if no server was found or a configuration completed no trial.
+    """
+    if args.history:
+        records = HistoryStore(HISTORY_PATH).query(args.server, time.time() - args.since * 86400 if args.since else None)
+        return write_results({'history': HISTORY_PATH, 'records': records, 'trends': history_trends(records)},
+                             args.output)
+
+    progress = open(os.devnull, "w") if args.quiet else sys.stderr
+    try:
+        with contextlib.redirect_stdout(progress):
+            if args.server:
+                servers = [(args.server, args.udp_port, args.tcp_port)]
+            else:
+                servers = find_servers(args.spread, not args.no_cache)  # Discovered once and reused by every trial
+                if not servers:
+                    print(f"{Colors.WARNING}⚠️ No server found. Exiting...{Colors.ENDC}")
+                    return 1
+            if args.tune:
+                results = auto_tune(servers[0], args.protocols, args.connections[0], udp_rate=args.udp_rate,
+                                    processes=args.processes)
+                save_tuning(results)
+            else:
+                server_ip, udp_port, tcp_port = servers[0]
+                latency = latency_under_load(server_ip, tcp_port, udp_port) if args.latency else None
+                results = run_test_matrix(servers[0], args.sizes, args.connections, args.protocols, args.repetitions,
+                                          args.warmup, args.processes, args.pin_cpus, args.udp_rate, args.mode,
+                                          servers, args.duration, args.reliable, args.random_payload,
+                                          None if args.no_history else HISTORY_PATH,
+                                          load_tuning(servers) if args.tuned else None)
+                if args.latency:
+                    results['latency'] = latency
+                failed = failed_configurations(results)
+                for config in failed:
+                    print(f"{Colors.FAIL}❌ No {config['protocol'].upper()} trial of {config['file_size']} bytes over "
+                          f"{config['connections']} connection(s) completed.{Colors.ENDC}")
+    finally:
+        if args.quiet:
+            progress.close()
+
+    exit_code = write_results(results, args.output)
+    return 1 if not args.tune and failed else exit_code
+
+
+def failed_configurations(results):
+    """
+    Finds the configurations of a test matrix without a single completed trial, so their
+    summary has nothing measured behind it. A bidirectional trial has to complete both directions.
+
+    Args:
+        results (dict): Results from `run_test_matrix`.
+
+    Returns:
+        list: The failed configurations.
+    """
+    return [config for config in results['configurations']
+            if not any(metrics['completed'] and metrics.get('upload_completed', 1) for metrics in config['trials'])]
+
+
+def write_results(results, path=None):
+    """
+    Writes JSON results to `path`, or to stdout without one.
+
+    Returns:
+        int: Process exit code.
+    """
+    if path:
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+def main(argv=None):
+    """
+    Main function that starts the client, receives server offers,
+    and initiates the speed test based on user input. Given any command line
+    options, it runs headless instead (see `run_headless`).
+
+    Args:
+        argv (list): Command line arguments, defaults to sys.argv[1:].
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        return run_headless(parse_args(argv))
+
+    print(f"{Colors.HEADER}Welcome to the Speed Test Client!{Colors.ENDC}")
+
+    # Get valid inputs for file size, number of UDP threads, and TCP threads
+    if TEST_DURATION:  # Duration-bounded test, no file size needed
+        file_size = 0
+    else:
+        file_size = get_valid_input("Enter file size for download (in bytes): ")
+    tcp_threads = get_valid_input("Enter the number of TCP connections: ")
+    udp_threads = get_valid_input("Enter the number of UDP connections: ")
+
+    # Receive the server offers (or use the cached servers) and pick the lowest-latency ones
+    servers = find_servers(SERVER_SPREAD)
+
+    if not servers:
+        print(f"{Colors.WARNING}⚠️ No server found. Exiting...{Colors.ENDC}")
+        return
+    server_ip, udp_port, tcp_port = servers[0]
+
+    if LATENCY_TEST:
+        latency_under_load(server_ip, tcp_port, udp_port)
+
+    if TEST_DURATION:
+        print(f"{Colors.OKBLUE}Starting speed test streaming for {TEST_DURATION} seconds.{Colors.ENDC}")
+    else:
+        print(f"{Colors.OKBLUE}Starting speed test with file size: {file_size} bytes.{Colors.ENDC}")
+    initiate_speed_test(server_ip, tcp_port, udp_port, file_size, tcp_threads, udp_threads, SERIES_EXPORT_PATH,
+                        CLIENT_PROCESSES, CLIENT_PIN_CPUS, mode=TEST_MODE, servers=servers, duration=TEST_DURATION,
+                        reliable=RELIABLE_UDP, random_payload=RANDOM_PAYLOAD,
+                        tuning=load_tuning(servers) if USE_TUNING else None)
 
 
 def get_valid_input(prompt):
@@ -278,4 +3035,4 @@ def get_valid_input(prompt):
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
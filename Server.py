@@ -1,8 +1,25 @@
+import argparse
+import asyncio
+import bisect
+import contextlib
+import errno
+import logging
+import logging.handlers
+import mmap
+import multiprocessing
+import queue
+import random
+import select
+import signal
 import socket
 import struct
+import sys
+import tempfile
 import threading
 import time
 import os
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 
 # ANSI color codes for terminal output
@@ -22,12 +39,608 @@ MAGIC_COOKIE = 0xabcddcba
 OFFER_TYPE = 0x2
 REQUEST_TYPE = 0x3
 PAYLOAD_TYPE = 0x4
+UPLOAD_TYPE = 0x5  # UDP request: the client sends the file to the server
+BIDIR_TYPE = 0x6  # UDP request: both sides send the file at the same time
+RESULT_TYPE = 0x7  # What the server measured while receiving an upload
+FIN_TYPE = 0x8  # The client sent the last segment of a UDP upload, or has every segment of a reliable download
+PROBE_TYPE = 0x9  # RTT probe, echoed back to the client (timestamped probes get the server's receive time)
+PAYLOAD_TS_TYPE = 0xA  # Payload segment whose header also carries the server's send timestamp
+STOP_TYPE = 0xB  # The client ends a duration-bounded stream
+REJECT_TYPE = 0xC  # The server is at capacity and turned the transfer away, the client should retry later
+NACK_TYPE = 0xD  # Segments a reliable UDP download is missing, as (first segment, count) ranges
 
 BROADCAST_PORT = 12345
 SERVER_UDP_PORT = 15000
 SERVER_TCP_PORT = 16000
 BUFFER_SIZE = 1024  # Size of each data chunk sent
 BROADCAST_INTERVAL = 1  # Seconds between UDP offer broadcasts
+TCP_CHUNK_SIZE = 256 * 1024  # Bytes handed to the kernel per TCP send call (independent of BUFFER_SIZE)
+TCP_SEND_ENGINE = "memoryview"  # Default TCP send engine: "legacy", "memoryview" or "sendfile"
+SERVER_CORE = "threads"  # Default server core: "threads" (thread per connection/request) or "asyncio" (one event loop)
+UDP_YIELD_EVERY = 64  # Datagrams one UDP transfer sends before yielding to the other transfers on the event loop
+UDP_BATCH_SIZE = 32  # Datagrams handed to the kernel per send call when UDP segmentation offload is available
+UDP_PACING_QUANTUM = 0.001  # Seconds of traffic a paced UDP transfer may send back to back
+UDP_PACING_BURST = 0.005  # Seconds of traffic a paced UDP transfer may bank to absorb late wake-ups
+
+UDP_REQUEST_FORMAT = '!IBQ'  # Magic cookie - 4 B, Message type - 1 B and File size - 8 B
+# Optional fields a client may append to a UDP request, in wire order. Older clients simply omit them.
+UDP_REQUEST_OPTIONS = (
+    ('rate_bps', '!Q'),  # Target sending rate in bits/second, 0 = as fast as possible
+    ('flags', '!B'),  # REQUEST_FLAG_* bits
+    ('duration_ms', '!I'),  # Stream the download for up to this many milliseconds instead of sending file_size bytes
+    ('segment_size', '!H'),  # Payload bytes per datagram of a download, 0 = BUFFER_SIZE (at most UDP_MAX_SEGMENT)
+    ('sndbuf', '!I'),  # SO_SNDBUF of the socket sending a download (threads core only), 0 = system default
+)
+REQUEST_FLAG_TIMESTAMPS = 0x1  # Send PAYLOAD_TS_TYPE segments carrying the send time
+REQUEST_FLAG_RELIABLE = 0x2  # Resend the segments the client reports missing (NACK_TYPE) until it sends FIN_TYPE
+REQUEST_FLAG_RANDOM = 0x4  # Fill the segments from the random payload pool instead of filler
+UDP_REQUEST_MODES = {REQUEST_TYPE: "download", UPLOAD_TYPE: "upload", BIDIR_TYPE: "bidir"}
+TCP_MODES = ("download", "upload", "bidir", "stream")  # Word a TCP request may append to the number, "download" if omitted
+TCP_RANDOM_PAYLOAD = "random"  # Word a TCP request may add after its mode: send the random payload pool instead of filler
+TCP_TUNING_OPTIONS = ("chunk", "sndbuf", "nodelay", "cc")  # name=value words a TCP request may end with, see apply_tcp_tuning
+TCP_MAX_CHUNK = 16 * 1024 * 1024  # Largest chunk size a TCP request may ask for
+MAX_SNDBUF = 256 * 1024 * 1024  # Largest SO_SNDBUF a request may ask for (the kernel caps it further)
+PAYLOAD_SEED = 0x5EED5EED  # Seed of the random payload pool, clients regenerate the same pool to check what arrives
+PAYLOAD_POOL_SIZE = 1024 * 1024  # Random pool bytes: past compressor windows, yet cache-resident; a multiple of BUFFER_SIZE
+MAX_FILE_SIZE = 64 * 1024 ** 3  # Largest file size a request may ask for, larger requests are dropped as invalid
+STREAM_MAX_DURATION = 60  # Seconds a duration-bounded stream may last at most, whatever the client asked for
+STREAM_BLOCK = 1024 * 1024  # Bytes a TCP stream sends between two checks for the client's STOP
+MESSAGE_HEADER = struct.Struct('!IB')  # Magic cookie and message type, the start of every message
+PAYLOAD_HEADER = struct.Struct('!IBQQ')  # Magic cookie, message type, total segments, current segment
+RESULT_FRAME = struct.Struct('!IBQQQ')  # Magic cookie, message type, bytes received, segments received, receive time (ns)
+PROBE = struct.Struct('!IBQ')  # Magic cookie, message type, probe sequence number
+PROBE_TS = struct.Struct('!IBQQQ')  # PROBE plus the client's send time and the server's receive time (ns)
+PAYLOAD_TS_HEADER = struct.Struct('!IBQQQ')  # PAYLOAD_HEADER plus the server's send time (ns)
+REJECT = struct.Struct('!IBI')  # Magic cookie, message type, milliseconds the client should wait before retrying
+NACK_HEADER = struct.Struct('!IBH')  # Magic cookie, message type, number of ranges that follow
+NACK_RANGE = struct.Struct('!QI')  # First missing segment, number of missing segments
+TIMESTAMP = struct.Struct('!Q')  # A nanosecond timestamp, rewritten in place in probes and timestamped segments
+PROBE_SERVER_TIME_OFFSET = PROBE_TS.size - TIMESTAMP.size
+SEND_TIME_OFFSET = PAYLOAD_TS_HEADER.size - TIMESTAMP.size
+UPLOAD_RCVBUF = 4 * 1024 * 1024  # SO_RCVBUF of the socket receiving a UDP upload, absorbs bursts at line rate
+UDP_IDLE_TIMEOUT = 1  # Seconds of silence after which a UDP upload is considered finished
+NACK_LINGER = 3  # Seconds a reliable UDP download waits for another NACK once everything was sent
+NACK_REPAIR_BUDGET = 4  # Segments a reliable UDP download may resend, as a multiple of its segment count
+UDP_RESULT_COPIES = 3  # Result frames sent at the end of a UDP upload, so losing one does not lose the result
+SEGMENT_NUMBER = struct.Struct('!Q')  # The current segment field, rewritten in place for every datagram
+SEGMENT_NUMBER_OFFSET = PAYLOAD_HEADER.size - SEGMENT_NUMBER.size
+# Linux UDP generic segmentation offload: one send call carries many equally sized datagrams.
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+UDP_MAX_DATAGRAM = 65507  # Largest UDP payload over IPv4, which bounds a segmentation offload batch
+UDP_MAX_SEGMENT = UDP_MAX_DATAGRAM - PAYLOAD_TS_HEADER.size  # Largest segment payload a download may ask for
+MAX_TRANSFERS = 128  # Transfers served at once per protocol (TCP, UDP), 0 = no limit; per process with --workers
+TRANSFER_WORKERS = 2 * MAX_TRANSFERS  # Threads serving transfers in the threads core: one per admitted transfer
+TRANSFER_QUEUE = 128  # Transfers that may wait for a free worker thread, later ones are rejected
+MAX_TRANSFERS_PER_CLIENT = 64  # Transfers served at once for one client IP address (both protocols), 0 = no limit
+REJECT_RETRY_AFTER = 1.0  # Seconds a rejected client is asked to wait before it tries again
+EGRESS_RATE_BPS = 0  # Bits/second all transfers together may send, split fairly between them, 0 = no cap
+EGRESS_BURST = 0.005  # Seconds of its share a transfer may send back to back under the egress cap
+SERVER_WORKERS = 0  # Server processes sharing the ports through SO_REUSEPORT, 0 = run everything in this process
+SUPERVISOR_INTERVAL = 1  # Seconds between worker liveness checks in --workers mode
+COUNTER_REPORT_INTERVAL = 10  # Seconds between combined counter reports in --workers mode
+COUNTER_NAMES = ("tcp_transfers", "udp_transfers", "bytes_sent", "datagrams_sent", "bytes_received",
+                 "datagrams_received", "active_tcp_transfers", "active_udp_transfers", "tcp_rejected",
+                 "udp_rejected")
+GAUGE_NAMES = ("active_tcp_transfers", "active_udp_transfers")  # Counters that go down again
+METRICS_HOST = "127.0.0.1"  # The metrics endpoint is only reachable from this machine
+METRICS_PORT = 0  # Port of the Prometheus metrics endpoint, 0 = off; --workers: worker i serves on port + 1 + i
+METRICS_MAX_CLIENTS = 1024  # Clients with their own per-client series, later ones are summed as client="other"
+SEND_LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)  # Seconds
+CONSOLE_LOG = True  # Write per-request messages to the console (through a background thread)
+COUNTER_INDEX = {name: index for index, name in enumerate(COUNTER_NAMES)}
+
+
+# Transfer counters
+class ServerCounters:
+    """
+    Transfer counters of this server process, kept in one row of an array of unsigned 64-bit
+    integers. In --workers mode the array is shared memory with one row per worker: each worker
+    only writes its own row, so workers never contend, and the supervisor sums the rows.
+    A local lock serializes the threads of one process.
+    """
+
+    def __init__(self, values=None, row=0):
+        self.values = values if values is not None else array('Q', bytes(8 * len(COUNTER_NAMES)))
+        self.offset = row * len(COUNTER_NAMES)
+        self.lock = threading.Lock()
+
+    def add(self, **amounts):
+        """
+        Adds to the named counters, e.g. `add(tcp_transfers=1, bytes_sent=n)`.
+        """
+        with self.lock:
+            for name, amount in amounts.items():
+                self.values[self.offset + COUNTER_INDEX[name]] += amount
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: Current value of every counter of this process.
+        """
+        return {name: self.values[self.offset + index] for index, name in enumerate(COUNTER_NAMES)}
+
+    def reset(self, *names):
+        """
+        Sets the named counters back to 0, e.g. the gauges of a restarted worker's row.
+        """
+        with self.lock:
+            for name in names:
+                self.values[self.offset + COUNTER_INDEX[name]] = 0
+
+
+counters = ServerCounters()  # Replaced by a shared-memory row in every --workers process
+
+
+# Detailed metrics
+class LatencyHistogram:
+    """
+    Send-call latency histogram with the SEND_LATENCY_BUCKETS upper bounds. Every transfer fills
+    a private one without locking and merges it into `metrics` once it is done.
+    """
+    bounds_ns = tuple(int(bound * 1e9) for bound in SEND_LATENCY_BUCKETS)
+
+    def __init__(self):
+        self.counts = [0] * (len(SEND_LATENCY_BUCKETS) + 1)  # The last bucket is +Inf
+        self.sum_ns = 0
+
+    def observe(self, start_ns):
+        """
+        Records one send call that started at `start_ns` (perf_counter_ns) and just returned.
+        """
+        elapsed_ns = time.perf_counter_ns() - start_ns
+        self.counts[bisect.bisect_left(self.bounds_ns, elapsed_ns)] += 1
+        self.sum_ns += elapsed_ns
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.sum_ns += other.sum_ns
+
+
+class ServerMetrics:
+    """
+    Metrics of this server process that only the Prometheus endpoint reads: send-call latency
+    histograms per protocol, errors by where they happened and exception type, and per-client
+    totals. Updated once per transfer (or error) under one lock, never per send call.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}  # protocol -> LatencyHistogram
+        self.errors = {}  # (where, exception type) -> count
+        self.clients = {}  # client IP -> [transfers, bytes sent, bytes received]
+
+    def transfer_finished(self, protocol, client_ip, histogram=None, bytes_sent=0, bytes_received=0, transfers=1):
+        """
+        Merges the send-call histogram and the totals of one finished transfer. The two halves of
+        a bidirectional event-loop transfer report separately, one of them with `transfers=0`.
+        """
+        with self.lock:
+            if histogram is not None:
+                self.latency.setdefault(protocol, LatencyHistogram()).merge(histogram)
+            if client_ip not in self.clients and len(self.clients) >= METRICS_MAX_CLIENTS:
+                client_ip = "other"
+            totals = self.clients.setdefault(client_ip, [0, 0, 0])
+            totals[0] += transfers
+            totals[1] += bytes_sent
+            totals[2] += bytes_received
+
+    def error(self, where, kind):
+        """
+        Counts an error in `where` (e.g. "tcp_handler") by its kind, the exception type name or
+        "InvalidRequest".
+        """
+        key = (where, kind)
+        with self.lock:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def render(self):
+        """
+        Returns:
+            list: Prometheus text exposition lines of these metrics.
+        """
+        with self.lock:
+            latency = {protocol: (list(histogram.counts), histogram.sum_ns)
+                       for protocol, histogram in self.latency.items()}
+            errors = dict(self.errors)
+            clients = {client: list(totals) for client, totals in self.clients.items()}
+        lines = ["# HELP speedtest_send_call_seconds Time spent in one send call.",
+                 "# TYPE speedtest_send_call_seconds histogram"]
+        for protocol, (counts, sum_ns) in sorted(latency.items()):
+            cumulative = 0
+            for bound, count in zip(SEND_LATENCY_BUCKETS + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'speedtest_send_call_seconds_bucket{{protocol="{protocol}",le="{bound}"}} {cumulative}')
+            lines.append(f'speedtest_send_call_seconds_sum{{protocol="{protocol}"}} {sum_ns / 1e9}')
+            lines.append(f'speedtest_send_call_seconds_count{{protocol="{protocol}"}} {cumulative}')
+        lines += ["# HELP speedtest_errors_total Exceptions caught by the server.",
+                  "# TYPE speedtest_errors_total counter"]
+        lines += [f'speedtest_errors_total{{where="{where}",type="{kind}"}} {count}'
+                  for (where, kind), count in sorted(errors.items())]
+        for index, name in enumerate(("transfers", "bytes_sent", "bytes_received")):
+            lines += [f"# HELP speedtest_client_{name}_total Per-client {name.replace('_', ' ')}.",
+                      f"# TYPE speedtest_client_{name}_total counter"]
+            lines += [f'speedtest_client_{name}_total{{client="{client}"}} {totals[index]}'
+                      for client, totals in sorted(clients.items())]
+        return lines
+
+
+metrics = ServerMetrics()  # Replaced by a fresh instance in every --workers process
+
+
+def render_counters(rows):
+    """
+    Prometheus text exposition lines of the transfer counters.
+
+    Args:
+        rows (list): (label text, `ServerCounters.snapshot()`) pairs, e.g. one per worker with
+            label text 'worker="0"', or a single pair with an empty label text.
+    """
+    lines = []
+    for name in COUNTER_NAMES:
+        gauge = name in GAUGE_NAMES
+        metric = f"speedtest_{name}" if gauge else f"speedtest_{name}_total"
+        lines += [f"# HELP {metric} {name.replace('_', ' ').capitalize()}.",
+                  f"# TYPE {metric} {'gauge' if gauge else 'counter'}"]
+        lines += [f"{metric}{{{labels}}} {row[name]}" if labels else f"{metric} {row[name]}" for labels, row in rows]
+    return lines
+
+
+def start_metrics_server(port, render):
+    """
+    Serves `render()` (a list of lines) as Prometheus text on http://METRICS_HOST:port/metrics
+    from a daemon thread.
+
+    Returns:
+        ThreadingHTTPServer: The running server.
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = ("\n".join(render()) + "\n").encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # Scrapes are not worth a console line
+            pass
+
+    server = ThreadingHTTPServer((METRICS_HOST, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(Colors.OKBLUE + f"Metrics served on http://{METRICS_HOST}:{port}/metrics" + Colors.ENDC)
+    return server
+
+
+# Console logging
+# Per-request messages go through a queue to a background thread, so a slow terminal never stalls a transfer.
+logger = logging.getLogger("speedtest.server")
+log_listener = None
+
+
+def start_console_log(enabled=CONSOLE_LOG):
+    """
+    Routes `log` through a queue drained by a background thread that writes to stdout,
+    or turns the console messages off. Called again in every --workers process.
+
+    Args:
+        enabled (bool): False drops every message without formatting it for output.
+    """
+    global log_listener
+    logger.handlers.clear()
+    logger.propagate = False
+    if not enabled:
+        logger.setLevel(logging.CRITICAL + 1)
+        return
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log_listener = logging.handlers.QueueListener(log_queue, handler)
+    log_listener.start()
+
+
+def stop_console_log():
+    """
+    Writes the queued messages and stops the background thread.
+    """
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+
+def log(message):
+    """
+    Queues one console message (see `start_console_log`).
+    """
+    logger.info(message)
+
+
+# Admission control and egress shaping
+# A spike of requests must not start a thread or a transfer each: transfers are admitted up to per-protocol and
+# per-client limits, the threads core runs them on a bounded pool, and everything else gets a REJECT right away.
+class AdmissionControl:
+    """
+    Caps the transfers served at once: `max_transfers` per protocol and `max_per_client` for one
+    client IP address (both protocols together). A limit of 0 does not cap.
+    """
+
+    def __init__(self, max_transfers=MAX_TRANSFERS, max_per_client=MAX_TRANSFERS_PER_CLIENT):
+        self.max_transfers = max_transfers
+        self.max_per_client = max_per_client
+        self.active = {"tcp": 0, "udp": 0}
+        self.clients = {}  # Client IP -> transfers it has running
+        self.lock = threading.Lock()
+
+    def admit(self, protocol, client_ip):
+        """
+        Admits one `protocol` ("tcp" or "udp") transfer of `client_ip` if both limits allow it.
+        Every admitted transfer must be released again.
+
+        Returns:
+            bool: True if the transfer may start.
+        """
+        with self.lock:
+            if self.max_transfers and self.active[protocol] >= self.max_transfers:
+                return False
+            if self.max_per_client and self.clients.get(client_ip, 0) >= self.max_per_client:
+                return False
+            self.active[protocol] += 1
+            self.clients[client_ip] = self.clients.get(client_ip, 0) + 1
+            return True
+
+    def release(self, protocol, client_ip):
+        """
+        Ends a transfer admitted by `admit`.
+        """
+        with self.lock:
+            self.active[protocol] -= 1
+            if self.clients[client_ip] > 1:
+                self.clients[client_ip] -= 1
+            else:
+                del self.clients[client_ip]
+
+
+class TransferPool:
+    """
+    Bounded executor of the threads core: at most `workers` daemon threads (started as they are
+    first needed) run the transfers, and at most `queue_limit` more wait for a free thread.
+    Sized to the admission limits of both protocols (see `configure_limits`), every admitted
+    transfer gets a thread right away; the queue only holds transfers beyond them when the
+    limits are off.
+    """
+
+    def __init__(self, workers=TRANSFER_WORKERS, queue_limit=TRANSFER_QUEUE):
+        self.workers = workers
+        self.jobs = queue.Queue(queue_limit)
+        self.started = 0
+        self.lock = threading.Lock()
+
+    def submit(self, function, *args):
+        """
+        Queues `function(*args)` for the next free worker thread.
+
+        Returns:
+            bool: False if the queue is full and the job was not accepted.
+        """
+        try:
+            self.jobs.put_nowait((function, args))
+        except queue.Full:
+            return False
+        with self.lock:
+            if self.started < self.workers:
+                self.started += 1
+                threading.Thread(target=self.run, daemon=True).start()
+        return True
+
+    def resize(self, workers):
+        """
+        Changes the number of worker threads the pool may start. Threads already started keep
+        running, so it is meant to be called before the first transfer.
+        """
+        with self.lock:
+            self.workers = workers
+
+    def run(self):
+        while True:
+            function, args = self.jobs.get()
+            function(*args)  # Handlers catch and log their own errors
+
+
+class EgressShaper:
+    """
+    Caps what all transfers together send at `rate_bps`. Every sending transfer paces itself with
+    a TokenBucket of its own, and whenever a transfer starts or ends the cap is split between the
+    buckets max-min fairly: a transfer that asked for a lower rate keeps it, the others share the
+    rest equally. Without a cap, only transfers that asked for a rate get a bucket.
+    """
+
+    def __init__(self, rate_bps=EGRESS_RATE_BPS):
+        self.rate = rate_bps / 8  # Bytes per second, 0 = no cap
+        self.flows = {}  # TokenBucket -> (requested rate in bytes/second or 0, smallest burst)
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def flow(self, rate_bps=0, min_burst=0):
+        """
+        Registers one sending transfer for the duration of the `with` block.
+
+        Args:
+            rate_bps (int): Rate the client asked for in bits/second, 0 = as fast as allowed.
+            min_burst (int): Bytes the transfer takes from its bucket at once (a batch or a chunk).
+
+        Yields:
+            TokenBucket: The bucket to pace the transfer with, or None if it is not paced.
+        """
+        demand = rate_bps / 8
+        if not self.rate:
+            yield TokenBucket(demand, max(min_burst, demand * UDP_PACING_BURST)) if demand else None
+            return
+        bucket = TokenBucket(demand or self.rate, min_burst)
+        with self.lock:
+            self.flows[bucket] = (demand, min_burst)
+            self.rebalance()
+        try:
+            yield bucket
+        finally:
+            with self.lock:
+                del self.flows[bucket]
+                self.rebalance()
+
+    def rebalance(self):
+        """
+        Sets the rate of every flow to its max-min fair share of the cap (called with the lock held).
+        """
+        remaining = self.rate
+        flows = sorted(self.flows.items(), key=lambda item: item[1][0] or float("inf"))
+        for index, (bucket, (demand, min_burst)) in enumerate(flows):
+            share = remaining / (len(flows) - index)
+            rate = min(demand, share) if demand else share
+            bucket.set_rate(rate, max(min_burst, rate * EGRESS_BURST))
+            remaining -= rate
+
+
+admission = AdmissionControl()
+transfer_pool = TransferPool()
+shaper = EgressShaper()
+
+
+def configure_limits(max_transfers=MAX_TRANSFERS, max_per_client=MAX_TRANSFERS_PER_CLIENT,
+                     egress_bps=EGRESS_RATE_BPS):
+    """
+    Replaces the admission limits and the egress cap of this process (called again in every
+    --workers process, each with its part of the egress cap), and sizes the transfer pool to
+    the transfers both protocols may run at once.
+    """
+    global admission, shaper
+    admission = AdmissionControl(max_transfers, max_per_client)
+    shaper = EgressShaper(egress_bps)
+    transfer_pool.resize(2 * max_transfers if max_transfers else TRANSFER_WORKERS)
+
+
+def start_transfer(protocol, client_ip, handler, *args):
+    """
+    Threads core: admits a `protocol` transfer of `client_ip` and queues `handler(*args)` on the
+    transfer pool, which releases the admission when the handler returns.
+
+    Returns:
+        bool: False if the transfer was rejected (a limit was reached or the pool queue is full).
+    """
+    if not admission.admit(protocol, client_ip):
+        return False
+    if transfer_pool.submit(run_admitted, protocol, client_ip, handler, args):
+        return True
+    admission.release(protocol, client_ip)
+    return False
+
+
+def run_admitted(protocol, client_ip, handler, args):
+    try:
+        handler(*args)
+    finally:
+        admission.release(protocol, client_ip)
+
+
+def reject_message():
+    """
+    Returns:
+        bytes: The REJECT message telling a client to retry after REJECT_RETRY_AFTER seconds.
+    """
+    return REJECT.pack(MAGIC_COOKIE, REJECT_TYPE, int(REJECT_RETRY_AFTER * 1000))
+
+
+def send_paced(engine, sock, nbytes, bucket, histogram=None, payload=None, offset=0):
+    """
+    Sends `nbytes` through a TCP send engine, one chunk at a time taken from `bucket` first.
+    Without a bucket the engine sends everything in one go. `payload` and `offset` are passed
+    on to the engine (see `PayloadPool`).
+
+    Returns:
+        int: Bytes sent.
+    """
+    if bucket is None:
+        return engine.send(sock, nbytes, histogram, payload, offset)
+    bytes_sent = 0
+    while bytes_sent < nbytes:
+        block = min(engine.chunk_size, nbytes - bytes_sent)
+        bucket.consume(block)
+        bytes_sent += engine.send(sock, block, histogram, payload, offset + bytes_sent)
+    return bytes_sent
+
+
+async def send_paced_async(engine, writer, nbytes, bucket, histogram=None, payload=None, offset=0):
+    """
+    Event-loop variant of `send_paced`.
+    """
+    if bucket is None:
+        return await engine.send_async(writer, nbytes, histogram, payload, offset)
+    bytes_sent = 0
+    while bytes_sent < nbytes:
+        block = min(engine.chunk_size, nbytes - bytes_sent)
+        delay = bucket.reserve(block)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        bytes_sent += await engine.send_async(writer, block, histogram, payload, offset + bytes_sent)
+    return bytes_sent
+
+
+# Transfer payload
+# Transfers send filler by default. On request they send a seeded pseudo-random pool instead, which compressing
+# middleboxes cannot shrink and which the client regenerates to check every byte that arrives.
+class PayloadPool:
+    """
+    The bytes a transfer sends, kept in one mmap'd temporary file shared by every transfer:
+    byte i of a transfer is byte i % `period` of the pool. The first `span` bytes are repeated
+    after the period, so the `span` bytes starting at any offset are one contiguous slice, as a
+    memoryview (`view`) or as a file range for `os.sendfile` (`position`), at no cost per chunk.
+    """
+
+    def __init__(self, content, span):
+        self.period = len(content)
+        self.span = span
+        size = self.period + span
+        self.file = tempfile.TemporaryFile()
+        self.file.truncate(size)
+        # Filled through a mapping so the pages are written once and stay in the page cache.
+        self.mapping = mmap.mmap(self.file.fileno(), size)
+        self.mapping[:] = (content * (size // self.period + 1))[:size]
+        self.data = memoryview(self.mapping)
+
+    def position(self, offset):
+        """Where the byte at transfer `offset` sits in the pool."""
+        return offset % self.period
+
+    def view(self, offset, nbytes):
+        """The `nbytes` (at most `span`) of the transfer starting at `offset`."""
+        position = offset % self.period
+        return self.data[position:position + nbytes]
+
+    def close(self):
+        self.data.release()
+        self.mapping.close()
+        self.file.close()
+
+
+random_pool = None
+random_pool_lock = threading.Lock()
+
+
+def random_payload():
+    """
+    Returns the random payload pool of this process, generated from PAYLOAD_SEED on first use.
+    It spans a whole period, so any send call of up to PAYLOAD_POOL_SIZE bytes is one slice.
+    """
+    global random_pool
+    with random_pool_lock:
+        if random_pool is None:
+            random_pool = PayloadPool(random.Random(PAYLOAD_SEED).randbytes(PAYLOAD_POOL_SIZE), PAYLOAD_POOL_SIZE)
+        return random_pool
 
 
 # Get the server's local IP address
@@ -67,154 +680,2089 @@ def udp_offer_broadcast():
                                 1)  # The socket broadcasts the message to all devices on the network
             # # udp_sock.bind(("0.0.0.0", 0))
             # udp_sock.bind(("0.0.0.0", BROADCAST_PORT))
-            print(Colors.OKBLUE + "UDP Broadcast started..."+ Colors.ENDC)
+            log(Colors.OKBLUE + "UDP Broadcast started..."+ Colors.ENDC)
             while True:
                 udp_sock.sendto(offer_message, ('<broadcast>',
                                                 BROADCAST_PORT))  # The socket sends the offer message (offer_message) to anyone listening on the UDP port.
                 time.sleep(BROADCAST_INTERVAL)  # The program waits a period of time before sending another message.
     except Exception as e:
-        print(Colors.FAIL + f"Error in UDP broadcast: {e}" + Colors.ENDC)
+        metrics.error("broadcast", type(e).__name__)
+        log(Colors.FAIL + f"Error in UDP broadcast: {e}" + Colors.ENDC)
 
 
 # Function to Start UDP Server
-def udp_server():
+def udp_server(reuse_port=False, udp_sock=None):
     """
     Starts the UDP server, binding it to the specified UDP port. The server listens for
-    incoming requests from clients and processes them in separate threads.
+    incoming requests from clients and processes them on the transfer pool's threads.
 
     This function runs indefinitely, accepting UDP packets, and delegating the processing
-    to the `handle_udp_request` function.
+    to the `handle_udp_request` function. Requests beyond the admission limits or the pool's
+    queue are answered with a REJECT message right away. The random payload pool is generated
+    up front, so no transfer waits for it.
+
+    Args:
+        reuse_port (bool): Bind with SO_REUSEPORT so several worker processes share the port.
+        udp_sock (socket.socket): An already bound UDP socket to serve on (e.g. an ephemeral
+            loopback port in the benchmarks) instead of binding SERVER_UDP_PORT.
     """
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_sock:
+        if udp_sock is None:
+            udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            if reuse_port:
+                udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             udp_sock.bind(("0.0.0.0", SERVER_UDP_PORT))
-            print(Colors.OKBLUE + f"UDP Server listening on port {SERVER_UDP_PORT}" + Colors.ENDC)
+        random_payload()
+        with udp_sock:
+            log(Colors.OKBLUE + f"UDP Server listening on port {udp_sock.getsockname()[1]}" + Colors.ENDC)
+            buffer = bytearray(BUFFER_SIZE)  # Reused for every datagram, requests are copied out of it
+            view = memoryview(buffer)
+            probe_views = {size: view[:size] for size in (PROBE.size, PROBE_TS.size)}
             while True:
-                data, client_address = udp_sock.recvfrom(
-                    BUFFER_SIZE)  # The data that the client sent is stored in data and the address of the client that sent the data is stored in client_address.
-                threading.Thread(target=handle_udp_request, args=(data, client_address), daemon=True).start()
+                length, client_address = udp_sock.recvfrom_into(
+                    buffer)  # The data that the client sent is stored in buffer and the address of the client that sent the data is stored in client_address.
+                if is_probe(buffer, length):  # Echoed right here, so the client's RTT does not include starting a thread
+                    if length == PROBE_TS.size:
+                        stamp_probe(buffer)
+                    try:
+                        udp_sock.sendto(probe_views[length], client_address)
+                    except OSError as e:  # A failed echo must not stop the UDP server
+                        metrics.error("udp_probe", type(e).__name__)
+                    continue
+                if start_transfer("udp", client_address[0], handle_udp_request, bytes(view[:length]), client_address):
+                    continue
+                counters.add(udp_rejected=1)
+                log(Colors.WARNING + f"UDP request from {client_address} rejected, the server is at capacity."
+                    + Colors.ENDC)
+                try:
+                    udp_sock.sendto(reject_message(), client_address)
+                except OSError as e:
+                    metrics.error("udp_reject", type(e).__name__)
     except Exception as e:
-        print(Colors.FAIL + f"Error in UDP server: {e}" + Colors.ENDC)
+        metrics.error("udp_server", type(e).__name__)
+        log(Colors.FAIL + f"Error in UDP server: {e}" + Colors.ENDC)
 
 
-# UDP Request Handler
-def handle_udp_request(data, client_address):
+# UDP request parsing
+def is_probe(data, length=None):
     """
-    Handles incoming UDP requests, validates the data, and sends file segments to the client.
+    Checks whether a UDP datagram is an RTT probe, which the server echoes back instead of parsing it as a request.
 
-    The function processes the request by checking the magic cookie and message type,
-    then sends the requested file in segments, each with a header containing information
-    such as the total number of segments and the current segment number.
+    Args:
+        data (bytes): The data received on the UDP port.
+        length (int): Length of the datagram when `data` is a larger receive buffer, defaults to len(data).
+
+    Returns:
+        bool: True if the datagram is a well formed PROBE or PROBE_TS message.
+    """
+    length = len(data) if length is None else length
+    return ((length == PROBE.size or length == PROBE_TS.size)
+            and MESSAGE_HEADER.unpack_from(data) == (MAGIC_COOKIE, PROBE_TYPE))
+
+
+def stamp_probe(buffer):
+    """
+    Writes the server's receive time into a PROBE_TS message in place, just before it is echoed.
+    """
+    TIMESTAMP.pack_into(buffer, PROBE_SERVER_TIME_OFFSET, time.perf_counter_ns())
+
+
+def is_stop(data):
+    """
+    Checks whether a datagram is the STOP_TYPE message a client sends to end a stream.
+    """
+    return len(data) == MESSAGE_HEADER.size and MESSAGE_HEADER.unpack(data) == (MAGIC_COOKIE, STOP_TYPE)
+
+
+def stream_deadline_ns(duration_ms):
+    """
+    Returns the `time.perf_counter_ns` value at which a stream of `duration_ms` milliseconds
+    ends, capped at STREAM_MAX_DURATION.
+    """
+    return time.perf_counter_ns() + min(duration_ms, STREAM_MAX_DURATION * 1000) * 1_000_000
+
+
+def parse_udp_request(data):
+    """
+    Validates a UDP request packet and extracts the requested file size and options.
 
     Args:
         data (bytes): The data received in the UDP request.
-        client_address (tuple): The address of the client sending the request.
+
+    Returns:
+        dict: The request fields ('file_size', 'mode' from UDP_REQUEST_MODES plus every name in
+        UDP_REQUEST_OPTIONS, missing options default to 0), or None if the packet is not a valid request
+        or asks for more than MAX_FILE_SIZE bytes.
     """
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_sock:
-            if len(data) != 13:  # Magic cookie - 4 B, Message type - 1 B and File size - 8 B
-                print(Colors.FAIL + "Invalid UDP request." + Colors.ENDC)
-                return
+    offset = struct.calcsize(UDP_REQUEST_FORMAT)
+    if len(data) < offset:
+        metrics.error("udp_request", "InvalidRequest")
+        log(Colors.FAIL + "Invalid UDP request." + Colors.ENDC)
+        return None
 
-            magic_cookie, msg_type, file_size = struct.unpack('!IBQ',
-                                                              data)  # Information return back to parts Magic cookie, Message type and File size.
-            if magic_cookie != MAGIC_COOKIE or msg_type != REQUEST_TYPE:
-                print(Colors.FAIL + "Invalid UDP request header." + Colors.ENDC)
-                return
+    magic_cookie, msg_type, file_size = struct.unpack_from(UDP_REQUEST_FORMAT,
+                                                           data)  # Information return back to parts Magic cookie, Message type and File size.
+    if magic_cookie != MAGIC_COOKIE or msg_type not in UDP_REQUEST_MODES:
+        metrics.error("udp_request", "InvalidRequest")
+        log(Colors.FAIL + "Invalid UDP request header." + Colors.ENDC)
+        return None
+    if file_size > MAX_FILE_SIZE:  # One small packet must not commit the server to an unbounded transfer
+        metrics.error("udp_request", "InvalidRequest")
+        log(Colors.FAIL + f"UDP request for {file_size} bytes is above MAX_FILE_SIZE." + Colors.ENDC)
+        return None
+
+    request = {'file_size': file_size, 'mode': UDP_REQUEST_MODES[msg_type]}
+    for name, option_format in UDP_REQUEST_OPTIONS:
+        option_size = struct.calcsize(option_format)
+        if offset + option_size <= len(data):
+            request[name], = struct.unpack_from(option_format, data, offset)
+            offset += option_size
+        else:
+            request[name] = 0
+    if offset != len(data):  # Trailing bytes that are not a whole option
+        metrics.error("udp_request", "InvalidRequest")
+        log(Colors.FAIL + "Invalid UDP request." + Colors.ENDC)
+        return None
+    return request
 
-            print(Colors.OKCYAN + f"UDP request received for {file_size} bytes from {client_address}" + Colors.ENDC)
-            total_segments = (file_size + BUFFER_SIZE - 1) // BUFFER_SIZE  # Calculating the number of segments required to send the file
 
-            for segment_number in range(total_segments):
-                payload_header = struct.pack('!IBQQ', MAGIC_COOKIE, PAYLOAD_TYPE, total_segments,
-                                             segment_number)  # Packing data into a binary structure (to send it over the network)
-                # Create the payload for the current segment, ensuring it doesn't exceed the remaining file size
-                # The payload consists of 'B' characters, and its length is determined by the smallest of BUFFER_SIZE or the remaining file size.
-                payload = b'B' * min(BUFFER_SIZE, file_size - (segment_number * BUFFER_SIZE))
-                udp_sock.sendto(payload_header + payload,
-                                client_address)  # The information is sent (the header + payload) to the client address via UDP.
+def request_timestamps(request):
+    """
+    Whether the client asked for timestamped payload segments (PAYLOAD_TS_TYPE).
+    """
+    return bool(request['flags'] & REQUEST_FLAG_TIMESTAMPS)
 
-            print(Colors.OKGREEN + f"UDP transfer to {client_address} completed." + Colors.ENDC)
 
-    except Exception as e:
-        print(Colors.FAIL + f"Error in UDP request handler: {e}" + Colors.ENDC)
+def request_payload(request):
+    """
+    The payload the client asked for: the random pool with REQUEST_FLAG_RANDOM, otherwise None (filler).
+    """
+    return random_payload() if request['flags'] & REQUEST_FLAG_RANDOM else None
 
 
-## TCP
-# Function to Start TCP Server
-def tcp_server():
+def request_segment_size(request):
     """
-    Starts the TCP server, listening for incoming TCP connections on the specified TCP port.
+    Payload bytes per datagram of a download: what the client asked for, BUFFER_SIZE if it did not.
+    """
+    return min(request['segment_size'] or BUFFER_SIZE, UDP_MAX_SEGMENT)
+
 
-    The server accepts new client connections, and for each connection, it creates a
-    new thread to handle the client request. The client request involves receiving a
-    file size and sending the corresponding number of bytes.
+def request_reliable(request):
     """
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_sock:  # create TCP socket and use IPv4 protocol
-            tcp_sock.bind(("0.0.0.0", SERVER_TCP_PORT))
-            tcp_sock.listen()  # Server wait to TCP request
-            print(Colors.OKBLUE + f"TCP Server listening on port {SERVER_TCP_PORT}" + Colors.ENDC)
+    Whether the client asked for a reliable download, repaired through its NACKs (REQUEST_FLAG_RELIABLE).
+    """
+    return bool(request['flags'] & REQUEST_FLAG_RELIABLE) and not request['duration_ms']
 
-            while True:
-                client_socket, client_address = tcp_sock.accept()  # Accepts a new TCP connection, returns a client socket and client address
-                print(Colors.WARNING + f"New TCP connection from {client_address}" + Colors.ENDC)
-                threading.Thread(target=handle_tcp_client, args=(client_socket,), daemon=True).start()
-    except Exception as e:
-        print(Colors.FAIL + f"Error in TCP server: {e}" + Colors.ENDC)
 
+class TokenBucket:
+    """
+    Token-bucket rate limiter: tokens (bytes) refill at `rate` per second up to `burst`.
+    Taking more tokens than available leaves the bucket in debt, so the long-run rate is exact
+    even when callers take whole batches at a time.
+    """
 
-# TCP Client Handler Function
-def handle_tcp_client(client_socket):
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.perf_counter()
+        self.lock = threading.Lock()  # The egress shaper changes the rate from other transfers' threads
+
+    def refill(self):
+        now = time.perf_counter()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def reserve(self, amount):
+        """
+        Takes `amount` tokens from the bucket.
+
+        Returns:
+            float: Seconds the caller has to wait before sending, 0 if it may send right away.
+        """
+        with self.lock:
+            self.refill()
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def set_rate(self, rate, burst):
+        """
+        Changes the refill rate and burst, crediting the tokens earned at the old rate so far.
+        """
+        with self.lock:
+            self.refill()
+            self.rate = rate
+            self.burst = burst
+
+    def consume(self, amount):
+        """
+        Takes `amount` tokens, sleeping until the bucket allows the send.
+        """
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class UdpSegmentBatcher:
     """
-    Handles incoming TCP client connections, receives the requested file size from
-    the client, and sends the file in chunks of a specified buffer size.
+    Builds the datagrams of one UDP transfer in place inside a single reusable buffer.
 
-    The function ensures that the file is sent in full, and each chunk is sent until
-    the complete file size is reached.
+    The buffer holds `batch_size` back-to-back datagrams of PAYLOAD_HEADER + `segment_size` bytes
+    (PAYLOAD_TS_HEADER with `timestamps`). Headers and 'B' filler are written once; each batch
+    only rewrites the segment numbers (and send times) with `pack_into`, so no bytes object is
+    created or copied per datagram. A batch is laid out exactly as UDP segmentation offload
+    expects it (equal strides, shorter last datagram). A `file_size` of None produces an endless
+    stream of full segments whose total segment count is 0. With a `payload` pool, segment k
+    carries bytes k * segment_size onwards of the pool, copied into its slot for every batch.
+    """
 
-    Args:
-        client_socket (socket.socket): The socket object representing the client connection.
+    def __init__(self, file_size, batch_size=UDP_BATCH_SIZE, timestamps=False, payload=None, segment_size=BUFFER_SIZE):
+        self.file_size = file_size
+        self.payload = payload
+        self.segment_size = segment_size
+        if file_size is None:
+            self.total_segments = None
+        else:
+            self.total_segments = (file_size + segment_size - 1) // segment_size  # Calculating the number of segments required to send the file
+        self.timestamps = timestamps
+        self.header = PAYLOAD_TS_HEADER if timestamps else PAYLOAD_HEADER
+        self.stride = self.header.size + segment_size
+        self.batch_size = max(1, min(batch_size, UDP_MAX_DATAGRAM // self.stride))
+        self.buffer = bytearray(b'B' * (self.stride * self.batch_size))
+        for slot in range(self.batch_size):
+            if timestamps:
+                PAYLOAD_TS_HEADER.pack_into(self.buffer, slot * self.stride, MAGIC_COOKIE, PAYLOAD_TS_TYPE,
+                                            self.total_segments or 0, 0, 0)
+            else:
+                PAYLOAD_HEADER.pack_into(self.buffer, slot * self.stride, MAGIC_COOKIE, PAYLOAD_TYPE,
+                                         self.total_segments or 0, 0)
+        self.view = memoryview(self.buffer)
+        self.slots = [self.view[slot * self.stride:(slot + 1) * self.stride] for slot in range(self.batch_size)]
+        self.next_segment = 0
+        self.count = 0  # Datagrams in the current batch
+        self.repaired = 0  # Segments sent again for a reliable download
+        self.repaired_bytes = 0
+
+    def next_batch(self):
+        """
+        Prepares the next batch of segments in the buffer.
+
+        Returns:
+            int: Number of bytes in the batch (`view[:nbytes]`), 0 once every segment was produced.
+        """
+        first = self.next_segment
+        if self.total_segments is None:
+            self.count = self.batch_size
+        else:
+            self.count = min(self.batch_size, self.total_segments - first)
+        if self.count <= 0:
+            return 0
+        buffer = self.buffer
+        pack_into = SEGMENT_NUMBER.pack_into
+        for slot in range(self.count):
+            pack_into(buffer, slot * self.stride + SEGMENT_NUMBER_OFFSET, first + slot)
+        if self.payload is not None:
+            self.fill(0, first, self.count)
+        self.next_segment = first + self.count
+        nbytes = self.count * self.stride
+        if self.next_segment == self.total_segments:  # The last segment only carries what is left of the file
+            nbytes -= self.total_segments * self.segment_size - self.file_size
+        return nbytes
+
+    def fill(self, first_slot, first_segment, count):
+        """
+        Copies the payload of `count` consecutive segments into consecutive slots of the batch.
+        """
+        buffer = self.buffer
+        view = self.payload.view
+        segment_size = self.segment_size
+        start = first_slot * self.stride + self.header.size
+        for segment in range(first_segment, first_segment + count):
+            buffer[start:start + segment_size] = view(segment * segment_size, segment_size)
+            start += self.stride
+
+    def stamp(self, first_slot=0, last_slot=None):
+        """
+        Writes the current time as the send timestamp of the datagrams in the given slots of the
+        batch (all of them by default). Does nothing without `timestamps`.
+        """
+        if not self.timestamps:
+            return
+        now = time.perf_counter_ns()
+        for slot in range(first_slot, self.count if last_slot is None else last_slot + 1):
+            TIMESTAMP.pack_into(self.buffer, slot * self.stride + SEND_TIME_OFFSET, now)
+
+    def datagrams(self, nbytes):
+        """
+        Yields the datagrams of the batch prepared by `next_batch` as memoryviews into the buffer,
+        each stamped with its send time right before it is yielded when `timestamps` is set.
+
+        Args:
+            nbytes (int): The value returned by `next_batch`.
+        """
+        last = self.count - 1
+        for slot in range(last):
+            self.stamp(slot, slot)
+            yield self.slots[slot]
+        self.stamp(last, last)
+        yield self.view[last * self.stride:nbytes]
+
+    def repair_batch(self, repairs):
+        """
+        Prepares a batch of segments taken from the front of a `RepairQueue` (and charged to its
+        budget) instead of the next new ones. The short last segment of the file always ends its
+        batch, which keeps the layout valid for UDP segmentation offload.
+
+        Returns:
+            int: Number of bytes in the batch, 0 if nothing is waiting to be resent.
+        """
+        buffer = self.buffer
+        pack_into = SEGMENT_NUMBER.pack_into
+        slot = 0
+        short = 0
+        while slot < self.batch_size:
+            taken = repairs.take(self.batch_size - slot)
+            if taken is None:
+                break
+            first, take = taken
+            if self.payload is not None:
+                self.fill(slot, first, take)
+            for segment in range(first, first + take):
+                pack_into(buffer, slot * self.stride + SEGMENT_NUMBER_OFFSET, segment)
+                slot += 1
+            if first + take == self.total_segments:
+                short = self.total_segments * self.segment_size - self.file_size
+                break
+        self.count = slot
+        nbytes = slot * self.stride - short
+        self.repaired += slot
+        self.repaired_bytes += nbytes
+        return nbytes
+
+    def pace(self, bucket):
+        """
+        Shrinks the batches to one pacing quantum of `bucket`, so a paced transfer is spread out
+        instead of bursty.
+        """
+        self.batch_size = max(1, min(self.batch_size, int(bucket.rate * UDP_PACING_QUANTUM) // self.stride))
+
+    @property
+    def bytes_sent(self):
+        """Datagram bytes of the segments produced so far (resent ones included), headers included."""
+        payload = self.next_segment * self.segment_size
+        if self.file_size is not None:
+            payload = min(payload, self.file_size)
+        return self.next_segment * self.header.size + payload + self.repaired_bytes
+
+    @property
+    def datagrams_sent(self):
+        return self.next_segment + self.repaired
+
+
+class RepairQueue:
     """
-    try:
-        data = client_socket.recv(
-            BUFFER_SIZE).decode().strip()  # Receive data from the client, decode it to a string, and strip any whitespace or newline characters.
-        if not data.isdigit():
-            print(Colors.FAIL + "Invalid TCP request received." + Colors.ENDC)
+    Segments a reliable UDP download has to send again, kept as a sorted list of disjoint
+    half-open (start, end) ranges built from the client's NACKs: a burst of a million lost
+    segments is one entry, and a range the client asks for again while it is still waiting
+    here is merged rather than queued twice. What one transfer may resend is capped at
+    NACK_REPAIR_BUDGET times its segment count, charged as segments are taken to be sent, so a
+    client cannot make the server send without end.
+    """
+
+    def __init__(self, total_segments):
+        self.total_segments = total_segments
+        self.ranges = []
+        self.budget = total_segments * NACK_REPAIR_BUDGET
+        self.requested = 0  # Distinct segments queued so far, a range asked for again while pending counts once
+        self.nacks = 0  # NACK messages received
+        self.finished = False  # The client sent FIN_TYPE, it has every segment
+        self.exhausted = False  # The client asked for more than the budget allows, the transfer failed
+
+    @property
+    def pending(self):
+        """Segments waiting to be resent."""
+        return sum(end - start for start, end in self.ranges)
+
+    def add(self, first, end):
+        """
+        Queues segments [first, end) (clipped to the transfer), merged with the queued ranges
+        they overlap or touch.
+        """
+        end = min(end, self.total_segments)
+        if first >= end:
             return
+        ranges = self.ranges
+        index = bisect.bisect_left(ranges, (first,))
+        if index and ranges[index - 1][1] >= first:
+            index -= 1
+            first = ranges[index][0]
+        stop = index
+        queued = 0
+        while stop < len(ranges) and ranges[stop][0] <= end:
+            queued += ranges[stop][1] - ranges[stop][0]
+            end = max(end, ranges[stop][1])
+            stop += 1
+        ranges[index:stop] = [(first, end)]
+        self.requested += end - first - queued
 
-        file_size = int(data)
-        print(Colors.OKCYAN + f"TCP request received for {file_size} bytes." + Colors.ENDC)
-        # if data is not number:
-        # try:
-        #     file_size = int(data)
-        # except ValueError:
-        #     print("Invalid input received, expected a number.")
-        #     client_socket.close()
-        #     return
+    def take(self, limit):
+        """
+        Takes up to `limit` consecutive segments from the front of the queue and charges them to
+        the budget. Once the budget is spent, the queue is emptied and marked `exhausted`.
 
-        bytes_sent = 0
-        while bytes_sent < file_size:  # Check that the entire file has been sent to the client in full.
-            chunk = b'A' * min(BUFFER_SIZE, file_size - bytes_sent)
-            client_socket.sendall(chunk)
-            bytes_sent += len(chunk)
+        Returns:
+            tuple: (first segment, number of segments), None if nothing can be resent.
+        """
+        if not self.ranges:
+            return None
+        if self.budget <= 0:
+            self.ranges.clear()
+            self.exhausted = True
+            return None
+        first, end = self.ranges[0]
+        take = min(end - first, limit, self.budget)
+        if first + take == end:
+            del self.ranges[0]
+        else:
+            self.ranges[0] = (first + take, end)
+        self.budget -= take
+        return first, take
 
-        print(Colors.OKGREEN + f"TCP transfer completed. {file_size} bytes sent." + Colors.ENDC)
-    except Exception as e:
-        print(Colors.FAIL + f"Error handling TCP connection: {e}" + Colors.ENDC)
-    finally:
-        client_socket.close()
+    def pacer(self, segments_sent, stride, elapsed_ns):
+        """
+        A token bucket for an unpaced transfer that started losing segments: the rate its client
+        took the segments sent so far at, those it asked for again left out, so the repairs and
+        the rest of the transfer are not lost as fast as the first burst was.
 
+        Args:
+            segments_sent (int): Segments sent so far, resent ones included.
+            stride (int): Bytes of one datagram.
+            elapsed_ns (int): Nanoseconds since the transfer started.
 
-# Main function to start both servers
-def main():
+        Returns:
+            TokenBucket: The bucket to pace the rest of the transfer with.
+        """
+        delivered = max(segments_sent - self.requested, 1) * stride
+        rate = max(delivered * 1e9 / max(elapsed_ns, 1), stride / UDP_PACING_QUANTUM)
+        return TokenBucket(rate, max(stride, rate * UDP_PACING_BURST))
+
+    def receive(self, data, length):
+        """
+        Takes one control message from the client: a NACK queues its ranges, FIN_TYPE marks the
+        transfer finished, anything else is ignored.
+        """
+        if length < MESSAGE_HEADER.size:
+            return
+        magic_cookie, msg_type = MESSAGE_HEADER.unpack_from(data)
+        if magic_cookie != MAGIC_COOKIE:
+            return
+        if msg_type == FIN_TYPE:
+            self.finished = True
+            return
+        if msg_type != NACK_TYPE or length < NACK_HEADER.size:
+            return
+        count = NACK_HEADER.unpack_from(data)[2]
+        if length != NACK_HEADER.size + count * NACK_RANGE.size:
+            return
+        self.nacks += 1
+        for first, number in NACK_RANGE.iter_unpack(memoryview(data)[NACK_HEADER.size:length]):
+            self.add(first, first + number)
+
+
+def log_repairs(client_address, repairs, datagrams):
     """
-    Main entry point for the server application.
+    Logs how a reliable download ended and what it took to repair it.
     """
-    print(Colors.HEADER + f"Server started, listening on IP address {get_local_ip()}" + Colors.ENDC)
-    threading.Thread(target=udp_offer_broadcast, daemon=True).start()
-    threading.Thread(target=udp_server, daemon=True).start()
-    tcp_server()
+    resent = datagrams - repairs.total_segments
+    if repairs.exhausted:
+        log(Colors.WARNING + f"Reliable UDP transfer to {client_address} failed: {repairs.nacks} NACKs asked for more "
+            f"than the repair budget of {repairs.total_segments * NACK_REPAIR_BUDGET} segments." + Colors.ENDC)
+        return
+    ending = "confirmed by the client" if repairs.finished else "the client went quiet"
+    log(Colors.OKCYAN + f"Reliable UDP transfer to {client_address}: {repairs.nacks} NACKs, {resent} segments resent, "
+        f"{ending}." + Colors.ENDC)
+
+
+def receive_repairs(udp_sock, client_address, buffer, repairs, timeout=0):
+    """
+    Feeds the messages `client_address` sent to the session socket of a reliable download into
+    `repairs`, waiting up to `timeout` seconds for the first one. Waits with `select`, so the
+    socket stays in blocking mode for the sender.
+
+    Returns:
+        bool: True if a message from the client arrived.
+    """
+    received = False
+    while select.select([udp_sock], [], [], timeout)[0]:
+        length, address = udp_sock.recvfrom_into(buffer)
+        if address == client_address:
+            repairs.receive(buffer, length)
+            received = True
+        timeout = 0
+    return received
+
+
+def enable_udp_segmentation(udp_sock, segment_size):
+    """
+    Turns on UDP segmentation offload for `udp_sock`, letting one send call carry many
+    datagrams of `segment_size` bytes. Only available on Linux 4.18 and later.
+
+    Returns:
+        bool: True if the option was accepted by the kernel.
+    """
+    if not hasattr(socket, "SOL_UDP"):
+        return False
+    try:
+        udp_sock.setsockopt(socket.SOL_UDP, UDP_SEGMENT, segment_size)
+        return True
+    except OSError:
+        return False
+
+
+def send_udp_file(udp_sock, client_address, file_size, rate_bps=0, histogram=None, timestamps=False, stop=None,
+                  deadline_ns=None, repairs=None, payload=None, segment_size=BUFFER_SIZE):
+    """
+    Sends the segments of a `file_size` bytes file to `client_address`, a whole batch per send
+    call where the kernel supports UDP segmentation offload and one datagram per call otherwise.
+
+    Args:
+        udp_sock (socket.socket): The UDP socket to send from.
+        client_address (tuple): The address of the client that sent the request.
+        file_size (int): The size of the requested file.
+        rate_bps (int): Target rate in bits/second, paced with a token bucket; 0 sends unpaced
+            (or at the transfer's share of the egress cap, see `EgressShaper`).
+        histogram (LatencyHistogram): Records the time of every send call when given.
+        timestamps (bool): Send PAYLOAD_TS_TYPE segments carrying their send time.
+        stop (threading.Event): For a stream (`file_size` None), ends it once set.
+        deadline_ns (int): For a stream, the `time.perf_counter_ns` value at which it ends.
+        repairs (RepairQueue): For a reliable download: the client's NACKs are read from `udp_sock`
+            into it and the missing segments resent ahead of new ones, an unpaced transfer is paced
+            from its first NACK on (see `RepairQueue.pacer`); once everything was sent the transfer
+            waits for NACKs until the client's FIN or NACK_LINGER seconds of silence, and it fails
+            once the client asks for more than the repair budget.
+        payload (PayloadPool): What the segments carry, None = filler.
+        segment_size (int): Payload bytes per datagram.
+
+    Returns:
+        tuple: Number of datagrams and bytes sent.
+    """
+    stride = (PAYLOAD_TS_HEADER if timestamps else PAYLOAD_HEADER).size + segment_size
+    with shaper.flow(rate_bps, stride) as bucket:
+        return send_udp_batches(udp_sock, client_address, file_size, bucket, histogram or LatencyHistogram(),
+                                timestamps, stop, deadline_ns, repairs, payload, segment_size)
+
+
+def send_udp_batches(udp_sock, client_address, file_size, bucket, histogram, timestamps, stop, deadline_ns,
+                     repairs=None, payload=None, segment_size=BUFFER_SIZE):
+    """
+    The send loop of `send_udp_file`, paced with `bucket` when it is not None.
+    """
+    batcher = UdpSegmentBatcher(file_size, UDP_BATCH_SIZE, timestamps, payload, segment_size)
+    if bucket is not None:
+        batcher.pace(bucket)
+    segmented = batcher.batch_size > 1 and enable_udp_segmentation(udp_sock, batcher.stride)
+    control = bytearray(BUFFER_SIZE) if repairs is not None else None  # NACKs of a reliable download land here
+    first_send_ns = time.perf_counter_ns()
+
+    while True:
+        if stop is not None and (stop.is_set() or time.perf_counter_ns() >= deadline_ns):
+            break
+        nbytes = 0
+        if repairs is not None:
+            receive_repairs(udp_sock, client_address, control, repairs)
+            if repairs.finished:
+                break
+            if bucket is None and repairs.nacks:
+                # Losing segments unpaced: pace the repairs and the rest at the rate the client keeps up with
+                bucket = repairs.pacer(batcher.datagrams_sent, batcher.stride, time.perf_counter_ns() - first_send_ns)
+                batcher.pace(bucket)
+            nbytes = batcher.repair_batch(repairs)
+            if repairs.exhausted:
+                break
+        if not nbytes:
+            nbytes = batcher.next_batch()
+        if not nbytes:
+            if repairs is None:
+                break
+            if not receive_repairs(udp_sock, client_address, control, repairs, NACK_LINGER):
+                break  # The client went quiet without its FIN
+            continue
+        if bucket is not None:
+            bucket.consume(nbytes)
+        if segmented:
+            try:
+                batcher.stamp()  # The whole batch leaves in this one call
+                start_ns = time.perf_counter_ns()
+                udp_sock.sendto(batcher.view[:nbytes], client_address)
+                histogram.observe(start_ns)
+                continue
+            except OSError as e:
+                if e.errno not in (errno.EIO, errno.EINVAL, errno.EMSGSIZE, errno.EOPNOTSUPP):
+                    raise
+                # The route cannot offload segmentation, fall back to one datagram per send call
+                segmented = False
+                udp_sock.setsockopt(socket.SOL_UDP, UDP_SEGMENT, 0)
+        for datagram in batcher.datagrams(nbytes):
+            start_ns = time.perf_counter_ns()
+            udp_sock.sendto(datagram,
+                            client_address)  # The information is sent (the header + payload) to the client address via UDP.
+            histogram.observe(start_ns)
+    return batcher.datagrams_sent, batcher.bytes_sent
+
+
+def watch_udp_stop(udp_sock, client_address, stop):
+    """
+    Sets `stop` once `client_address` sends a STOP_TYPE message to the socket of a stream, or
+    once the stream ended by itself. Waits with `select`, so the socket stays in blocking mode
+    for the sender.
+    """
+    buffer = bytearray(BUFFER_SIZE)
+    try:
+        while not stop.is_set():
+            readable, _, _ = select.select([udp_sock], [], [], UDP_IDLE_TIMEOUT)
+            if not readable:
+                continue
+            length, address = udp_sock.recvfrom_into(buffer, 0, socket.MSG_DONTWAIT)
+            if address == client_address and is_stop(buffer[:length]):
+                stop.set()
+    except (OSError, ValueError):  # The stream ended and its socket was closed
+        pass
+
+
+# UDP uploads
+class UploadReceiver:
+    """
+    Accounts for the datagrams of one UDP upload: unique segments (one bit per segment in a
+    bytearray, sized from a request already checked against MAX_FILE_SIZE), their payload bytes and every payload datagram, timed from the first to the
+    last payload datagram. Datagrams are only parsed in place, never copied.
+    """
+
+    def __init__(self, total_segments):
+        self.total_segments = total_segments
+        self.seen = bytearray((total_segments + 7) // 8)
+        self.unique = 0
+        self.datagrams = 0
+        self.goodput_bytes = 0
+        self.first_ns = None
+        self.last_ns = None
+        self.finished = total_segments == 0
+
+    def record(self, data, length):
+        """
+        Accounts for one datagram held in `data[:length]`.
+
+        Returns:
+            bool: True once every segment arrived or the client sent FIN_TYPE.
+        """
+        if length < MESSAGE_HEADER.size:
+            return self.finished
+        magic_cookie, msg_type = MESSAGE_HEADER.unpack_from(data)
+        if magic_cookie != MAGIC_COOKIE:
+            return self.finished
+        if msg_type == FIN_TYPE:
+            self.finished = True
+        elif msg_type == PAYLOAD_TYPE and length >= PAYLOAD_HEADER.size:
+            now_ns = time.perf_counter_ns()
+            if self.first_ns is None:
+                self.first_ns = now_ns
+            self.last_ns = now_ns
+            self.datagrams += 1
+            segment, = SEGMENT_NUMBER.unpack_from(data, SEGMENT_NUMBER_OFFSET)
+            mask = 1 << (segment & 7)
+            if segment < self.total_segments and not self.seen[segment >> 3] & mask:
+                self.seen[segment >> 3] |= mask
+                self.unique += 1
+                self.goodput_bytes += length - PAYLOAD_HEADER.size
+                if self.unique == self.total_segments:
+                    self.finished = True
+        return self.finished
+
+    def result(self):
+        """
+        Returns:
+            bytes: The RESULT_FRAME sent back to the client.
+        """
+        elapsed_ns = self.last_ns - self.first_ns if self.first_ns is not None else 0
+        return RESULT_FRAME.pack(MAGIC_COOKIE, RESULT_TYPE, self.goodput_bytes, self.unique, elapsed_ns)
+
+
+def receive_udp_upload(udp_sock, client_address, receiver):
+    """
+    Receives the datagrams of an upload from `client_address` into one reusable buffer until
+    the receiver is finished or the client is silent for UDP_IDLE_TIMEOUT seconds.
+
+    Args:
+        udp_sock (socket.socket): The session socket the client sends the upload to.
+        client_address (tuple): The address of the uploading client.
+        receiver (UploadReceiver): Accounts for the received datagrams.
+    """
+    buffer = bytearray(PAYLOAD_HEADER.size + BUFFER_SIZE)
+    udp_sock.settimeout(UDP_IDLE_TIMEOUT)
+    while not receiver.finished:
+        try:
+            length, address = udp_sock.recvfrom_into(buffer)
+        except socket.timeout:
+            break
+        if address == client_address:
+            receiver.record(buffer, length)
+
+
+def serve_udp_upload(udp_sock, client_address, request):
+    """
+    Serves an upload or bidirectional UDP request from a session socket of its own: echoes the
+    request header to tell the client where to send, receives the upload (while sending the
+    download on another thread for "bidir") and answers with a RESULT_FRAME.
+
+    Args:
+        udp_sock (socket.socket): A new, unbound UDP socket for this transfer.
+        client_address (tuple): The address of the client that sent the request.
+        request (dict): The request as returned by `parse_udp_request`.
+
+    Returns:
+        UploadReceiver: What was received.
+    """
+    file_size = request['file_size']
+    bidir = request['mode'] == "bidir"
+    udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UPLOAD_RCVBUF)
+    udp_sock.sendto(struct.pack(UDP_REQUEST_FORMAT, MAGIC_COOKIE, BIDIR_TYPE if bidir else UPLOAD_TYPE, file_size),
+                    client_address)  # Also binds the socket, so the client learns the session address from it
+    receiver = UploadReceiver((file_size + BUFFER_SIZE - 1) // BUFFER_SIZE)
+    histogram = LatencyHistogram()
+    sent = []
+    sender = None
+    if bidir:
+        sender = threading.Thread(
+            target=lambda: sent.append(send_udp_file(udp_sock, client_address, file_size, request['rate_bps'],
+                                                     histogram, request_timestamps(request),
+                                                     payload=request_payload(request))),
+            daemon=True)
+        sender.start()
+    receive_udp_upload(udp_sock, client_address, receiver)
+    if sender is not None:
+        sender.join()
+    result = receiver.result()
+    for _ in range(UDP_RESULT_COPIES):
+        udp_sock.sendto(result, client_address)
+    datagrams, bytes_sent = sent[0] if sent else (0, 0)
+    counters.add(udp_transfers=1, datagrams_sent=datagrams, bytes_sent=bytes_sent,
+                 datagrams_received=receiver.datagrams, bytes_received=receiver.goodput_bytes)
+    metrics.transfer_finished("udp", client_address[0], histogram if bidir else None, bytes_sent,
+                              receiver.goodput_bytes)
+    return receiver
+
+
+# UDP Request Handler
+def handle_udp_request(data, client_address):
+    """
+    Handles incoming UDP requests, validates the data, and sends file segments to the client.
+
+    The function processes the request by checking the magic cookie and message type,
+    then sends the requested file in segments, each with a header containing information
+    such as the total number of segments and the current segment number. Requests that
+    carry a target rate are paced to that rate, reliable requests are repaired from the
+    client's NACKs. Upload and bidirectional requests are handed to `serve_udp_upload`.
+
+    Args:
+        data (bytes): The data received in the UDP request.
+        client_address (tuple): The address of the client sending the request.
+    """
+    counters.add(active_udp_transfers=1)
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_sock:
+            request = parse_udp_request(data)
+            if request is None:
+                return
+
+            file_size = request['file_size']
+            if request['mode'] != "download":
+                log(Colors.OKCYAN + f"UDP {request['mode']} request received for {file_size} bytes from "
+                    f"{client_address}" + Colors.ENDC)
+                receiver = serve_udp_upload(udp_sock, client_address, request)
+                log(Colors.OKGREEN + f"UDP {request['mode']} with {client_address} completed, received "
+                    f"{receiver.unique}/{receiver.total_segments} segments." + Colors.ENDC)
+                return
+
+            histogram = LatencyHistogram()
+            payload = request_payload(request)
+            segment_size = request_segment_size(request)
+            if request['sndbuf']:
+                udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, min(request['sndbuf'], MAX_SNDBUF))
+            if request['duration_ms']:
+                log(Colors.OKCYAN + f"UDP stream of up to {request['duration_ms']} ms requested by {client_address}"
+                    + Colors.ENDC)
+                stop = threading.Event()
+                threading.Thread(target=watch_udp_stop, args=(udp_sock, client_address, stop), daemon=True).start()
+                try:
+                    datagrams, bytes_sent = send_udp_file(udp_sock, client_address, None, request['rate_bps'],
+                                                          histogram, request_timestamps(request), stop,
+                                                          stream_deadline_ns(request['duration_ms']), payload=payload,
+                                                          segment_size=segment_size)
+                finally:
+                    stop.set()  # Also ends the watcher
+            else:
+                log(Colors.OKCYAN + f"UDP request received for {file_size} bytes from {client_address}" + Colors.ENDC)
+                repairs = None
+                if request_reliable(request):
+                    repairs = RepairQueue((file_size + segment_size - 1) // segment_size)
+                datagrams, bytes_sent = send_udp_file(udp_sock, client_address, file_size, request['rate_bps'],
+                                                      histogram, request_timestamps(request), repairs=repairs,
+                                                      payload=payload, segment_size=segment_size)
+                if repairs is not None:
+                    log_repairs(client_address, repairs, datagrams)
+            counters.add(udp_transfers=1, datagrams_sent=datagrams, bytes_sent=bytes_sent)
+            metrics.transfer_finished("udp", client_address[0], histogram, bytes_sent)
+
+            log(Colors.OKGREEN + f"UDP transfer to {client_address} completed." + Colors.ENDC)
+
+    except Exception as e:
+        metrics.error("udp_handler", type(e).__name__)
+        log(Colors.FAIL + f"Error in UDP request handler: {e}" + Colors.ENDC)
+    finally:
+        counters.add(active_udp_transfers=-1)
+
+
+## TCP
+# TCP send engines
+# Every engine pushes `nbytes` of payload to a connected socket. They differ only in how the bytes reach the kernel,
+# so they can be swapped at start-up (--tcp-engine) to compare bytes/sec per core. The payload is the engine's own
+# filler unless a `PayloadPool` is given, read from `offset` on (the bytes of the transfer sent so far).
+class LegacySendEngine:
+    """
+    Original send path: builds a new bytes object for every chunk and hands it to `sendall`.
+    Kept as a baseline for comparing the other engines.
+    """
+    name = "legacy"
+    default_chunk_size = BUFFER_SIZE  # The original server's send size
+
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size or self.default_chunk_size
+
+    def chunk(self, payload, offset, nbytes):
+        if payload is None:
+            return b'A' * nbytes
+        return bytes(payload.view(offset, min(nbytes, payload.span)))
+
+    def send(self, sock, nbytes, histogram=None, payload=None, offset=0):
+        """
+        Sends `nbytes` of payload over `sock`.
+
+        Args:
+            histogram (LatencyHistogram): Records the time of every send call when given.
+            payload (PayloadPool): What to send, None = filler.
+            offset (int): Transfer offset of the first byte, where `payload` is read from.
+
+        Returns:
+            int: Number of bytes sent.
+        """
+        histogram = histogram or LatencyHistogram()
+        bytes_sent = 0
+        while bytes_sent < nbytes:
+            chunk = self.chunk(payload, offset + bytes_sent, min(self.chunk_size, nbytes - bytes_sent))
+            start_ns = time.perf_counter_ns()
+            sock.sendall(chunk)
+            histogram.observe(start_ns)
+            bytes_sent += len(chunk)
+        return bytes_sent
+
+    async def send_async(self, writer, nbytes, histogram=None, payload=None, offset=0):
+        """
+        Event-loop variant of `send`, writing to an asyncio StreamWriter and waiting for the
+        transport buffer to drain after every chunk (the write plus the drain is one send call).
+
+        Returns:
+            int: Number of bytes sent.
+        """
+        histogram = histogram or LatencyHistogram()
+        bytes_sent = 0
+        while bytes_sent < nbytes:
+            chunk = self.chunk(payload, offset + bytes_sent, min(self.chunk_size, nbytes - bytes_sent))
+            start_ns = time.perf_counter_ns()
+            writer.write(chunk)
+            await writer.drain()
+            histogram.observe(start_ns)
+            bytes_sent += len(chunk)
+        return bytes_sent
+
+    def close(self):
+        pass
+
+
+class MemoryviewSendEngine:
+    """
+    Allocation-free send path: the payload is allocated up front (see `PayloadPool`) and every
+    send call passes a memoryview of it, so no bytes object is built or copied per chunk.
+    """
+    name = "memoryview"
+    default_chunk_size = TCP_CHUNK_SIZE
+
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size or self.default_chunk_size
+        self.filler = PayloadPool(b'A', self.chunk_size)
+
+    def send(self, sock, nbytes, histogram=None, payload=None, offset=0):
+        """
+        Sends `nbytes` of payload over `sock`.
+
+        Args:
+            histogram (LatencyHistogram): Records the time of every send call when given.
+            payload (PayloadPool): What to send, None = filler.
+            offset (int): Transfer offset of the first byte, where `payload` is read from.
+
+        Returns:
+            int: Number of bytes sent.
+        """
+        histogram = histogram or LatencyHistogram()
+        payload = payload or self.filler
+        step = min(self.chunk_size, payload.span)
+        bytes_sent = 0
+        while bytes_sent < nbytes:
+            start_ns = time.perf_counter_ns()
+            sock.sendall(payload.view(offset + bytes_sent, min(step, nbytes - bytes_sent)))
+            histogram.observe(start_ns)
+            bytes_sent += step
+        return nbytes
+
+    async def send_async(self, writer, nbytes, histogram=None, payload=None, offset=0):
+        """
+        Event-loop variant of `send`, writing to an asyncio StreamWriter and waiting for the
+        transport buffer to drain after every chunk (the write plus the drain is one send call).
+
+        Returns:
+            int: Number of bytes sent.
+        """
+        histogram = histogram or LatencyHistogram()
+        payload = payload or self.filler
+        step = min(self.chunk_size, payload.span)
+        bytes_sent = 0
+        while bytes_sent < nbytes:
+            start_ns = time.perf_counter_ns()
+            writer.write(payload.view(offset + bytes_sent, min(step, nbytes - bytes_sent)))
+            await writer.drain()
+            histogram.observe(start_ns)
+            bytes_sent += step
+        return nbytes
+
+    def close(self):
+        self.filler.close()
+
+
+class SendfileSendEngine:
+    """
+    Zero-copy send path: the payload lives in an mmap'd temporary file (see `PayloadPool`) and is
+    handed to the kernel with `os.sendfile`, so the data never passes through Python. Platforms
+    without `os.sendfile` go through `socket.sendfile`, which falls back to plain sends internally.
+    """
+    name = "sendfile"
+    default_chunk_size = TCP_CHUNK_SIZE
+
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size or self.default_chunk_size
+        self.filler = PayloadPool(b'A', self.chunk_size)
+
+    def send(self, sock, nbytes, histogram=None, payload=None, offset=0):
+        """
+        Sends `nbytes` of payload over `sock`, each call starting at the pool position of the
+        next byte.
+
+        Args:
+            histogram (LatencyHistogram): Records the time of every send call when given.
+            payload (PayloadPool): What to send, None = filler.
+            offset (int): Transfer offset of the first byte, where `payload` is read from.
+
+        Returns:
+            int: Number of bytes sent.
+        """
+        histogram = histogram or LatencyHistogram()
+        payload = payload or self.filler
+        step = min(self.chunk_size, payload.span)
+        if not hasattr(os, "sendfile"):
+            bytes_sent = 0
+            while bytes_sent < nbytes:
+                start_ns = time.perf_counter_ns()
+                bytes_sent += sock.sendfile(payload.file, payload.position(offset + bytes_sent),
+                                            min(step, nbytes - bytes_sent))
+                histogram.observe(start_ns)
+            return nbytes
+
+        out_fd = sock.fileno()
+        in_fd = payload.file.fileno()
+        bytes_sent = 0
+        while bytes_sent < nbytes:
+            start_ns = time.perf_counter_ns()
+            sent = os.sendfile(out_fd, in_fd, payload.position(offset + bytes_sent), min(step, nbytes - bytes_sent))
+            histogram.observe(start_ns)
+            if sent == 0:
+                raise ConnectionError("Connection closed during sendfile")
+            bytes_sent += sent
+        return nbytes
+
+    async def send_async(self, writer, nbytes, histogram=None, payload=None, offset=0):
+        """
+        Event-loop variant of `send`, using `loop.sendfile` on the writer's transport
+        (native sendfile where the loop supports it, buffered writes otherwise).
+
+        Returns:
+            int: Number of bytes sent.
+        """
+        histogram = histogram or LatencyHistogram()
+        payload = payload or self.filler
+        step = min(self.chunk_size, payload.span)
+        loop = asyncio.get_running_loop()
+        bytes_sent = 0
+        while bytes_sent < nbytes:
+            start_ns = time.perf_counter_ns()
+            bytes_sent += await loop.sendfile(writer.transport, payload.file, payload.position(offset + bytes_sent),
+                                              min(step, nbytes - bytes_sent))
+            histogram.observe(start_ns)
+        return nbytes
+
+    def close(self):
+        self.filler.close()
+
+
+TCP_SEND_ENGINES = {
+    LegacySendEngine.name: LegacySendEngine,
+    MemoryviewSendEngine.name: MemoryviewSendEngine,
+    SendfileSendEngine.name: SendfileSendEngine,
+}
+
+
+def make_tcp_send_engine(name=TCP_SEND_ENGINE, chunk_size=None):
+    """
+    Creates the TCP send engine selected by name.
+
+    Args:
+        name (str): One of the keys of TCP_SEND_ENGINES.
+        chunk_size (int): Bytes handed to the kernel per send call, None = the engine's
+            `default_chunk_size` (TCP_CHUNK_SIZE, BUFFER_SIZE for the legacy engine).
+
+    Returns:
+        object: An engine exposing `send(sock, nbytes, histogram, payload, offset)`,
+        `send_async(writer, nbytes, histogram, payload, offset)` and `close()`.
+    """
+    if name not in TCP_SEND_ENGINES:
+        raise ValueError(f"Unknown TCP send engine '{name}', expected one of {', '.join(TCP_SEND_ENGINES)}")
+    if chunk_size is not None and chunk_size <= 0:
+        raise ValueError("Chunk size must be greater than 0")
+    return TCP_SEND_ENGINES[name](chunk_size)
+
+
+# Function to Start TCP Server
+def tcp_server(engine, reuse_port=False, tcp_sock=None):
+    """
+    Starts the TCP server, listening for incoming TCP connections on the specified TCP port.
+
+    The server accepts new client connections, and hands each connection to a thread of
+    the transfer pool. The client request involves receiving a file size and sending the
+    corresponding number of bytes. Connections beyond the admission limits or the pool's
+    queue get a REJECT message and are closed. The random payload pool is generated up front,
+    so no transfer waits for it.
+
+    Args:
+        engine: The TCP send engine shared by all connections (see `make_tcp_send_engine`).
+        reuse_port (bool): Bind with SO_REUSEPORT so several worker processes share the port.
+        tcp_sock (socket.socket): An already bound TCP socket to listen on (e.g. an ephemeral
+            loopback port in the benchmarks) instead of binding SERVER_TCP_PORT.
+    """
+    try:
+        if tcp_sock is None:
+            tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # create TCP socket and use IPv4 protocol
+            if os.name != "nt":  # Allow a quick restart while old connections sit in TIME_WAIT
+                tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            tcp_sock.bind(("0.0.0.0", SERVER_TCP_PORT))
+        random_payload()
+        with tcp_sock:
+            tcp_sock.listen()  # Server wait to TCP request
+            log(Colors.OKBLUE + f"TCP Server listening on port {tcp_sock.getsockname()[1]}" + Colors.ENDC)
+
+            while True:
+                client_socket, client_address = tcp_sock.accept()  # Accepts a new TCP connection, returns a client socket and client address
+                log(Colors.WARNING + f"New TCP connection from {client_address}" + Colors.ENDC)
+                if start_transfer("tcp", client_address[0], handle_tcp_client, client_socket, engine):
+                    continue
+                counters.add(tcp_rejected=1)
+                log(Colors.WARNING + f"TCP connection from {client_address} rejected, the server is at capacity."
+                    + Colors.ENDC)
+                with client_socket:
+                    try:
+                        client_socket.sendall(reject_message())  # Fits in the empty send buffer, never blocks
+                    except OSError as e:
+                        metrics.error("tcp_reject", type(e).__name__)
+    except Exception as e:
+        metrics.error("tcp_server", type(e).__name__)
+        log(Colors.FAIL + f"Error in TCP server: {e}" + Colors.ENDC)
+
+
+# TCP request parsing
+def parse_tcp_request(line):
+    """
+    Parses a TCP request line: the file size, optionally followed by one of TCP_MODES
+    (e.g. b"1000000 upload"), then by TCP_RANDOM_PAYLOAD (b"1000000 download random") and
+    then by name=value tuning words named in TCP_TUNING_OPTIONS (b"1000000 download chunk=65536
+    nodelay=1 cc=bbr"). A bare file size is a download of filler, as sent by older clients.
+    For "stream" the number is the longest the stream may last, in milliseconds, otherwise it
+    may be at most MAX_FILE_SIZE.
+
+    Args:
+        line (bytes): The request without its terminating newline.
+
+    Returns:
+        tuple: (file size, mode, random payload, tuning dict), or None if the request is invalid.
+    """
+    try:
+        words = line.decode().split()
+    except UnicodeDecodeError:
+        return None
+    tuning = {}
+    while len(words) > 1 and "=" in words[-1]:
+        name, _, value = words.pop().partition("=")
+        if name not in TCP_TUNING_OPTIONS or name in tuning:
+            return None
+        if name == "cc":
+            if not value.isascii() or not value.replace("_", "").isalnum():
+                return None
+            tuning[name] = value
+        elif (not value.isascii() or not value.isdigit() or name == "chunk" and not 0 < int(value) <= TCP_MAX_CHUNK
+              or name == "sndbuf" and int(value) > MAX_SNDBUF):
+            return None
+        else:
+            tuning[name] = int(value)
+    if not 1 <= len(words) <= 3 or not words[0].isascii() or not words[0].isdigit():
+        return None
+    mode = words[1] if len(words) >= 2 else "download"
+    if mode not in TCP_MODES or len(words) == 3 and words[2] != TCP_RANDOM_PAYLOAD:
+        return None
+    if mode != "stream" and int(words[0]) > MAX_FILE_SIZE:
+        return None
+    return int(words[0]), mode, len(words) == 3, tuning
+
+
+def apply_tcp_tuning(sock, tuning):
+    """
+    Applies the socket options a TCP request asked for: SO_SNDBUF ('sndbuf', bytes),
+    TCP_NODELAY ('nodelay', 0 or 1) and the congestion control algorithm ('cc', Linux).
+
+    Raises:
+        OSError: If the kernel refuses an option, e.g. a congestion control algorithm that is
+            not available on this server.
+    """
+    if tuning.get('sndbuf'):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, tuning['sndbuf'])
+    if 'nodelay' in tuning:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if tuning['nodelay'] else 0)
+    if tuning.get('cc'):
+        if not hasattr(socket, "TCP_CONGESTION"):
+            raise OSError(errno.ENOPROTOOPT, "TCP_CONGESTION is not supported on this platform")
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CONGESTION, tuning['cc'].encode())
+
+
+def format_tuning(tuning):
+    """
+    Formats tuning options as the name=value words of a request line.
+    """
+    return " ".join(f"{name}={value}" for name, value in tuning.items())
+
+
+tuned_engines = {}  # (engine name, chunk size) -> engine for the TCP requests that asked for that chunk size
+tuned_engines_lock = threading.Lock()
+
+
+def tuned_engine(engine, chunk_size):
+    """
+    The engine serving a request that asked for `chunk_size`: `engine` itself if it already
+    sends chunks of that size, otherwise an engine of the same kind created once per size.
+    Sizes are rounded down to a power of two (at least BUFFER_SIZE), which bounds how many
+    engines clients can make the server keep.
+    """
+    chunk_size = max(BUFFER_SIZE, 1 << (chunk_size.bit_length() - 1))
+    if chunk_size == engine.chunk_size:
+        return engine
+    with tuned_engines_lock:
+        key = (engine.name, chunk_size)
+        if key not in tuned_engines:
+            tuned_engines[key] = type(engine)(chunk_size)
+        return tuned_engines[key]
+
+
+def close_tuned_engines():
+    """
+    Closes the engines `tuned_engine` created.
+    """
+    with tuned_engines_lock:
+        for engine in tuned_engines.values():
+            engine.close()
+        tuned_engines.clear()
+
+
+# TCP uploads
+def receive_tcp_upload(sock, nbytes, received=0):
+    """
+    Receives an upload of `nbytes` into one reusable buffer, counting bytes and receive calls.
+
+    Args:
+        sock (socket.socket): The client connection.
+        nbytes (int): Bytes the client announced.
+        received (int): Upload bytes that already arrived together with the request line.
+
+    Returns:
+        tuple: Bytes received, receive calls and nanoseconds until the last byte arrived.
+    """
+    buffer = bytearray(TCP_CHUNK_SIZE)
+    calls = 0
+    start_ns = end_ns = time.perf_counter_ns()
+    while received < nbytes:
+        count = sock.recv_into(buffer, min(TCP_CHUNK_SIZE, nbytes - received))
+        calls += 1
+        if not count:  # The client closed its side early
+            break
+        received += count
+        end_ns = time.perf_counter_ns()
+    return received, calls, end_ns - start_ns
+
+
+def serve_tcp_upload(client_socket, engine, file_size, bidir, received=0, histogram=None, payload=None):
+    """
+    Receives an upload (and for "bidir" sends the download through `engine` at the same time),
+    then sends a RESULT_FRAME after the download payload.
+
+    Args:
+        client_socket (socket.socket): The client connection.
+        engine: The TCP send engine used for the download direction.
+        file_size (int): Bytes in each direction.
+        bidir (bool): Also send `file_size` bytes to the client.
+        received (int): Upload bytes that already arrived together with the request line.
+        histogram (LatencyHistogram): Records the send calls of the download direction.
+        payload (PayloadPool): What the download direction sends, None = filler.
+
+    Returns:
+        tuple: Bytes sent, bytes received and the receive time in nanoseconds.
+    """
+    if bidir:
+        upload = []
+        receiver = threading.Thread(
+            target=lambda: upload.append(receive_tcp_upload(client_socket, file_size, received)), daemon=True)
+        receiver.start()
+        with shaper.flow(0, engine.chunk_size) as bucket:
+            bytes_sent = send_paced(engine, client_socket, file_size, bucket, histogram, payload)
+        receiver.join()
+        if not upload:
+            raise ConnectionError("upload receiver failed")
+        bytes_received, calls, elapsed_ns = upload[0]
+    else:
+        bytes_sent = 0
+        bytes_received, calls, elapsed_ns = receive_tcp_upload(client_socket, file_size, received)
+    client_socket.sendall(RESULT_FRAME.pack(MAGIC_COOKIE, RESULT_TYPE, bytes_received, calls, elapsed_ns))
+    counters.add(tcp_transfers=1, bytes_sent=bytes_sent, bytes_received=bytes_received)
+    return bytes_sent, bytes_received, elapsed_ns
+
+
+# Duration-bounded TCP streams
+def serve_tcp_stream(client_socket, engine, duration_ms, pending=b"", histogram=None, payload=None):
+    """
+    Streams payload through `engine` until the client sends STOP (or closes its side) or
+    `duration_ms` milliseconds have passed (see `stream_deadline_ns`). A watcher thread blocks
+    on the connection for the STOP message, the sender checks for it after every STREAM_BLOCK bytes.
+
+    Args:
+        client_socket (socket.socket): The client connection.
+        engine: The TCP send engine.
+        duration_ms (int): Longest the stream may last, in milliseconds.
+        pending (bytes): Bytes that arrived after the request line, the start of an early STOP.
+        histogram (LatencyHistogram): Records the send calls.
+        payload (PayloadPool): What to send, None = filler.
+
+    Returns:
+        int: Bytes sent.
+    """
+    stop = threading.Event()
+
+    def watch_for_stop():
+        data = pending
+        try:
+            while len(data) < MESSAGE_HEADER.size:
+                chunk = client_socket.recv(MESSAGE_HEADER.size - len(data))
+                if not chunk:
+                    break
+                data += chunk
+        except OSError:
+            pass
+        stop.set()  # STOP, anything else the client sends and its end of the connection all end the stream
+
+    threading.Thread(target=watch_for_stop, daemon=True).start()
+    deadline_ns = stream_deadline_ns(duration_ms)
+    bytes_sent = 0
+    try:
+        with shaper.flow(0, engine.chunk_size) as bucket:
+            block = STREAM_BLOCK if bucket is None else engine.chunk_size  # A paced block may take long to send
+            while not stop.is_set() and time.perf_counter_ns() < deadline_ns:
+                bytes_sent += send_paced(engine, client_socket, block, bucket, histogram, payload, bytes_sent)
+    except ConnectionError:
+        if not stop.is_set():  # A client that sent its STOP may hang up before reading everything
+            raise
+    finally:
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)  # Wakes the watcher if the deadline ended the stream
+        except OSError:
+            pass
+    counters.add(tcp_transfers=1, bytes_sent=bytes_sent)
+    return bytes_sent
+
+
+# TCP Client Handler Function
+def handle_tcp_client(client_socket, engine):
+    """
+    Handles incoming TCP client connections, receives the requested file size from
+    the client, and sends the file through the given send engine.
+
+    The function ensures that the file is sent in full and reports the throughput per
+    CPU second spent by the handling thread, so engines can be compared per core.
+    Upload and bidirectional requests are handed to `serve_tcp_upload`.
+
+    Args:
+        client_socket (socket.socket): The socket object representing the client connection.
+        engine: The TCP send engine used to push the payload (see `make_tcp_send_engine`).
+    """
+    counters.add(active_tcp_transfers=1)
+    try:
+        client_ip = client_socket.getpeername()[0]
+        histogram = LatencyHistogram()
+        data = client_socket.recv(BUFFER_SIZE)  # The request line, possibly followed by the start of an upload
+        line, _, rest = data.partition(b"\n")
+        request = parse_tcp_request(line)
+        if request is None:
+            metrics.error("tcp_request", "InvalidRequest")
+            log(Colors.FAIL + "Invalid TCP request received." + Colors.ENDC)
+            return
+
+        file_size, mode, random_requested, tuning = request
+        payload = random_payload() if random_requested else None
+        if tuning:
+            apply_tcp_tuning(client_socket, tuning)
+            engine = tuned_engine(engine, tuning['chunk']) if 'chunk' in tuning else engine
+            log(Colors.OKCYAN + f"TCP request tuned: {format_tuning(tuning)}." + Colors.ENDC)
+        if mode == "stream":
+            log(Colors.OKCYAN + f"TCP stream of up to {file_size} ms requested." + Colors.ENDC)
+            start_time = time.perf_counter()
+            bytes_sent = serve_tcp_stream(client_socket, engine, file_size, rest, histogram, payload)
+            total_time = time.perf_counter() - start_time
+            metrics.transfer_finished("tcp", client_ip, histogram, bytes_sent)
+            log(Colors.OKGREEN + f"TCP stream completed. {bytes_sent} bytes sent in {total_time:.2f} seconds "
+                f"({engine.name} engine)." + Colors.ENDC)
+            return
+        if mode != "download":
+            log(Colors.OKCYAN + f"TCP {mode} request received for {file_size} bytes." + Colors.ENDC)
+            bytes_sent, bytes_received, elapsed_ns = serve_tcp_upload(client_socket, engine, file_size,
+                                                                      mode == "bidir", len(rest), histogram, payload)
+            metrics.transfer_finished("tcp", client_ip, histogram, bytes_sent, bytes_received)
+            speed = bytes_received * 8 / (elapsed_ns / 1e9) if elapsed_ns else 0
+            log(Colors.OKGREEN + f"TCP {mode} completed. {bytes_received} bytes received in {elapsed_ns / 1e9:.2f} "
+                f"seconds ({speed:.2f} bits/second), {bytes_sent} bytes sent." + Colors.ENDC)
+            return
+
+        log(Colors.OKCYAN + f"TCP request received for {file_size} bytes." + Colors.ENDC)
+        # if data is not number:
+        # try:
+        #     file_size = int(data)
+        # except ValueError:
+        #     print("Invalid input received, expected a number.")
+        #     client_socket.close()
+        #     return
+
+        start_time = time.perf_counter()
+        cpu_start = time.thread_time()  # CPU time of this thread only, kernel time of the send calls included
+        with shaper.flow(0, engine.chunk_size) as bucket:
+            bytes_sent = send_paced(engine, client_socket, file_size, bucket, histogram, payload)
+        cpu_time = time.thread_time() - cpu_start
+        counters.add(tcp_transfers=1, bytes_sent=bytes_sent)
+        metrics.transfer_finished("tcp", client_ip, histogram, bytes_sent)
+        total_time = time.perf_counter() - start_time
+
+        per_core = bytes_sent / cpu_time if cpu_time > 0 else 0  # bytes per CPU second
+        log(Colors.OKGREEN + f"TCP transfer completed. {bytes_sent} bytes sent in {total_time:.2f} seconds "
+            f"({engine.name} engine, {per_core / 1e6:.1f} MB/s per core)." + Colors.ENDC)
+    except Exception as e:
+        metrics.error("tcp_handler", type(e).__name__)
+        log(Colors.FAIL + f"Error handling TCP connection: {e}" + Colors.ENDC)
+    finally:
+        counters.add(active_tcp_transfers=-1)
+        client_socket.close()
+
+
+## Event-loop server core
+# Alternative to the thread-per-connection / thread-per-datagram core above (--core asyncio): a single asyncio loop
+# multiplexes the offer broadcaster, every TCP transfer and every UDP request using non-blocking writes.
+async def udp_offer_broadcast_async():
+    """
+    Event-loop variant of `udp_offer_broadcast`, sending the same offer message every
+    BROADCAST_INTERVAL seconds from a loop task.
+    """
+    offer_message = struct.pack('!IBHH', MAGIC_COOKIE, OFFER_TYPE, SERVER_UDP_PORT, SERVER_TCP_PORT)
+    transport = None
+    try:
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, family=socket.AF_INET,
+                                                           allow_broadcast=True)
+        log(Colors.OKBLUE + "UDP Broadcast started..." + Colors.ENDC)
+        while True:
+            transport.sendto(offer_message, ('<broadcast>', BROADCAST_PORT))
+            await asyncio.sleep(BROADCAST_INTERVAL)
+    except Exception as e:
+        metrics.error("broadcast", type(e).__name__)
+        log(Colors.FAIL + f"Error in UDP broadcast: {e}" + Colors.ENDC)
+    finally:
+        if transport is not None:
+            transport.close()
+
+
+class UdpRequestProtocol(asyncio.DatagramProtocol):
+    """
+    Receives UDP requests on the server UDP port and streams each requested file back from
+    its own loop task. Sending pauses while the transport's write buffer is above its
+    high-water mark (backpressure) and yields about every UDP_YIELD_EVERY datagrams so
+    concurrent transfers share the loop.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.transfers = set()  # Keeps references to the running transfer tasks
+        self.probe_buffer = bytearray(PROBE_TS.size)  # Timestamped probe echoes are built here
+        self.streams = {}  # Client address -> stop event of its running stream
+        self.repairs = {}  # Client address -> (RepairQueue, event set on every NACK) of its reliable download
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def error_received(self, exc):
+        metrics.error("udp_server", type(exc).__name__)
+        log(Colors.FAIL + f"Error in UDP server: {exc}" + Colors.ENDC)
+
+    def datagram_received(self, data, client_address):
+        if is_probe(data):
+            if len(data) == PROBE_TS.size:  # Stamped in a reusable buffer, the transport copies it only if it must queue it
+                self.probe_buffer[:] = data
+                stamp_probe(self.probe_buffer)
+                data = self.probe_buffer
+            self.transport.sendto(data, client_address)
+            return
+        if is_stop(data):
+            stop = self.streams.get(client_address)
+            if stop is not None:
+                stop.set()
+            return
+        if client_address in self.repairs:  # NACK or FIN of a reliable download
+            repairs, arrived = self.repairs[client_address]
+            repairs.receive(data, len(data))
+            arrived.set()
+            return
+        request = parse_udp_request(data)
+        if request is None:
+            return
+        client_ip = client_address[0]
+        if not admission.admit("udp", client_ip):
+            counters.add(udp_rejected=1)
+            log(Colors.WARNING + f"UDP request from {client_address} rejected, the server is at capacity."
+                + Colors.ENDC)
+            self.transport.sendto(reject_message(), client_address)
+            return
+        if request['mode'] != "download":
+            log(Colors.OKCYAN + f"UDP {request['mode']} request received for {request['file_size']} bytes from "
+                f"{client_address}" + Colors.ENDC)
+            transfer = asyncio.ensure_future(self.receive_file(request, client_address))
+        elif request['duration_ms']:
+            log(Colors.OKCYAN + f"UDP stream of up to {request['duration_ms']} ms requested by {client_address}"
+                + Colors.ENDC)
+            transfer = asyncio.ensure_future(self.send_file(None, client_address, request['rate_bps'],
+                                                            request_timestamps(request), request['duration_ms'],
+                                                            payload=request_payload(request),
+                                                            segment_size=request_segment_size(request)))
+        else:
+            log(Colors.OKCYAN + f"UDP request received for {request['file_size']} bytes from {client_address}"
+                + Colors.ENDC)
+            transfer = asyncio.ensure_future(self.send_file(request['file_size'], client_address,
+                                                            request['rate_bps'], request_timestamps(request),
+                                                            reliable=request_reliable(request),
+                                                            payload=request_payload(request),
+                                                            segment_size=request_segment_size(request)))
+        counters.add(active_udp_transfers=1)
+        self.transfers.add(transfer)
+        transfer.add_done_callback(lambda done: self.transfer_done(done, client_ip))
+
+    def transfer_done(self, transfer, client_ip):
+        self.transfers.discard(transfer)
+        counters.add(active_udp_transfers=-1)
+        admission.release("udp", client_ip)
+
+    async def send_file(self, file_size, client_address, rate_bps=0, timestamps=False, duration_ms=0,
+                        reliable=False, payload=None, segment_size=BUFFER_SIZE):
+        """
+        Sends the segments of a `file_size` bytes file to `client_address`, built in a reusable
+        buffer by `UdpSegmentBatcher` and paced with a token bucket when a rate was requested.
+        Every download leaves from the shared server socket, so a requested SO_SNDBUF is not applied.
+
+        Args:
+            file_size (int): The size of the requested file.
+            client_address (tuple): The address of the client that sent the request.
+            rate_bps (int): Target rate in bits/second, 0 sends unpaced (or at the transfer's share of
+                the egress cap, see `EgressShaper`).
+            timestamps (bool): Send PAYLOAD_TS_TYPE segments carrying their send time.
+            duration_ms (int): Stream (`file_size` None) until the client's STOP or for this many milliseconds.
+            reliable (bool): Resend the segments the client's NACKs report missing, ahead of new
+                ones, until its FIN or NACK_LINGER seconds of silence (see `RepairQueue`).
+            payload (PayloadPool): What the segments carry, None = filler.
+            segment_size (int): Payload bytes per datagram.
+        """
+        stop = None
+        repairs = None
+        try:
+            if duration_ms:
+                stop = self.streams[client_address] = asyncio.Event()
+                deadline_ns = stream_deadline_ns(duration_ms)
+            batcher = UdpSegmentBatcher(file_size, timestamps=timestamps, payload=payload, segment_size=segment_size)
+            if reliable:
+                repairs = RepairQueue(batcher.total_segments)
+                arrived = asyncio.Event()
+                self.repairs[client_address] = (repairs, arrived)
+            histogram = LatencyHistogram()
+            sent = 0
+            first_send_ns = time.perf_counter_ns()
+            with shaper.flow(rate_bps, batcher.stride * batcher.batch_size) as bucket:
+                while True:
+                    if stop is not None and (stop.is_set() or time.perf_counter_ns() >= deadline_ns):
+                        break
+                    nbytes = 0
+                    if repairs is not None:
+                        if repairs.finished:
+                            break
+                        if bucket is None and repairs.nacks:  # Pace the repairs and the rest, see `send_udp_batches`
+                            bucket = repairs.pacer(sent, batcher.stride, time.perf_counter_ns() - first_send_ns)
+                        nbytes = batcher.repair_batch(repairs)
+                        if repairs.exhausted:
+                            break
+                    if not nbytes:
+                        nbytes = batcher.next_batch()
+                    if not nbytes:
+                        if repairs is None:
+                            break
+                        arrived.clear()
+                        try:
+                            await asyncio.wait_for(arrived.wait(), NACK_LINGER)
+                        except asyncio.TimeoutError:
+                            break  # The client went quiet without its FIN
+                        continue
+                    if bucket is not None:
+                        delay = bucket.reserve(nbytes)
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    for datagram in batcher.datagrams(nbytes):
+                        if not self.writable.is_set():
+                            await self.writable.wait()
+                        start_ns = time.perf_counter_ns()
+                        self.transport.sendto(datagram, client_address)  # Copied by the transport only if it has to buffer
+                        histogram.observe(start_ns)
+                    sent += batcher.count
+                    if sent % UDP_YIELD_EVERY < batcher.count:
+                        await asyncio.sleep(0)
+            bytes_sent = batcher.bytes_sent
+            if repairs is not None:
+                log_repairs(client_address, repairs, sent)
+            counters.add(udp_transfers=1, datagrams_sent=sent, bytes_sent=bytes_sent)
+            metrics.transfer_finished("udp", client_address[0], histogram, bytes_sent)
+            log(Colors.OKGREEN + f"UDP transfer to {client_address} completed." + Colors.ENDC)
+        except Exception as e:
+            metrics.error("udp_handler", type(e).__name__)
+            log(Colors.FAIL + f"Error in UDP request handler: {e}" + Colors.ENDC)
+        finally:
+            if stop is not None and self.streams.get(client_address) is stop:
+                del self.streams[client_address]
+            if repairs is not None and self.repairs.get(client_address, (None,))[0] is repairs:
+                del self.repairs[client_address]
+
+    async def receive_file(self, request, client_address):
+        """
+        Event-loop variant of `serve_udp_upload`: opens a session endpoint for an upload or
+        bidirectional request, echoes the request header from it, receives the upload (while
+        the session streams the download for "bidir") and answers with a RESULT_FRAME.
+
+        Args:
+            request (dict): The request as returned by `parse_udp_request`.
+            client_address (tuple): The address of the client that sent the request.
+        """
+        transport = None
+        try:
+            loop = asyncio.get_running_loop()
+            file_size = request['file_size']
+            bidir = request['mode'] == "bidir"
+            receiver = UploadReceiver((file_size + BUFFER_SIZE - 1) // BUFFER_SIZE)
+            transport, session = await loop.create_datagram_endpoint(
+                lambda: UdpUploadProtocol(client_address, receiver), local_addr=("0.0.0.0", 0))
+            transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UPLOAD_RCVBUF)
+            transport.sendto(struct.pack(UDP_REQUEST_FORMAT, MAGIC_COOKIE, BIDIR_TYPE if bidir else UPLOAD_TYPE,
+                                         file_size), client_address)
+            # send_file counts the transfer and the bytes sent of a bidirectional request
+            sending = asyncio.ensure_future(session.send_file(file_size, client_address, request['rate_bps'],
+                                                              request_timestamps(request),
+                                                              payload=request_payload(request))) \
+                if bidir else None
+            while not receiver.finished:
+                try:
+                    await asyncio.wait_for(session.finished.wait(), UDP_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    if time.perf_counter_ns() - session.last_activity_ns >= UDP_IDLE_TIMEOUT * 1e9:
+                        break
+            if sending is not None:
+                await sending
+            result = receiver.result()
+            for _ in range(UDP_RESULT_COPIES):
+                transport.sendto(result, client_address)
+            counters.add(udp_transfers=0 if bidir else 1, datagrams_received=receiver.datagrams,
+                         bytes_received=receiver.goodput_bytes)
+            metrics.transfer_finished("udp", client_address[0], bytes_received=receiver.goodput_bytes,
+                                      transfers=0 if bidir else 1)
+            log(Colors.OKGREEN + f"UDP {request['mode']} with {client_address} completed, received "
+                f"{receiver.unique}/{receiver.total_segments} segments." + Colors.ENDC)
+        except Exception as e:
+            metrics.error("udp_handler", type(e).__name__)
+            log(Colors.FAIL + f"Error in UDP request handler: {e}" + Colors.ENDC)
+        finally:
+            if transport is not None:
+                transport.close()
+
+
+class UdpUploadProtocol(UdpRequestProtocol):
+    """
+    Session endpoint of one upload or bidirectional UDP transfer. Datagrams from the client are
+    accounted for by an `UploadReceiver`; the inherited `send_file` streams the download
+    direction with the same backpressure as the main endpoint.
+    """
+
+    def __init__(self, client_address, receiver):
+        super().__init__()
+        self.client_address = client_address
+        self.receiver = receiver
+        self.finished = asyncio.Event()
+        self.last_activity_ns = time.perf_counter_ns()
+
+    def datagram_received(self, data, client_address):
+        if client_address != self.client_address:
+            return
+        self.last_activity_ns = time.perf_counter_ns()
+        if self.receiver.record(data, len(data)):
+            self.finished.set()
+
+
+async def receive_tcp_upload_async(reader, nbytes):
+    """
+    Event-loop variant of `receive_tcp_upload`. The stream API has no `readinto`, so each read
+    returns the bytes the transport already buffered; they are counted and dropped.
+
+    Returns:
+        tuple: Bytes received, read calls and nanoseconds until the last byte arrived.
+    """
+    received = 0
+    calls = 0
+    start_ns = end_ns = time.perf_counter_ns()
+    while received < nbytes:
+        data = await reader.read(min(TCP_CHUNK_SIZE, nbytes - received))
+        calls += 1
+        if not data:
+            break
+        received += len(data)
+        end_ns = time.perf_counter_ns()
+    return received, calls, end_ns - start_ns
+
+
+async def serve_tcp_stream_async(reader, writer, engine, duration_ms, histogram=None, payload=None):
+    """
+    Event-loop variant of `serve_tcp_stream`: a read of the connection stands in for the
+    watcher thread, anything the client sends (normally STOP) or its EOF ends the stream.
+
+    Returns:
+        int: Bytes sent.
+    """
+    watcher = asyncio.ensure_future(reader.read(MESSAGE_HEADER.size))
+    client_socket = writer.get_extra_info('socket')
+    deadline_ns = stream_deadline_ns(duration_ms)
+    bytes_sent = 0
+
+    def stop_requested():
+        # loop.sendfile pauses reading on the transport for every block, which can cancel the
+        # queued read of the client's STOP, so the socket itself is polled as well.
+        return watcher.done() or bool(select.select([client_socket], [], [], 0)[0])
+
+    try:
+        with shaper.flow(0, engine.chunk_size) as bucket:
+            block = STREAM_BLOCK if bucket is None else engine.chunk_size  # A paced block may take long to send
+            while not stop_requested() and time.perf_counter_ns() < deadline_ns:
+                bytes_sent += await send_paced_async(engine, writer, block, bucket, histogram, payload, bytes_sent)
+        if not watcher.done() and stop_requested():
+            # Consume the STOP, so closing the connection sends a FIN rather than a reset.
+            await asyncio.wait((watcher,), timeout=UDP_IDLE_TIMEOUT)
+    except ConnectionError:
+        if not stop_requested():
+            raise
+    finally:
+        watcher.cancel()
+    counters.add(tcp_transfers=1, bytes_sent=bytes_sent)
+    return bytes_sent
+
+
+async def handle_tcp_client_async(reader, writer, engine):
+    """
+    Event-loop variant of `handle_tcp_client`: reads the requested file size and streams
+    it through the engine's `send_async`, which waits on the transport for backpressure.
+    Upload and bidirectional requests are received (and sent) concurrently on the loop.
+    Connections beyond the admission limits get a REJECT message and are closed.
+
+    Args:
+        reader (asyncio.StreamReader): Reader side of the client connection.
+        writer (asyncio.StreamWriter): Writer side of the client connection.
+        engine: The TCP send engine used to push the payload (see `make_tcp_send_engine`).
+    """
+    client_address = writer.get_extra_info('peername')
+    log(Colors.WARNING + f"New TCP connection from {client_address}" + Colors.ENDC)
+    if not admission.admit("tcp", client_address[0]):
+        counters.add(tcp_rejected=1)
+        log(Colors.WARNING + f"TCP connection from {client_address} rejected, the server is at capacity."
+            + Colors.ENDC)
+        writer.write(reject_message())
+        writer.close()
+        return
+    counters.add(active_tcp_transfers=1)
+    histogram = LatencyHistogram()
+    try:
+        request = parse_tcp_request((await reader.readline()).rstrip(b"\n"))
+        if request is None:
+            metrics.error("tcp_request", "InvalidRequest")
+            log(Colors.FAIL + "Invalid TCP request received." + Colors.ENDC)
+            return
+
+        file_size, mode, random_requested, tuning = request
+        payload = random_payload() if random_requested else None
+        if tuning:
+            apply_tcp_tuning(writer.get_extra_info('socket'), tuning)
+            engine = tuned_engine(engine, tuning['chunk']) if 'chunk' in tuning else engine
+            log(Colors.OKCYAN + f"TCP request tuned: {format_tuning(tuning)}." + Colors.ENDC)
+        if mode == "stream":
+            log(Colors.OKCYAN + f"TCP stream of up to {file_size} ms requested." + Colors.ENDC)
+            start_time = time.perf_counter()
+            bytes_sent = await serve_tcp_stream_async(reader, writer, engine, file_size, histogram, payload)
+            total_time = time.perf_counter() - start_time
+            metrics.transfer_finished("tcp", client_address[0], histogram, bytes_sent)
+            log(Colors.OKGREEN + f"TCP stream completed. {bytes_sent} bytes sent in {total_time:.2f} seconds "
+                f"({engine.name} engine)." + Colors.ENDC)
+            return
+        if mode != "download":
+            log(Colors.OKCYAN + f"TCP {mode} request received for {file_size} bytes." + Colors.ENDC)
+            if mode == "bidir":
+                with shaper.flow(0, engine.chunk_size) as bucket:
+                    bytes_sent, (bytes_received, calls, elapsed_ns) = await asyncio.gather(
+                        send_paced_async(engine, writer, file_size, bucket, histogram, payload),
+                        receive_tcp_upload_async(reader, file_size))
+            else:
+                bytes_sent = 0
+                bytes_received, calls, elapsed_ns = await receive_tcp_upload_async(reader, file_size)
+            writer.write(RESULT_FRAME.pack(MAGIC_COOKIE, RESULT_TYPE, bytes_received, calls, elapsed_ns))
+            await writer.drain()
+            counters.add(tcp_transfers=1, bytes_sent=bytes_sent, bytes_received=bytes_received)
+            metrics.transfer_finished("tcp", client_address[0], histogram, bytes_sent, bytes_received)
+            speed = bytes_received * 8 / (elapsed_ns / 1e9) if elapsed_ns else 0
+            log(Colors.OKGREEN + f"TCP {mode} completed. {bytes_received} bytes received in {elapsed_ns / 1e9:.2f} "
+                f"seconds ({speed:.2f} bits/second), {bytes_sent} bytes sent." + Colors.ENDC)
+            return
+
+        log(Colors.OKCYAN + f"TCP request received for {file_size} bytes." + Colors.ENDC)
+        start_time = time.perf_counter()
+        with shaper.flow(0, engine.chunk_size) as bucket:
+            bytes_sent = await send_paced_async(engine, writer, file_size, bucket, histogram, payload)
+        total_time = time.perf_counter() - start_time
+        counters.add(tcp_transfers=1, bytes_sent=bytes_sent)
+        metrics.transfer_finished("tcp", client_address[0], histogram, bytes_sent)
+        log(Colors.OKGREEN + f"TCP transfer completed. {bytes_sent} bytes sent in {total_time:.2f} seconds "
+            f"({engine.name} engine)." + Colors.ENDC)
+    except Exception as e:
+        metrics.error("tcp_handler", type(e).__name__)
+        log(Colors.FAIL + f"Error handling TCP connection: {e}" + Colors.ENDC)
+    finally:
+        counters.add(active_tcp_transfers=-1)
+        admission.release("tcp", client_address[0])
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+
+async def async_server(engine, reuse_port=False, broadcast=True, tcp_sock=None, udp_sock=None):
+    """
+    Runs the whole server (offer broadcaster, UDP server and TCP server) on the current event loop.
+    The random payload pool is generated up front, so no transfer waits for it.
+
+    Args:
+        engine: The TCP send engine shared by all connections (see `make_tcp_send_engine`).
+        reuse_port (bool): Bind with SO_REUSEPORT so several worker processes share the ports.
+        broadcast (bool): Run the offer broadcaster on this loop (off in --workers mode, where
+            the supervisor broadcasts).
+        tcp_sock (socket.socket): An already bound TCP socket to serve on instead of SERVER_TCP_PORT.
+        udp_sock (socket.socket): An already bound UDP socket to serve on instead of SERVER_UDP_PORT.
+    """
+    loop = asyncio.get_running_loop()
+    random_payload()
+    broadcaster = asyncio.ensure_future(udp_offer_broadcast_async()) if broadcast else None
+    if udp_sock is None:
+        udp_transport, _ = await loop.create_datagram_endpoint(UdpRequestProtocol,
+                                                               local_addr=("0.0.0.0", SERVER_UDP_PORT),
+                                                               reuse_port=reuse_port or None)
+    else:
+        udp_transport, _ = await loop.create_datagram_endpoint(UdpRequestProtocol, sock=udp_sock)
+    log(Colors.OKBLUE + f"UDP Server listening on port {udp_transport.get_extra_info('sockname')[1]}" + Colors.ENDC)
+    try:
+        handler = lambda reader, writer: handle_tcp_client_async(reader, writer, engine)
+        if tcp_sock is None:
+            tcp = await asyncio.start_server(handler, "0.0.0.0", SERVER_TCP_PORT, reuse_port=reuse_port or None)
+        else:
+            tcp = await asyncio.start_server(handler, sock=tcp_sock)
+        log(Colors.OKBLUE + f"TCP Server listening on port {tcp.sockets[0].getsockname()[1]}" + Colors.ENDC)
+        async with tcp:
+            await tcp.serve_forever()
+    finally:
+        udp_transport.close()
+        if broadcaster is not None:
+            broadcaster.cancel()
+
+
+## Multi-worker mode
+# --workers N forks N server processes that all bind the same ports with SO_REUSEPORT, so the kernel spreads
+# connections and datagrams across them. A supervisor broadcasts the offers, restarts dead workers and sums counters.
+def watch_supervisor(supervisor_pid):
+    """
+    Ends this worker process as soon as its supervisor is gone, so no orphaned worker keeps
+    holding the shared ports. Runs in a daemon thread of every worker.
+
+    Args:
+        supervisor_pid (int): Process id of the supervisor that started this worker.
+    """
+    while os.getppid() == supervisor_pid:
+        time.sleep(SUPERVISOR_INTERVAL)
+    os._exit(0)
+
+
+def run_server_worker(index, core, tcp_engine, chunk_size, shared_counters, metrics_port=METRICS_PORT,
+                      console_log=CONSOLE_LOG, limits=None):
+    """
+    Entry point of one worker process: serves TCP and UDP on the shared ports without broadcasting.
+
+    Args:
+        index (int): Worker number, also its row in `shared_counters`.
+        core (str): "threads" or "asyncio".
+        tcp_engine (str): Name of the TCP send engine.
+        chunk_size (int): Bytes handed to the kernel per TCP send call, None = the engine's default.
+        shared_counters: Shared-memory array holding one counter row per worker.
+        metrics_port (int): The supervisor's metrics port; this worker serves its own metrics on
+            metrics_port + 1 + index. 0 = off.
+        console_log (bool): Write per-request messages to the console.
+        limits (dict): Keyword arguments of `configure_limits` for this worker.
+    """
+    global counters, metrics
+    counters = ServerCounters(shared_counters, index)
+    counters.reset(*GAUGE_NAMES)  # A previous worker in this row may have died mid-transfer
+    metrics = ServerMetrics()
+    configure_limits(**(limits or {}))
+    start_console_log(console_log)  # The supervisor's log thread does not exist in this process
+    threading.Thread(target=watch_supervisor, args=(os.getppid(),), daemon=True).start()
+    if metrics_port:
+        start_metrics_server(metrics_port + 1 + index,
+                             lambda: render_counters([(f'worker="{index}"', counters.snapshot())]) + metrics.render())
+    engine = make_tcp_send_engine(tcp_engine, chunk_size)
+    log(Colors.OKBLUE + f"Worker {index} started (pid {os.getpid()})" + Colors.ENDC)
+    try:
+        if core == "asyncio":
+            asyncio.run(async_server(engine, reuse_port=True, broadcast=False))
+        else:
+            threading.Thread(target=udp_server, args=(True,), daemon=True).start()
+            tcp_server(engine, reuse_port=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.close()
+        close_tuned_engines()
+        stop_console_log()
+
+
+def print_worker_counters(shared_counters, workers):
+    """
+    Prints the counters of every worker and their total.
+
+    Args:
+        shared_counters: Shared-memory array holding one counter row per worker.
+        workers (int): Number of workers.
+    """
+    totals = dict.fromkeys(COUNTER_NAMES, 0)
+    for index in range(workers):
+        row = ServerCounters(shared_counters, index).snapshot()
+        for name in COUNTER_NAMES:
+            totals[name] += row[name]
+        print(Colors.OKCYAN + f"Worker {index}: " + ", ".join(f"{name} {row[name]}" for name in COUNTER_NAMES)
+              + Colors.ENDC)
+    print(Colors.BOLD + "All workers: " + ", ".join(f"{name} {totals[name]}" for name in COUNTER_NAMES) + Colors.ENDC)
+
+
+def supervise_workers(workers, core, tcp_engine, chunk_size, metrics_port=METRICS_PORT, console_log=CONSOLE_LOG,
+                      limits=None):
+    """
+    Starts `workers` server processes sharing the ports through SO_REUSEPORT, runs the offer
+    broadcaster, restarts workers that die and periodically prints the combined counters.
+
+    Args:
+        workers (int): Number of worker processes.
+        core (str): "threads" or "asyncio".
+        tcp_engine (str): Name of the TCP send engine.
+        chunk_size (int): Bytes handed to the kernel per TCP send call, None = the engine's default.
+        metrics_port (int): Serve every worker's counters on this port (and each worker's detailed
+            metrics on the ports after it), 0 = off.
+        console_log (bool): Write per-request messages to the console.
+        limits (dict): Keyword arguments of `configure_limits`; every worker applies the admission
+            limits on its own and gets an equal part of the egress cap.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        print(Colors.FAIL + "--workers needs SO_REUSEPORT, which this platform does not support." + Colors.ENDC)
+        return
+
+    shared_counters = multiprocessing.RawArray('Q', workers * len(COUNTER_NAMES))
+    processes = [None] * workers
+    worker_limits = dict(limits or {})
+    worker_limits['egress_bps'] = worker_limits.get('egress_bps', EGRESS_RATE_BPS) / workers
+
+    def start_worker(index):
+        process = multiprocessing.Process(target=run_server_worker,
+                                          args=(index, core, tcp_engine, chunk_size, shared_counters, metrics_port,
+                                                console_log, worker_limits), daemon=True)
+        process.start()
+        processes[index] = process
+
+    # Stop the workers and report on `kill` as well as on Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if metrics_port:
+        start_metrics_server(metrics_port, lambda: render_counters(
+            [(f'worker="{index}"', ServerCounters(shared_counters, index).snapshot()) for index in range(workers)]))
+    threading.Thread(target=udp_offer_broadcast, daemon=True).start()
+    for index in range(workers):
+        start_worker(index)
+
+    last_report = time.monotonic()
+    try:
+        while True:
+            time.sleep(SUPERVISOR_INTERVAL)
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    print(Colors.WARNING + f"Worker {index} (pid {process.pid}) exited with code {process.exitcode}, "
+                                           f"restarting..." + Colors.ENDC)
+                    start_worker(index)
+            if time.monotonic() - last_report >= COUNTER_REPORT_INTERVAL:
+                print_worker_counters(shared_counters, workers)
+                last_report = time.monotonic()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        print_worker_counters(shared_counters, workers)
+
+
+def parse_args(argv=None):
+    """
+    Parses the server command line options.
+
+    Args:
+        argv (list): Arguments to parse, defaults to sys.argv[1:].
+
+    Returns:
+        argparse.Namespace: The parsed options.
+    """
+    parser = argparse.ArgumentParser(description="Network speed test server.")
+    parser.add_argument("--core", choices=["threads", "asyncio"], default=SERVER_CORE,
+                        help=f"server core: one thread per transfer or a single event loop (default: {SERVER_CORE})")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS,
+                        help="server processes sharing the ports through SO_REUSEPORT (default: single process)")
+    parser.add_argument("--tcp-engine", choices=list(TCP_SEND_ENGINES), default=TCP_SEND_ENGINE,
+                        help=f"TCP send engine (default: {TCP_SEND_ENGINE})")
+    parser.add_argument("--chunk-size", type=int,
+                        help=f"bytes handed to the kernel per TCP send call (default: {TCP_CHUNK_SIZE}, "
+                             f"{LegacySendEngine.default_chunk_size} for the legacy engine)")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help=f"serve Prometheus metrics on http://{METRICS_HOST}:PORT/metrics (default: off)")
+    parser.add_argument("--quiet", action="store_true", help="do not write per-request messages to the console")
+    parser.add_argument("--max-transfers", type=int, default=MAX_TRANSFERS,
+                        help=f"transfers served at once per protocol, 0 = no limit (default: {MAX_TRANSFERS})")
+    parser.add_argument("--max-per-client", type=int, default=MAX_TRANSFERS_PER_CLIENT,
+                        help=f"transfers served at once for one client IP address, 0 = no limit "
+                             f"(default: {MAX_TRANSFERS_PER_CLIENT})")
+    parser.add_argument("--egress-mbps", type=float, default=EGRESS_RATE_BPS / 1e6,
+                        help="cap on what all transfers together send in Mbit/s, shared fairly, 0 = no cap "
+                             "(default: no cap)")
+    args = parser.parse_args(argv)
+    if args.chunk_size is not None and args.chunk_size <= 0:
+        parser.error("--chunk-size must be greater than 0")
+    if args.workers < 0:
+        parser.error("--workers must not be negative")
+    if args.max_transfers < 0 or args.max_per_client < 0 or args.egress_mbps < 0:
+        parser.error("--max-transfers, --max-per-client and --egress-mbps must not be negative")
+    if not 0 <= args.metrics_port <= 65535 - max(args.workers, 0):
+        parser.error("--metrics-port must leave room for one port per worker below 65536")
+    return args
+
+
+# Main function to start both servers
+def main(argv=None):
+    """
+    Main entry point for the server application.
+
+    Args:
+        argv (list): Command line arguments, defaults to sys.argv[1:].
+    """
+    args = parse_args(argv)
+    print(Colors.HEADER + f"Server started, listening on IP address {get_local_ip()}" + Colors.ENDC)
+    chunk_size = args.chunk_size or TCP_SEND_ENGINES[args.tcp_engine].default_chunk_size
+    print(Colors.OKBLUE + f"{args.core} core, TCP send engine: {args.tcp_engine}, chunk size: {chunk_size} bytes"
+          + Colors.ENDC)
+    start_console_log(not args.quiet)
+    limits = {'max_transfers': args.max_transfers, 'max_per_client': args.max_per_client,
+              'egress_bps': int(args.egress_mbps * 1e6)}
+    if args.egress_mbps:
+        print(Colors.OKBLUE + f"Egress capped at {args.egress_mbps:g} Mbit/s, shared fairly between transfers"
+              + Colors.ENDC)
+    if args.workers > 0:
+        try:
+            supervise_workers(args.workers, args.core, args.tcp_engine, args.chunk_size, args.metrics_port,
+                              not args.quiet, limits)
+        finally:
+            stop_console_log()
+        return
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port,
+                             lambda: render_counters([("", counters.snapshot())]) + metrics.render())
+    configure_limits(**limits)
+    engine = make_tcp_send_engine(args.tcp_engine, args.chunk_size)
+    try:
+        if args.core == "asyncio":
+            asyncio.run(async_server(engine))
+        else:
+            threading.Thread(target=udp_offer_broadcast, daemon=True).start()
+            threading.Thread(target=udp_server, daemon=True).start()
+            tcp_server(engine)
+    finally:
+        engine.close()
+        close_tuned_engines()
+        stop_console_log()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,43 @@
+import struct
+
+import pytest
+
+import Server
+
+
+@pytest.fixture
+def limits():
+    """Lets a test configure the limits, restoring the defaults afterwards."""
+    yield Server.configure_limits
+    Server.configure_limits()
+
+
+def test_pool_has_a_thread_for_every_admitted_transfer(limits):
+    limits(max_transfers=10)
+    assert Server.transfer_pool.workers == 20
+    limits(max_transfers=0)  # No admission limit: the pool and its queue bound the transfers
+    assert Server.transfer_pool.workers == Server.TRANSFER_WORKERS
+    limits()
+    assert Server.transfer_pool.workers >= 2 * Server.MAX_TRANSFERS
+
+
+def test_admission_limits_per_protocol_and_client():
+    admission = Server.AdmissionControl(max_transfers=2, max_per_client=3)
+    assert admission.admit("tcp", "10.0.0.1") and admission.admit("tcp", "10.0.0.2")
+    assert not admission.admit("tcp", "10.0.0.3")  # TCP is full
+    assert admission.admit("udp", "10.0.0.1") and admission.admit("udp", "10.0.0.1")
+    assert not admission.admit("udp", "10.0.0.1")  # 10.0.0.1 has three running
+    admission.release("tcp", "10.0.0.1")
+    assert admission.admit("tcp", "10.0.0.3")
+    assert admission.clients == {"10.0.0.1": 2, "10.0.0.2": 1, "10.0.0.3": 1}
+
+
+def test_requests_above_the_file_size_limit_are_invalid():
+    def udp_request(file_size):
+        return struct.pack(Server.UDP_REQUEST_FORMAT, Server.MAGIC_COOKIE, Server.UPLOAD_TYPE, file_size)
+
+    assert Server.parse_udp_request(udp_request(Server.MAX_FILE_SIZE))['file_size'] == Server.MAX_FILE_SIZE
+    assert Server.parse_udp_request(udp_request(Server.MAX_FILE_SIZE + 1)) is None
+    assert Server.parse_tcp_request(b"%d upload" % Server.MAX_FILE_SIZE)[0] == Server.MAX_FILE_SIZE
+    assert Server.parse_tcp_request(b"%d upload" % (Server.MAX_FILE_SIZE + 1)) is None
+    assert Server.parse_tcp_request(b"%d" % 10 ** 20) is None
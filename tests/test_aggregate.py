@@ -0,0 +1,55 @@
+import pytest
+
+import Client
+
+SECOND = 1_000_000_000
+
+
+def steady_stat(start_ns, end_ns, total_bytes):
+    """A transfer that moved `total_bytes` at a constant rate from `start_ns` to `end_ns`."""
+    series = Client.IntervalSeries(start_ns)
+    for now_ns in range(start_ns + series.interval_ns, end_ns, series.interval_ns):
+        series.sample(now_ns, total_bytes * (now_ns - start_ns) // (end_ns - start_ns), 0)
+    series.finish(end_ns, total_bytes, 0)
+    return {'start_ns': start_ns, 'end_ns': end_ns, 'series': series, 'bytes': total_bytes,
+            'speed': total_bytes * 8e9 / (end_ns - start_ns)}
+
+
+def test_aggregate_of_overlapping_transfers():
+    stats = [steady_stat(0, SECOND, 100_000_000), steady_stat(SECOND // 2, 3 * SECOND // 2, 100_000_000)]
+    aggregate = Client.aggregate_throughput(stats)
+    assert aggregate['connections'] == 2
+    assert aggregate['bytes'] == 200_000_000
+    assert aggregate['window_s'] == pytest.approx(1.5)
+    assert aggregate['throughput_bps'] == pytest.approx(200_000_000 * 8 / 1.5)
+    assert aggregate['overlap_s'] == pytest.approx(0.5)
+    assert aggregate['overlap_bps'] == pytest.approx(1.6e9, rel=1e-6)  # Both at 800 Mbit/s
+    assert aggregate['series'].bytes[-1] == 200_000_000
+    assert aggregate['interval_median_bps'] == pytest.approx(8e8, rel=1e-6)  # One transfer alone in 10 of 15 intervals
+    assert aggregate['interval_p95_bps'] == pytest.approx(1.6e9, rel=1e-6)
+
+
+def test_aggregate_without_overlap():
+    stats = [steady_stat(0, SECOND, 10_000_000), steady_stat(2 * SECOND, 3 * SECOND, 10_000_000)]
+    aggregate = Client.aggregate_throughput(stats)
+    assert aggregate['overlap_s'] is None and aggregate['overlap_bps'] is None
+    assert aggregate['throughput_bps'] == pytest.approx(20_000_000 * 8 / 3)
+    assert aggregate['interval_min_bps'] == 0  # The idle second between the transfers
+
+
+def test_aggregate_of_nothing():
+    assert Client.aggregate_throughput([]) == {'connections': 0}
+
+
+def test_trial_metrics_always_report_overlap():
+    metrics = Client.trial_metrics([steady_stat(0, SECOND, 1_000_000), steady_stat(2 * SECOND, 3 * SECOND, 1_000_000)])
+    assert 'overlap_bps' in metrics and metrics['overlap_bps'] is None
+
+
+def test_upload_series_counts_the_bytes_received():
+    sent = steady_stat(0, SECOND, 10_000_000)['series']
+    result = (Client.MAGIC_COOKIE, Client.RESULT_TYPE, 9_000_000, 8790, SECOND)
+    stat = Client.upload_stat(1, result, 0, SECOND, sent, 10_000_000, 9766)
+    assert stat['bytes'] == stat['series'].bytes[-1] == 9_000_000
+    assert list(stat['series'].ends_ns) == list(sent.ends_ns)
+    assert sent.bytes[-1] == 10_000_000  # The sender's series is left alone
@@ -0,0 +1,38 @@
+import json
+
+import pytest
+
+import Benchmark
+
+RESULTS = {'tcp-threads': {'throughput_bps': 9e9, 'packets_per_s': 1e5, 'cpu_s_per_gb': 0.5}}
+
+
+def test_regression_beyond_the_threshold_is_flagged():
+    baseline = {'tcp-threads': {'throughput_bps': 1e10, 'packets_per_s': 1e5, 'cpu_s_per_gb': 0.4},
+                'udp-threads': {'throughput_bps': 1e9}}  # Not in the current run
+    comparisons = {comparison['metric']: comparison
+                   for comparison in Benchmark.compare_to_baseline(RESULTS, baseline, threshold=0.10)}
+    assert set(comparisons) == set(Benchmark.TRACKED_METRICS)
+    assert comparisons['throughput_bps']['change'] == pytest.approx(-0.1)
+    assert not comparisons['throughput_bps']['regressed']  # Exactly at the threshold
+    assert not comparisons['packets_per_s']['regressed']
+    assert comparisons['cpu_s_per_gb']['change'] == pytest.approx(-0.25)  # Lower is better
+    assert comparisons['cpu_s_per_gb']['regressed']
+
+
+def test_metrics_missing_from_either_run_are_skipped():
+    baseline = {'tcp-threads': {'throughput_bps': 0, 'packets_per_s': 1e5}}
+    comparisons = Benchmark.compare_to_baseline(RESULTS, baseline)
+    assert [comparison['metric'] for comparison in comparisons] == ['packets_per_s']
+
+
+def test_main_gates_against_the_baseline(tmp_path, monkeypatch):
+    monkeypatch.setattr(Benchmark, "run_benchmarks", lambda *args: RESULTS)
+    path = tmp_path / "baseline.json"
+    assert Benchmark.main(["--baseline", str(path)]) == 0  # No baseline yet: nothing to gate against
+    assert Benchmark.main(["--baseline", str(path), "--save-baseline"]) == 0
+    assert Benchmark.main(["--baseline", str(path)]) == 0
+    baseline = json.loads(path.read_text())
+    baseline['results']['tcp-threads']['throughput_bps'] = 2e10
+    path.write_text(json.dumps(baseline))
+    assert Benchmark.main(["--baseline", str(path)]) == 1
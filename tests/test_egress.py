@@ -0,0 +1,30 @@
+import pytest
+
+from Server import EgressShaper
+
+
+def test_capped_rate_is_shared_max_min_fairly():
+    shaper = EgressShaper(rate_bps=8e6)  # 1 MB/s
+    with shaper.flow() as first, shaper.flow() as second:
+        assert first.rate == second.rate == pytest.approx(500000)
+        with shaper.flow(rate_bps=1e6) as slow:  # Asks for less than its share and keeps it
+            assert slow.rate == pytest.approx(125000)
+            assert first.rate == second.rate == pytest.approx(437500)
+        assert first.rate == second.rate == pytest.approx(500000)
+    assert shaper.flows == {}
+
+
+def test_capped_rate_is_split_when_every_flow_asks_for_more():
+    shaper = EgressShaper(rate_bps=8e6)
+    with shaper.flow(rate_bps=6e6) as first, shaper.flow(rate_bps=16e6) as second:
+        assert first.rate == second.rate == pytest.approx(500000)
+
+
+def test_uncapped_shaper_only_paces_requested_rates():
+    shaper = EgressShaper(rate_bps=0)
+    with shaper.flow(min_burst=1500) as bucket:
+        assert bucket is None
+    with shaper.flow(rate_bps=8e6, min_burst=1500) as bucket:
+        assert bucket.rate == pytest.approx(1e6)
+        assert bucket.burst >= 1500
+    assert shaper.flows == {}
@@ -0,0 +1,61 @@
+import math
+
+import pytest
+
+import Client
+
+
+def record(timestamp_s, server="10.0.0.1", throughput=1e9, overlap=math.nan, loss=math.nan):
+    return (int(timestamp_s * 1e9), Client.history_server_key(server), Client.HISTORY_PROTOCOLS.index("udp"),
+            Client.HISTORY_DIRECTIONS.index("download"), Client.HISTORY_FLAG_RELIABLE, 1, 4, 4, 1_000_000, 0,
+            4_000_000, 0.5, throughput, overlap, 9e8, 2.5e8, loss, 0)
+
+
+def test_history_round_trip(tmp_path):
+    store = Client.HistoryStore(str(tmp_path / "history"))
+    store.append([record(1000, overlap=2e9, loss=1.5), record(1001)])
+    assert store.count() == 2
+    first, second = store.query()
+    assert first['timestamp'] == pytest.approx(1000)
+    assert first['server'] == "10.0.0.1"
+    assert (first['protocol'], first['direction'], first['reliable'], first['random_payload']) == \
+           ("udp", "download", True, False)
+    assert (first['connections'], first['completed'], first['file_size'], first['bytes']) == (4, 4, 1_000_000, 4_000_000)
+    assert (first['throughput_bps'], first['overlap_bps'], first['loss_percent']) == (1e9, 2e9, 1.5)
+    assert second['overlap_bps'] is None and second['loss_percent'] is None  # NaN stands for not measured
+
+
+def test_history_query_by_server_and_time(tmp_path):
+    store = Client.HistoryStore(str(tmp_path / "history"))
+    store.append([record(1000 + index, "10.0.0.1" if index % 2 else "10.0.0.2") for index in range(10)])
+    assert len(store.query()) == 10
+    assert [entry['timestamp'] for entry in store.query("10.0.0.1")] == pytest.approx([1001, 1003, 1005, 1007, 1009])
+    assert [entry['timestamp'] for entry in store.query(since=1004, until=1007)] == pytest.approx([1004, 1005, 1006])
+    assert store.query("10.0.0.3") == []
+    assert store.query(since=2000) == []
+
+
+def test_history_keeps_timestamps_in_order(tmp_path):
+    store = Client.HistoryStore(str(tmp_path / "history"))
+    store.append([record(1000)])
+    store.append([record(900)])  # The clock stepped back
+    assert [entry['timestamp'] for entry in store.query()] == pytest.approx([1000, 1000])
+
+
+def test_history_ignores_a_partial_tail(tmp_path):
+    path = tmp_path / "history"
+    store = Client.HistoryStore(str(path))
+    store.append([record(1000)])
+    with open(path, "ab") as f:
+        f.write(b"torn")
+    assert store.count() == 1
+    store.append([record(1001)])
+    assert store.count() == 2
+    assert path.stat().st_size == len(Client.HISTORY_MAGIC) + 2 * Client.HISTORY_RECORD.size
+
+
+def test_history_refuses_other_files(tmp_path):
+    path = tmp_path / "history"
+    path.write_bytes(b"not a history")
+    with pytest.raises(ValueError):
+        Client.HistoryStore(str(path)).append([record(1000)])
@@ -0,0 +1,42 @@
+import socket
+import threading
+
+import Client
+
+
+def download(data, read_size=4096):
+    """Receives `data` through `receive_tcp_download` as a random payload download."""
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        thread = threading.Thread(target=lambda: (sender.sendall(data), sender.shutdown(socket.SHUT_WR)))
+        thread.start()
+        stat = Client.receive_tcp_download(receiver, len(data), 1, read_size=read_size, random_payload=True)
+        thread.join()
+    return stat['report']
+
+
+def test_payload_pool_repeats_the_seeded_pool():
+    pool = Client.payload_pool(Client.BUFFER_SIZE)
+    assert len(pool) >= Client.PAYLOAD_POOL_SIZE + Client.BUFFER_SIZE
+    assert pool[Client.PAYLOAD_POOL_SIZE:Client.PAYLOAD_POOL_SIZE + 100] == pool[:100]
+
+
+def test_intact_random_payload_passes():
+    size = 3 * Client.PAYLOAD_POOL_SIZE + 12345  # Wraps around the pool
+    data = (Client.payload_pool(Client.PAYLOAD_POOL_SIZE) * 4)[:size]
+    report = download(data)
+    assert report['corrupt'] == 0 and report['first_corrupt_byte'] is None
+
+
+def test_filler_is_reported_as_corrupt():
+    report = download(b'A' * 100_000)
+    assert report['corrupt'] > 0 and report['first_corrupt_byte'] == 0
+
+
+def test_single_flipped_byte_is_detected():
+    size = 3 * Client.PAYLOAD_POOL_SIZE
+    data = bytearray((Client.payload_pool(Client.PAYLOAD_POOL_SIZE) * 3)[:size])
+    data[size // 2 + 17] ^= 0x01
+    report = download(bytes(data), read_size=256 * 1024)
+    assert report['corrupt'] == 1
+    assert report['first_corrupt_byte'] <= size // 2 + 17
@@ -0,0 +1,127 @@
+import struct
+
+import Client
+import Server
+
+
+class RecordingSocket:
+    """Collects what `send_nacks` sends instead of sending it."""
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append((bytes(data), address))
+
+
+def tracker_with(total_segments, received):
+    tracker = Client.ReceiveTracker(total_segments)
+    for segment in received:
+        tracker.record(segment, Client.BUFFER_SIZE, 0)
+    return tracker
+
+
+def nack_message(ranges):
+    message = Server.NACK_HEADER.pack(Server.MAGIC_COOKIE, Server.NACK_TYPE, len(ranges))
+    return message + b''.join(Server.NACK_RANGE.pack(start, end - start) for start, end in ranges)
+
+
+def test_missing_ranges_merges_holes_across_bytes():
+    tracker = tracker_with(40, [0, 1, 2, 10, 11, 30])
+    assert tracker.missing_ranges() == [(3, 10), (12, 30), (31, 40)]
+
+
+def test_missing_ranges_window_and_limit():
+    tracker = tracker_with(40, [0, 1, 2, 10, 11, 30])
+    assert tracker.missing_ranges(5, 20) == [(5, 10), (12, 20)]
+    assert tracker.missing_ranges(limit=2) == [(3, 10), (12, 30)]
+    assert tracker.missing_ranges(38, 100) == [(38, 40)]
+
+
+def test_missing_ranges_complete_and_empty():
+    assert tracker_with(17, range(17)).missing_ranges() == []
+    assert tracker_with(17, []).missing_ranges() == [(0, 17)]
+
+
+def test_nacks_round_trip_into_repair_queue():
+    ranges = [(2 * index, 2 * index + 1) for index in range(Client.NACK_MAX_RANGES + 5)]
+    sock = RecordingSocket()
+    assert Client.send_nacks(sock, ("127.0.0.1", 9), ranges) == 2
+    assert all(len(data) <= Client.BUFFER_SIZE and address == ("127.0.0.1", 9) for data, address in sock.sent)
+
+    repairs = Server.RepairQueue(1000)
+    for data, _ in sock.sent:
+        repairs.receive(data, len(data))
+    assert repairs.nacks == 2
+    assert repairs.ranges == ranges
+
+
+def test_repair_queue_ignores_malformed_messages():
+    repairs = Server.RepairQueue(100)
+    message = nack_message([(1, 5)])
+    repairs.receive(message, len(message) - 1)  # Truncated range
+    repairs.receive(b'\x00' * len(message), len(message))  # Wrong magic cookie
+    assert repairs.nacks == 0 and repairs.ranges == []
+    fin = struct.pack('!IB', Server.MAGIC_COOKIE, Server.FIN_TYPE)
+    repairs.receive(fin, len(fin))
+    assert repairs.finished
+
+
+def test_repair_queue_merges_and_clips_ranges():
+    repairs = Server.RepairQueue(100)
+    repairs.add(10, 20)
+    repairs.add(30, 40)
+    repairs.add(15, 25)  # Overlaps the first range
+    repairs.add(25, 30)  # Touches both
+    repairs.add(10, 20)  # Asked for again while pending
+    repairs.add(95, 120)  # Past the end of the transfer
+    assert repairs.ranges == [(10, 40), (95, 100)]
+    assert repairs.requested == repairs.pending == 35
+
+
+def test_repair_queue_charges_budget_on_take():
+    repairs = Server.RepairQueue(10)
+    budget = repairs.budget
+    repairs.add(0, 10)
+    repairs.add(0, 10)
+    assert repairs.budget == budget
+    assert repairs.take(4) == (0, 4)
+    assert repairs.take(100) == (4, 6)
+    assert repairs.take(100) is None
+    assert repairs.budget == budget - 10
+    assert not repairs.exhausted
+
+
+def test_repair_queue_exhausts_budget():
+    repairs = Server.RepairQueue(2)
+    for _ in range(Server.NACK_REPAIR_BUDGET):
+        repairs.add(0, 2)
+        while repairs.take(1):
+            pass
+    repairs.add(0, 2)
+    assert repairs.take(1) is None
+    assert repairs.exhausted and repairs.ranges == []
+
+
+def test_nack_scheduler_asks_once_per_hole_until_repairs_go_quiet():
+    interval_ns = int(Client.NACK_INTERVAL * 1e9)
+    tracker = tracker_with(100, [0, 1, 5, 6])
+    nacks = Client.NackScheduler(0)
+    assert nacks.due(tracker, interval_ns) == []  # Holes younger than one interval may only be reordered
+    tracker.record(50, Client.BUFFER_SIZE, 0)
+    assert nacks.due(tracker, 2 * interval_ns) == [(2, 5)]
+    nacks.probe_ns = 2 * interval_ns
+    assert nacks.due(tracker, 2 * interval_ns + 1) == []  # Not asked for again right away
+    tracker.record(3, Client.BUFFER_SIZE, 0)
+    nacks.arrived(3, 3 * interval_ns)  # A repair, sampling the round trip
+    assert nacks.rtt_ns == interval_ns
+    assert nacks.due(tracker, 3 * interval_ns) == [(7, 50)]
+    later_ns = 3 * interval_ns + nacks.wait_ns
+    assert nacks.due(tracker, later_ns) == [(2, 3), (4, 5), (7, 50)]  # Quiet since: everything still missing again
+
+
+def test_nack_scheduler_asks_for_the_tail_once_the_server_is_quiet():
+    tracker = tracker_with(10, [0, 1, 2])
+    nacks = Client.NackScheduler(0)
+    assert nacks.due(tracker, 1, quiet=True) == [(3, 10)]
+    assert nacks.due(tracker, 2, quiet=True) == []
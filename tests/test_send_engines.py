@@ -0,0 +1,25 @@
+import pytest
+
+import Server
+
+
+@pytest.mark.parametrize("name", list(Server.TCP_SEND_ENGINES))
+def test_engines_default_to_their_own_chunk_size(name):
+    engine = Server.make_tcp_send_engine(name)
+    try:
+        expected = Server.BUFFER_SIZE if name == "legacy" else Server.TCP_CHUNK_SIZE
+        assert engine.chunk_size == expected
+    finally:
+        engine.close()
+
+
+def test_explicit_chunk_size_overrides_the_default():
+    engine = Server.make_tcp_send_engine("legacy", 65536)
+    assert engine.chunk_size == 65536
+
+
+def test_invalid_engine_settings():
+    with pytest.raises(ValueError):
+        Server.make_tcp_send_engine("carrier-pigeon")
+    with pytest.raises(ValueError):
+        Server.make_tcp_send_engine("memoryview", 0)
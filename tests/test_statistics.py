@@ -0,0 +1,60 @@
+import math
+import socket
+
+import pytest
+
+import Client
+from Client import T_CRITICAL_95, failed_configurations, summarize
+
+
+def test_summary_of_no_values_is_empty():
+    assert summarize([]) == {'n': 0, 'mean': None, 'stdev': None, 'ci95_low': None, 'ci95_high': None}
+    assert summarize([None, None])['n'] == 0
+
+
+def test_single_value_has_no_spread():
+    assert summarize([5.0]) == {'n': 1, 'mean': 5.0, 'stdev': 0.0, 'ci95_low': 5.0, 'ci95_high': 5.0}
+
+
+def test_small_samples_use_the_t_distribution():
+    summary = summarize([1, 2, 3, None])  # The missing value is left out
+    margin = T_CRITICAL_95[1] / math.sqrt(3)
+    assert summary['n'] == 3
+    assert summary['mean'] == pytest.approx(2)
+    assert summary['stdev'] == pytest.approx(1)
+    assert summary['ci95_low'] == pytest.approx(2 - margin)
+    assert summary['ci95_high'] == pytest.approx(2 + margin)
+
+
+def test_large_samples_use_the_normal_quantile():
+    values = [0, 2] * 50
+    summary = summarize(values)
+    stdev = summary['stdev']
+    assert summary['ci95_high'] - summary['mean'] == pytest.approx(1.96 * stdev / 10)
+
+
+def test_configuration_without_a_completed_trial_fails():
+    results = {'configurations': [
+        {'trials': [{'completed': 0}, {'completed': 2}]},
+        {'trials': [{'completed': 0}, {'completed': 0}]},
+        {'trials': [{'completed': 1, 'upload_completed': 0}]},  # Bidirectional, the upload failed
+        {'trials': []},
+    ]}
+    assert failed_configurations(results) == results['configurations'][1:]
+
+
+def test_udp_download_without_an_answer_records_no_transfer(monkeypatch):
+    monkeypatch.setattr(Client, "UDP_IDLE_TIMEOUT", 0.1)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as silent:  # Takes the request, never answers
+        silent.bind(("127.0.0.1", 0))
+        stats = []
+        Client.udp_download("127.0.0.1", silent.getsockname()[1], 10000, 1, stats)
+    assert stats == []
+    assert Client.trial_metrics(stats)['completed'] == 0
+
+
+def test_transfers_without_data_do_not_count_as_completed():
+    series = Client.IntervalSeries(0)
+    series.finish(10 ** 9, 0, 0)
+    empty = {'start_ns': 0, 'end_ns': 10 ** 9, 'series': series, 'bytes': 0, 'speed': 0.0}
+    assert Client.trial_metrics([empty])['completed'] == 0
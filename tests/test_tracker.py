@@ -0,0 +1,21 @@
+from Client import ReceiveTracker
+
+
+def test_tracker_adopts_the_servers_split_before_the_first_segment():
+    tracker = ReceiveTracker(10)
+    assert tracker.accepts_total(20, limit=40)
+    assert tracker.total_segments == 20 and len(tracker.seen) == 3
+    assert tracker.record(19, 100, 0)
+
+
+def test_tracker_ignores_totals_that_contradict_the_transfer():
+    tracker = ReceiveTracker(10)
+    assert not tracker.accepts_total(2 ** 60, limit=40)  # Beyond what the requested size allows
+    assert tracker.record(3, 100, 0)
+    assert not tracker.accepts_total(20, limit=40)  # A stray datagram keeps what arrived
+    assert tracker.accepts_total(10, limit=40)
+    assert tracker.total_segments == 10 and tracker.unique == 1
+
+
+def test_stream_accepts_any_total():
+    assert ReceiveTracker(0, stream=True).accepts_total(5, limit=0)
@@ -0,0 +1,46 @@
+import Client
+import Server
+from Client import (BUFFER_SIZE, IP_UDP_OVERHEAD, PAYLOAD_TS_HEADER, TUNE_SNDBUFS, TUNE_TCP_CHUNKS,
+                    UDP_MAX_SEGMENT, connection_tuning, tuning_space)
+
+
+def test_tcp_space_starts_every_option_at_the_default(monkeypatch):
+    monkeypatch.setattr(Client, "available_congestion_control", lambda: ["cubic", "bbr"])
+    space = dict(tuning_space("tcp", 1500))
+    assert list(space) == ['chunk', 'sndbuf', 'rcvbuf', 'nodelay', 'cc']
+    assert space['chunk'] == (0,) + TUNE_TCP_CHUNKS
+    assert space['sndbuf'] == (0,) + TUNE_SNDBUFS
+    assert space['cc'] == ("", "cubic", "bbr")
+
+
+def test_udp_segments_are_bounded_by_the_path_mtu():
+    space = dict(tuning_space("udp", 1500))
+    largest = 1500 - IP_UDP_OVERHEAD - PAYLOAD_TS_HEADER.size
+    assert space['segment_size'][0] == 0
+    assert max(space['segment_size']) == largest
+    assert BUFFER_SIZE not in space['segment_size']  # Already covered by the default
+    assert list(space['segment_size'][1:]) == sorted(space['segment_size'][1:])
+
+
+def test_udp_segments_stop_at_the_largest_datagram():
+    segments = dict(tuning_space("udp", 1 << 20))['segment_size']
+    assert max(segments) == UDP_MAX_SEGMENT
+
+
+def test_connection_tuning_per_server_and_protocol():
+    tuning = {'10.0.0.5': {'tcp': {'chunk': 65536}}}
+    assert connection_tuning(tuning, '10.0.0.5', "tcp") == {'chunk': 65536}
+    assert connection_tuning(tuning, '10.0.0.5', "udp") is None
+    assert connection_tuning(tuning, '10.0.0.6', "tcp") is None
+    assert connection_tuning(None, '10.0.0.5', "tcp") is None
+
+
+def test_server_parses_tuning_words():
+    assert Server.parse_tcp_request(b"1000 download chunk=65536 sndbuf=1048576 nodelay=1 cc=bbr") == (
+        1000, "download", False, {'cc': "bbr", 'nodelay': 1, 'sndbuf': 1048576, 'chunk': 65536})
+
+
+def test_server_rejects_malformed_or_oversized_tuning():
+    for line in ("1000 download chunk=²", "²", "1000 download sndbuf=99999999999999999999",
+                 "1000 download chunk=%d" % (Server.TCP_MAX_CHUNK + 1), "1000 download sndbuf=-1"):
+        assert Server.parse_tcp_request(line.encode()) is None, line
@@ -0,0 +1,26 @@
+from Server import MAGIC_COOKIE, PAYLOAD_HEADER, PAYLOAD_TYPE, RESULT_FRAME, UploadReceiver
+
+
+def segment(number, total, payload=b'x' * 100):
+    return PAYLOAD_HEADER.pack(MAGIC_COOKIE, PAYLOAD_TYPE, total, number) + payload
+
+
+def test_receiver_counts_unique_segments_once():
+    receiver = UploadReceiver(10)
+    assert len(receiver.seen) == 2  # One bit per segment
+    for number in (0, 9, 9, 3, 10, 8):  # A duplicate and one past the last segment
+        data = segment(number, 10)
+        receiver.record(data, len(data))
+    assert receiver.unique == 4 and receiver.datagrams == 6
+    assert receiver.goodput_bytes == 400
+    assert not receiver.finished
+
+
+def test_receiver_finishes_with_the_last_segment():
+    receiver = UploadReceiver(9)
+    for number in range(9):
+        data = segment(number, 9)
+        finished = receiver.record(data, len(data))
+    assert finished
+    _, _, goodput, unique, _ = RESULT_FRAME.unpack(receiver.result())
+    assert (goodput, unique) == (900, 9)